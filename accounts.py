@@ -0,0 +1,100 @@
+import json
+import os
+import zlib
+from collections import namedtuple
+
+# Mailboxes MailLLM answers for. Without ACCOUNTS_FILE there is a single
+# account named 'default' built from EMAIL/PASSWORD and the IMAP_*/SMTP_*
+# settings, so existing .env setups keep working unchanged.
+Account = namedtuple(
+    'Account',
+    'name email password imap_host imap_port imap_ssl smtp_host smtp_port smtp_ssl folders sent_folder'
+)
+
+DEFAULT_ACCOUNT = 'default'
+
+
+def _flag(value):
+    """Read a boolean from JSON or an env-style '0'/'1' string"""
+    if isinstance(value, str):
+        return value.strip().lower() not in ('0', 'false', 'no', '')
+    return bool(value)
+
+
+def default_account():
+    """The single account configured through the environment"""
+    return Account(
+        name=DEFAULT_ACCOUNT,
+        email=os.getenv('EMAIL'),
+        password=os.getenv('PASSWORD'),
+        imap_host=os.getenv('IMAP_HOST', 'imap.gmail.com'),
+        imap_port=int(os.getenv('IMAP_PORT', '993')),
+        imap_ssl=_flag(os.getenv('IMAP_SSL', '1')),
+        smtp_host=os.getenv('SMTP_HOST', 'smtp.gmail.com'),
+        smtp_port=int(os.getenv('SMTP_PORT', '465')),
+        smtp_ssl=_flag(os.getenv('SMTP_SSL', '1')),
+        folders=("INBOX",),
+        sent_folder=os.getenv('SENT_FOLDER', '[Gmail]/Sent Mail')
+    )
+
+
+def load_accounts(path):
+    """Read accounts from a JSON file.
+
+    The file holds {"accounts": [...]}; every entry needs a unique "name"
+    and an "email". Passwords can be given inline as "password" or, better,
+    as "password_env" naming an environment variable. Server settings and
+    "folders" fall back to the environment defaults.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    base = default_account()
+    accounts = []
+    for entry in config.get('accounts', []):
+        password = entry.get('password')
+        if password is None and entry.get('password_env'):
+            password = os.getenv(entry['password_env'])
+
+        accounts.append(Account(
+            name=entry['name'],
+            email=entry['email'],
+            password=password,
+            imap_host=entry.get('imap_host', base.imap_host),
+            imap_port=int(entry.get('imap_port', base.imap_port)),
+            imap_ssl=_flag(entry.get('imap_ssl', base.imap_ssl)),
+            smtp_host=entry.get('smtp_host', base.smtp_host),
+            smtp_port=int(entry.get('smtp_port', base.smtp_port)),
+            smtp_ssl=_flag(entry.get('smtp_ssl', base.smtp_ssl)),
+            folders=tuple(entry.get('folders', base.folders)),
+            sent_folder=entry.get('sent_folder', base.sent_folder)
+        ))
+
+    names = [account.name for account in accounts]
+    if len(names) != len(set(names)):
+        raise ValueError(f"duplicate account names in {path}")
+    return accounts
+
+
+def partition(accounts, spec):
+    """Keep the accounts owned by partition `spec` ("i/n", e.g. "0/3").
+
+    Accounts are assigned by a stable hash of their name, so every process
+    started with the same n agrees on who owns what without coordinating.
+    """
+    if not spec:
+        return accounts
+
+    index, _, count = spec.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"bad PARTITION {spec!r}, expected i/n with 0 <= i < n")
+
+    return [account for account in accounts if zlib.crc32(account.name.encode()) % count == index]
+
+
+def configured_accounts():
+    """Accounts this process should serve: ACCOUNTS_FILE (or the .env account), filtered by PARTITION"""
+    path = os.getenv('ACCOUNTS_FILE')
+    accounts = load_accounts(path) if path else [default_account()]
+    return partition(accounts, os.getenv('PARTITION'))
@@ -1,6 +1,12 @@
-from groq import Groq # type: ignore
+import asyncio
 import os
+import re
+import threading
+import time
 from dotenv import load_dotenv
+import metrics
+from preprocess import count_tokens
+from rate_limiter import RateLimiter
 
 # Load environment variables
 load_dotenv()
@@ -8,17 +14,7 @@ load_dotenv()
 # Get Groq API key from .env file
 GROQ_API_KEY = os.getenv('GROQ_API_KEY')
 
-client = Groq(api_key=GROQ_API_KEY)
-
-def email_ai_response(email_content):
-     chat_completion = client.chat.completions.create(
-         messages=[
-             # Set an optional system message. This sets the behavior of the
-             # assistant and can be used to provide specific instructions for
-             # how it should behave throughout the conversation.
-             {
-                 "role": "system",
-                 "content": '''
+SYSTEM_PROMPT = '''
 You are MailLLM, an AI service that answers questions via email. Respond **only with the answer** to the question asked, formatted as a proper email. 
 
 Requirements:
@@ -50,17 +46,340 @@ From your prior request, here is the answer to your question: <answer content he
 Best Regards,  
 MailLLM
 '''
-             },
-             # Set a user message for the assistant to respond to.
-             {
-                 "role": "user",
-                 "content": email_content,
-             }
-         ],
-
-         # The language model which will generate the completion.
-         model="llama-3.1-8b-instant"
-     )
-
-     # Return the completion returned by the LLM.
-     return chat_completion.choices[0].message.content
\ No newline at end of file
+
+# Groq clients, created on first use: importing groq is slow, and only the
+# process role ever calls the LLM. The async one belongs to the event loop
+# that first uses it.
+client = None
+async_client = None
+_client_lock = threading.Lock()
+
+# Model tiers: involved or long mail goes to the strong model, everything
+# else (and anything the strong model can't answer in time) to the fast one.
+# LLM_STRONG_MODEL= (empty) sends everything to the fast model.
+FAST_MODEL = os.getenv('LLM_FAST_MODEL', 'llama-3.1-8b-instant')
+STRONG_MODEL = os.getenv('LLM_STRONG_MODEL', 'llama-3.3-70b-versatile')
+
+# Prompts at least this long (subject, body and thread context) count as hard
+STRONG_MIN_TOKENS = int(os.getenv('LLM_STRONG_MIN_TOKENS', '400'))
+
+# Groq quota per model (defaults match the free tier of each)
+GROQ_RPM = int(os.getenv('GROQ_RPM', '30'))
+GROQ_TPM = int(os.getenv('GROQ_TPM', '6000'))
+GROQ_STRONG_RPM = int(os.getenv('GROQ_STRONG_RPM', '30'))
+GROQ_STRONG_TPM = int(os.getenv('GROQ_STRONG_TPM', '12000'))
+
+# Shared by every worker thread; rate_limiter (the fast model's) drives the reply scheduler
+rate_limiter = RateLimiter(GROQ_RPM, GROQ_TPM)
+rate_limiters = {FAST_MODEL: rate_limiter}
+if STRONG_MODEL and STRONG_MODEL != FAST_MODEL:
+     rate_limiters[STRONG_MODEL] = RateLimiter(GROQ_STRONG_RPM, GROQ_STRONG_TPM)
+
+# Cap on the reply's length; a mail answer never needs more
+MAX_COMPLETION_TOKENS = int(os.getenv('LLM_MAX_TOKENS', '600'))
+
+# Rough allowance for the reply when estimating a request's token cost
+ESTIMATED_COMPLETION_TOKENS = min(400, MAX_COMPLETION_TOKENS)
+
+# Seconds one model may take for a whole reply, and may go silent (before
+# the first token or between chunks), before it is abandoned
+MODEL_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '20'))
+STALL_TIMEOUT = float(os.getenv('LLM_STALL_TIMEOUT', '8'))
+
+# Seconds a reply may take across every tier it falls back through
+REPLY_DEADLINE = float(os.getenv('LLM_DEADLINE', '45'))
+
+# How many times a rate-limited request is retried before giving up
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Sent instead when no model can answer within the deadline (see index.canned_reply)
+CANNED_REPLY = """Dear {name},
+
+Thank you for your email. MailLLM is very busy right now and couldn't answer your question in time. Please send it again a little later and you will get a full answer.
+
+Best Regards,
+MailLLM"""
+
+# Signs of a question that needs more than the fast model
+_HARD_HINTS = re.compile(
+    r'```|\b(explain|compare|why|prove|derive|calculate|step[- ]by[- ]step|debug|traceback|algorithm)\b',
+    re.IGNORECASE
+)
+
+class LLMUnavailable(Exception):
+     """No model could answer within the deadline or quota"""
+
+     def __init__(self, message, reason='error'):
+          super().__init__(message)
+          self.reason = reason
+
+def estimate_tokens(text):
+     """Local token estimate, corrected by the real usage once the reply arrives"""
+     return count_tokens(text) + 1
+
+def retry_after_seconds(error):
+     """Read Retry-After from a 429 response, defaulting to a short pause"""
+     try:
+          return float(error.response.headers.get('retry-after', 5))
+     except (AttributeError, TypeError, ValueError):
+          return 5.0
+
+def choose_models(email_content, context=None):
+     """Models to try for a mail, in order: the strong one first for long or involved questions"""
+     if STRONG_MODEL not in rate_limiters:
+          return [FAST_MODEL]
+
+     tokens = count_tokens(email_content) + count_tokens(context)
+     hints = len(_HARD_HINTS.findall(email_content)) + max(email_content.count('?') - 1, 0)
+     if tokens >= STRONG_MIN_TOKENS or hints >= 2:
+          return [STRONG_MODEL, FAST_MODEL]
+     return [FAST_MODEL]
+
+@metrics.timed('llm_request')
+def email_ai_response(email_content, context=None):
+     """Generate a reply within the shared RPM/TPM budget and REPLY_DEADLINE.
+
+     Each model is streamed with MODEL_TIMEOUT and STALL_TIMEOUT; when the
+     strong model is out of quota, rate limited past the deadline, slow or
+     failing, the fast one answers instead. Raises LLMUnavailable when none
+     can. `context` is a short summary of the earlier conversation for
+     follow-ups.
+     """
+     deadline = time.monotonic() + REPLY_DEADLINE
+     messages = _messages(email_content, context)
+     estimated = estimate_tokens(SYSTEM_PROMPT + (context or '') + email_content) + ESTIMATED_COMPLETION_TOKENS
+
+     error = None
+     for model in choose_models(email_content, context):
+          try:
+               return _generate(model, messages, estimated, deadline)
+          except LLMUnavailable as e:
+               _fell_back(model, e)
+               error = e
+     raise error
+
+async def email_ai_response_async(email_content, context=None):
+     """email_ai_response for the asyncio runtime: same tiers and limits, awaiting instead of blocking"""
+     start = time.perf_counter()
+     deadline = time.monotonic() + REPLY_DEADLINE
+     messages = _messages(email_content, context)
+     estimated = estimate_tokens(SYSTEM_PROMPT + (context or '') + email_content) + ESTIMATED_COMPLETION_TOKENS
+
+     try:
+          error = None
+          for model in choose_models(email_content, context):
+               try:
+                    return await _generate_async(model, messages, estimated, deadline)
+               except LLMUnavailable as e:
+                    _fell_back(model, e)
+                    error = e
+          raise error
+     except Exception:
+          metrics.inc('llm_request_errors_total')
+          raise
+     finally:
+          metrics.observe('llm_request_seconds', time.perf_counter() - start)
+
+def _client():
+     global client
+     with _client_lock:
+          if client is None:
+               from groq import Groq # type: ignore
+               # Retries are handled below so a 429 pauses every worker, not just the caller
+               client = Groq(api_key=GROQ_API_KEY, max_retries=0)
+     return client
+
+def _generate(model, messages, estimated, deadline):
+     """Stream one model's reply, waiting for its quota and retrying 429s while the deadline allows"""
+     from groq import RateLimitError # type: ignore
+     limiter = rate_limiters[model]
+
+     for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+          # Out of quota for longer than the deadline allows: let the next tier answer
+          wait = limiter.reserve(estimated)
+          while wait > 0:
+               if time.monotonic() + wait >= deadline:
+                    raise LLMUnavailable(f"{model} quota exhausted", reason='quota')
+               time.sleep(wait)
+               wait = limiter.reserve(estimated)
+
+          try:
+               return _stream_completion(model, messages, estimated, deadline)
+          except RateLimitError as e:
+               # Over quota: everyone waits, then this request tries again
+               metrics.inc('llm_rate_limited_total', model=model)
+               limiter.pause(retry_after_seconds(e))
+               if attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise LLMUnavailable(f"{model} rate limited", reason='rate_limited')
+
+async def _generate_async(model, messages, estimated, deadline):
+     from groq import RateLimitError # type: ignore
+     limiter = rate_limiters[model]
+
+     for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+          wait = limiter.reserve(estimated)
+          while wait > 0:
+               if time.monotonic() + wait >= deadline:
+                    raise LLMUnavailable(f"{model} quota exhausted", reason='quota')
+               await asyncio.sleep(wait)
+               wait = limiter.reserve(estimated)
+
+          try:
+               return await _stream_completion_async(model, messages, estimated, deadline)
+          except RateLimitError as e:
+               metrics.inc('llm_rate_limited_total', model=model)
+               limiter.pause(retry_after_seconds(e))
+               if attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise LLMUnavailable(f"{model} rate limited", reason='rate_limited')
+
+def _stream_completion(model, messages, estimated, deadline):
+     """Stream a completion, abandoning it past MODEL_TIMEOUT/the deadline or when it stalls"""
+     from groq import APIConnectionError, APIStatusError # type: ignore
+     start = time.perf_counter()
+     call_deadline = min(deadline, time.monotonic() + MODEL_TIMEOUT)
+     reply = _Reply(model, start)
+     try:
+          stream = _client().chat.completions.create(
+              messages=messages,
+
+              # The language model which will generate the completion.
+              model=model,
+              max_tokens=MAX_COMPLETION_TOKENS,
+              stream=True,
+
+              # Applies to every read, so a stalled stream fails fast too
+              timeout=min(STALL_TIMEOUT, max(call_deadline - time.monotonic(), 0.1))
+          )
+          try:
+               for chunk in stream:
+                    reply.add(chunk)
+                    if time.monotonic() > call_deadline:
+                         raise LLMUnavailable(f"{model} took longer than {MODEL_TIMEOUT}s", reason='timeout')
+          finally:
+               stream.close()
+     except (APIConnectionError, APIStatusError) as e:
+          # Timeouts, dropped connections, 5xx and an unknown model fall back;
+          # 429 is retried above and other 4xx (bad key, bad request) are errors
+          if isinstance(e, APIStatusError) and not _falls_back(e.status_code):
+               raise
+          raise reply.failed(e)
+     except LLMUnavailable as e:
+          raise reply.failed(e)
+
+     return reply.settle(estimated)
+
+async def _stream_completion_async(model, messages, estimated, deadline):
+     from groq import APIConnectionError, APIStatusError, AsyncGroq # type: ignore
+     global async_client
+     if async_client is None:
+          async_client = AsyncGroq(api_key=GROQ_API_KEY, max_retries=0)
+
+     start = time.perf_counter()
+     call_deadline = min(deadline, time.monotonic() + MODEL_TIMEOUT)
+     reply = _Reply(model, start)
+     try:
+          stream = await async_client.chat.completions.create(
+              messages=messages,
+              model=model,
+              max_tokens=MAX_COMPLETION_TOKENS,
+              stream=True,
+              timeout=min(STALL_TIMEOUT, max(call_deadline - time.monotonic(), 0.1))
+          )
+          try:
+               async for chunk in stream:
+                    reply.add(chunk)
+                    if time.monotonic() > call_deadline:
+                         raise LLMUnavailable(f"{model} took longer than {MODEL_TIMEOUT}s", reason='timeout')
+          finally:
+               await stream.close()
+     except (APIConnectionError, APIStatusError) as e:
+          if isinstance(e, APIStatusError) and not _falls_back(e.status_code):
+               raise
+          raise reply.failed(e)
+     except LLMUnavailable as e:
+          raise reply.failed(e)
+
+     return reply.settle(estimated)
+
+class _Reply:
+     """A streamed completion as it arrives, with its per-model metrics"""
+
+     def __init__(self, model, start):
+          self.model = model
+          self.start = start
+          self.parts = []
+          self.usage = None
+          self.finish_reason = None
+          self.first_token = False
+
+     def add(self, chunk):
+          if chunk.choices:
+               choice = chunk.choices[0]
+               if choice.delta and choice.delta.content:
+                    if not self.first_token:
+                         self.first_token = True
+                         metrics.observe('llm_first_token_seconds', time.perf_counter() - self.start, model=self.model)
+                    self.parts.append(choice.delta.content)
+               self.finish_reason = choice.finish_reason or self.finish_reason
+
+          # Groq reports usage on the last chunk, under x_groq
+          x_groq = getattr(chunk, 'x_groq', None)
+          self.usage = getattr(chunk, 'usage', None) or getattr(x_groq, 'usage', None) or self.usage
+
+     def failed(self, error):
+          """Record a failed attempt and return the LLMUnavailable to raise"""
+          metrics.observe('llm_model_seconds', time.perf_counter() - self.start, model=self.model)
+          if isinstance(error, LLMUnavailable):
+               return error
+          from groq import APITimeoutError # type: ignore
+          reason = 'timeout' if isinstance(error, APITimeoutError) else 'error'
+          return LLMUnavailable(f"{self.model}: {error}", reason=reason)
+
+     def settle(self, estimated):
+          """Correct the token budget with the real usage and return the reply text"""
+          metrics.observe('llm_model_seconds', time.perf_counter() - self.start, model=self.model)
+          if self.usage is not None:
+               rate_limiters[self.model].settle(estimated, self.usage.total_tokens)
+               metrics.inc('llm_tokens_total', self.usage.prompt_tokens, type='prompt', model=self.model)
+               metrics.inc('llm_tokens_total', self.usage.completion_tokens, type='completion', model=self.model)
+          if self.finish_reason == 'length':
+               # Cut at MAX_COMPLETION_TOKENS; still sent, but worth knowing about
+               metrics.inc('llm_truncated_total', model=self.model)
+
+          text = ''.join(self.parts)
+          if not text.strip():
+               raise LLMUnavailable(f"{self.model} returned an empty reply", reason='empty')
+          metrics.inc('llm_replies_total', model=self.model)
+          return text
+
+def _falls_back(status_code):
+     return status_code >= 500 or status_code in (404, 413)
+
+def _fell_back(model, error):
+     metrics.inc('llm_fallback_total', model=model, reason=error.reason)
+     print(f"LLM {model} unavailable ({error.reason}): {error}")
+
+def _messages(email_content, context=None):
+     messages = [
+         # Set an optional system message. This sets the behavior of the
+         # assistant and can be used to provide specific instructions for
+         # how it should behave throughout the conversation.
+         {
+             "role": "system",
+             "content": SYSTEM_PROMPT
+         }
+     ]
+
+     # Earlier questions and our answers in this thread, already summarised
+     if context:
+          messages.append({
+              "role": "system",
+              "content": f"Earlier in this conversation:\n{context}"
+          })
+
+     # Set a user message for the assistant to respond to.
+     messages.append({
+         "role": "user",
+         "content": email_content,
+     })
+     return messages
@@ -0,0 +1,445 @@
+import json
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from flask import Blueprint, Flask, Response, jsonify, request, stream_with_context
+import metrics
+from read_model import page
+
+# Fields a client may ask for with ?fields=
+MAIL_FIELDS = {"id", "message_id", "subject", "from", "date", "body", "received_at", "account", "in_reply_to", "references"}
+RESPONSE_FIELDS = {"id", "message_id", "original_subject", "original_from", "responded_at", "response"}
+
+# Most results one /search or /archive request returns
+MAX_SEARCH_RESULTS = 100
+
+# Most changes per /changes response or /events batch
+MAX_CHANGES = 500
+
+# Longest a /changes request waits for a change (?timeout=, seconds)
+LONG_POLL_TIMEOUT = 25
+LONG_POLL_MAX = 60
+
+# Seconds between keepalive comments on an idle /events stream, and the
+# reconnect delay sent to EventSource clients (milliseconds)
+EVENTS_KEEPALIVE = 15
+EVENTS_RETRY_MS = 3000
+
+# /events streams and waiting /changes requests open at once; each holds a
+# server thread, so past this they get a 503 and other requests keep theirs
+MAX_WAITING = 32
+
+ENDPOINTS = {
+    "/all": "GET - Get all emails (query params: ?limit=10&after=<id>&fields=subject,from&format=ndjson)",
+    "/unread": "GET - Get unread emails (same query params as /all)",
+    "/responded": "GET - Get responded emails (same query params as /all)",
+    "/receive": "GET - Receive emails (query param: ?type=unread|all|responded, plus /all params)",
+    "/search": "GET - Full-text search over mail and replies (query params: ?q=words \"a phrase\" prefix*&from=&account=&status=&since=YYYY-MM-DD&until=YYYY-MM-DD&limit=20&offset=0)",
+    "/archive": "GET - Archived mail (query params: ?message_id=<id> for one mail, ?segments=1 for segment sizes, or ?from=&account=&since=YYYY-MM-DD&until=YYYY-MM-DD&limit=50&after=<id>)",
+    "/changes": "GET - Long-poll for new mail, sent replies and archiving after a sequence number (query params: ?since=<seq>&limit=100&timeout=25; without since, returns the current seq)",
+    "/events": "GET - Server-sent events: new_mail, reply_sent, archived and stats (count deltas) as they happen (resume with Last-Event-ID or ?since=<seq>)",
+    "/stats": "GET - Get email statistics",
+    "/metrics": "GET - Prometheus metrics (latency histograms, token usage, queue depth)"
+}
+
+
+def _not_modified(version, updated_at):
+    """Return a 304 if the client's ETag/Last-Modified still matches, else None.
+
+    Also stashes the validators on the request for _with_validators.
+    """
+    etag = f'W/"{version}"'
+    request.mailllm_validators = (etag, updated_at)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            return _with_validators(Response(status=304))
+        return None
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since and updated_at:
+        try:
+            if updated_at <= parsedate_to_datetime(if_modified_since).timestamp():
+                return _with_validators(Response(status=304))
+        except (TypeError, ValueError):
+            pass
+
+    return None
+
+
+def _with_validators(response):
+    etag, updated_at = request.mailllm_validators
+    response.headers['ETag'] = etag
+    # HTTP dates have whole seconds: round up, and only send one once that
+    # second is over, so no later write can fall within it
+    if updated_at and math.ceil(updated_at) <= time.time():
+        response.headers['Last-Modified'] = formatdate(math.ceil(updated_at), usegmt=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _date_param(name):
+    """Read a YYYY-MM-DD (UTC) or Unix timestamp query parameter"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid {name}: use YYYY-MM-DD or a Unix timestamp")
+
+
+def _page_params(allowed_fields):
+    """Read limit/after/fields/format from the query string"""
+    # ?num= is the original name for ?limit=
+    limit = request.args.get('limit', default=None, type=int)
+    if limit is None:
+        limit = request.args.get('num', default=None, type=int)
+    after = request.args.get('after', default=None, type=int)
+
+    fields = request.args.get('fields')
+    if fields:
+        fields = {field.strip() for field in fields.split(',') if field.strip()}
+        unknown = fields - allowed_fields
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        # The id is the pagination cursor, always include it
+        fields.add("id")
+
+    ndjson = request.args.get('format') == 'ndjson' or \
+        'application/x-ndjson' in request.headers.get('Accept', '')
+
+    return limit, after, fields, ndjson
+
+
+def _stream(mail_type, rows, fields, ndjson):
+    """Stream rows as one JSON document or as NDJSON, never holding the full list"""
+
+    def project(row):
+        if fields:
+            return {key: value for key, value in row.items() if key in fields}
+        return row
+
+    def generate_ndjson():
+        for row in rows:
+            yield json.dumps(project(row), ensure_ascii=False) + '\n'
+
+    def generate_json():
+        yield f'{{"success": true, "type": {json.dumps(mail_type)}, "emails": ['
+        count = 0
+        last_id = None
+        for row in rows:
+            if count:
+                yield ', '
+            yield json.dumps(project(row), ensure_ascii=False)
+            count += 1
+            last_id = row["id"]
+        yield f'], "count": {count}, "next_after": {json.dumps(last_id)}}}'
+
+    if ndjson:
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
+
+def _event(seq, name, data):
+    """One server-sent event"""
+    return f'id: {seq}\nevent: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def _busy():
+    response = jsonify({"error": "Too many open change feeds, retry shortly"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+def create_api(store, read_model=None, archive=None, changes=None):
+    """Blueprint with the read-only mail endpoints.
+
+    With a ReadModel, validators, stats and any page inside its window are
+    served from memory; deeper pages stream from the MailStore. With an
+    Archive, /archive looks up mail that compaction moved out of the store.
+    With a ChangeFeed, /changes and /events push the store's change log.
+    """
+    api = Blueprint('api', __name__)
+    waiting = threading.BoundedSemaphore(MAX_WAITING)
+
+    def check_validators():
+        snapshot = read_model.snapshot() if read_model else None
+        if snapshot:
+            return snapshot, _not_modified(snapshot.version, snapshot.updated_at)
+        return None, _not_modified(*store.version())
+
+    def list_endpoint(mail_type):
+        snapshot, not_modified = check_validators()
+        if not_modified:
+            return not_modified
+
+        allowed = RESPONSE_FIELDS if mail_type == 'responded' else MAIL_FIELDS
+        limit, after, fields, ndjson = _page_params(allowed)
+
+        rows = page(snapshot, mail_type, after=after, limit=limit) if snapshot else None
+        if rows is None:
+            if mail_type == 'responded':
+                rows = store.iter_responses(after=after, limit=limit)
+            else:
+                status = 'unread' if mail_type == 'unread' else None
+                rows = store.iter_mails(status=status, after=after, limit=limit)
+
+        return _with_validators(_stream(mail_type, rows, fields, ndjson))
+
+    @api.route('/all', methods=['GET'])
+    def get_all_emails():
+        """API endpoint to get all emails"""
+        try:
+            return list_endpoint('all')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/unread', methods=['GET'])
+    def get_unread_emails():
+        """API endpoint to get unread emails"""
+        try:
+            return list_endpoint('unread')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/responded', methods=['GET'])
+    def get_responded_emails():
+        """API endpoint to get responded emails"""
+        try:
+            return list_endpoint('responded')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/receive', methods=['GET'])
+    def receive_emails():
+        """API endpoint to receive emails from the mail store"""
+        try:
+            # Get type parameter (default: 'unread')
+            mail_type = request.args.get('type', default='unread', type=str)
+
+            if mail_type not in ('all', 'unread', 'responded'):
+                return jsonify({"error": "Invalid type. Use 'all', 'unread', or 'responded'"}), 400
+
+            return list_endpoint(mail_type)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/search', methods=['GET'])
+    def search_emails():
+        """API endpoint to search mail and replies, best match first"""
+        try:
+            status = request.args.get('status')
+            if status not in (None, 'unread', 'responded'):
+                return jsonify({"error": "Invalid status. Use 'unread' or 'responded'"}), 400
+
+            limit = min(max(request.args.get('limit', default=20, type=int), 1), MAX_SEARCH_RESULTS)
+            offset = max(request.args.get('offset', default=0, type=int), 0)
+            results = store.search(
+                request.args.get('q', ''),
+                sender=request.args.get('from'),
+                account=request.args.get('account'),
+                status=status,
+                since=_date_param('since'),
+                until=_date_param('until'),
+                limit=limit,
+                offset=offset
+            )
+            if request.args.get('body') != '1':
+                # Snippets are usually enough; whole bodies on request
+                for result in results:
+                    result.pop('body', None)
+
+            return jsonify({
+                "success": True,
+                "query": request.args.get('q', ''),
+                "results": results,
+                "count": len(results),
+                "next_offset": offset + len(results) if len(results) == limit else None
+            })
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/archive', methods=['GET'])
+    def get_archived_emails():
+        """API endpoint to look up archived mail"""
+        try:
+            if archive is None:
+                return jsonify({"error": "Archive not configured"}), 404
+
+            message_id = request.args.get('message_id')
+            if message_id:
+                mail = archive.get(message_id)
+                if mail is None:
+                    return jsonify({"error": "Not found in the archive"}), 404
+                return jsonify({"success": True, "mail": mail})
+
+            if request.args.get('segments') == '1':
+                return jsonify({"success": True, "segments": archive.stats()})
+
+            limit = min(max(request.args.get('limit', default=50, type=int), 1), MAX_SEARCH_RESULTS)
+            results = archive.find(
+                sender=request.args.get('from'),
+                account=request.args.get('account'),
+                since=_date_param('since'),
+                until=_date_param('until'),
+                limit=limit,
+                after=request.args.get('after', type=int)
+            )
+            return jsonify({
+                "success": True,
+                "results": results,
+                "count": len(results),
+                "next_after": results[-1]["id"] if len(results) == limit else None
+            })
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/changes', methods=['GET'])
+    def get_changes():
+        """API endpoint to long-poll the change log"""
+        try:
+            if changes is None:
+                return jsonify({"error": "Change feed not configured"}), 404
+
+            since = request.args.get('since', type=int)
+            if since is None:
+                # Start here: load /stats and the lists, then follow from this seq
+                return jsonify({"success": True, "changes": [], "count": 0, "last_seq": store.last_change(), "reset": False})
+
+            limit = min(max(request.args.get('limit', default=100, type=int), 1), MAX_CHANGES)
+            timeout = min(max(request.args.get('timeout', default=LONG_POLL_TIMEOUT, type=float), 0), LONG_POLL_MAX)
+
+            rows, reset = store.changes(since, limit)
+            if not rows and not reset and timeout and not changes.closed:
+                if not waiting.acquire(blocking=False):
+                    return _busy()
+                try:
+                    changes.wait(since, timeout)
+                finally:
+                    waiting.release()
+                rows, reset = store.changes(since, limit)
+
+            if reset:
+                # Too far behind (or another database): reload, then follow from last_seq
+                return jsonify({"success": True, "changes": [], "count": 0, "last_seq": store.last_change(), "reset": True})
+
+            response = jsonify({
+                "success": True,
+                "changes": rows,
+                "count": len(rows),
+                "last_seq": rows[-1]["seq"] if rows else since,
+                "reset": False
+            })
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/events', methods=['GET'])
+    def get_events():
+        """API endpoint streaming the change log as server-sent events"""
+        if changes is None:
+            return jsonify({"error": "Change feed not configured"}), 404
+
+        # EventSource resends the last id it saw when it reconnects
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = request.args.get('since', type=int)
+        if since is None:
+            since = store.last_change()
+
+        if changes.closed or not waiting.acquire(blocking=False):
+            return _busy()
+
+        def generate(since):
+            try:
+                yield f'retry: {EVENTS_RETRY_MS}\n\n'
+                yield from follow(since)
+            finally:
+                waiting.release()
+
+        def follow(since):
+            while not changes.closed:
+                rows, reset = store.changes(since, MAX_CHANGES)
+                if reset:
+                    since = store.last_change()
+                    yield _event(since, 'reset', {"seq": since})
+                    continue
+
+                if rows:
+                    delta = {}
+                    for row in rows:
+                        yield _event(row["seq"], row["type"], row)
+                        for key, value in row["stats"].items():
+                            delta[key] = delta.get(key, 0) + value
+                    since = rows[-1]["seq"]
+                    # One stats event per batch with the net change in /stats counts
+                    delta = {key: value for key, value in delta.items() if value}
+                    if delta:
+                        yield _event(since, 'stats', {"seq": since, "delta": delta})
+                    continue
+
+                if changes.wait(since, EVENTS_KEEPALIVE) <= since:
+                    # Keeps proxies from closing the stream and notices gone clients
+                    yield ': keepalive\n\n'
+
+        response = Response(stream_with_context(generate(since)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    @api.route('/stats', methods=['GET'])
+    def get_stats():
+        """API endpoint to get email statistics"""
+        try:
+            snapshot, not_modified = check_validators()
+            if not_modified:
+                return not_modified
+
+            return _with_validators(jsonify({
+                "success": True,
+                "stats": snapshot.counts if snapshot else store.counts()
+            }))
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @api.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """Prometheus scrape endpoint"""
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return api
+
+
+def create_app(store, read_model=None, archive=None, changes=None, **home):
+    """Flask app with the mail endpoints, and `home` plus the endpoint list at /"""
+    app = Flask(__name__)
+    app.register_blueprint(create_api(store, read_model, archive, changes))
+
+    @app.route('/', methods=['GET'])
+    def index():
+        """Home endpoint"""
+        return jsonify(dict(home, endpoints=ENDPOINTS))
+
+    return app
@@ -0,0 +1,277 @@
+import gzip
+import json
+import os
+import re
+import time
+import zlib
+from datetime import datetime, timezone
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows; compaction is still one process at a time (see compact)
+    fcntl = None
+
+# Compressed monthly segments of archived mail
+ARCHIVE_DIR = './logs/archive'
+
+# Settled mail older than this many days leaves the primary store (0 = never)
+ARCHIVE_AFTER_DAYS = 90
+
+# Segments older than this many months are deleted (0 = keep forever)
+ARCHIVE_KEEP_MONTHS = 0
+
+# Mails moved per compaction batch; each batch is one gzip member per month
+ARCHIVE_BATCH = 1000
+
+ARCHIVE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archive_index (
+    message_id     TEXT PRIMARY KEY,
+    segment        TEXT NOT NULL,
+    member_offset  INTEGER NOT NULL,
+    sender         TEXT,
+    subject        TEXT,
+    date_ts        REAL,
+    account        TEXT,
+    archived_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archive_segment ON archive_index(segment);
+CREATE INDEX IF NOT EXISTS archive_date ON archive_index(date_ts);
+CREATE INDEX IF NOT EXISTS archive_sender ON archive_index(sender);
+'''
+
+_SEGMENT = re.compile(r'^mail-(\d{4})-(\d{2})\.ndjson\.gz$')
+
+
+def segment_name(timestamp):
+    """Segment file for mail that arrived at `timestamp` (UTC month)"""
+    return datetime.fromtimestamp(timestamp or 0, tz=timezone.utc).strftime('mail-%Y-%m.ndjson.gz')
+
+
+def _month_index(year, month):
+    return year * 12 + month - 1
+
+
+class Archive:
+    """Append-only, compressed history of settled mail.
+
+    compact() moves mail that was answered (or dead-lettered) more than
+    `after_days` ago out of the primary store into gzip NDJSON segments,
+    one file per arrival month. Every batch is appended as its own gzip
+    member, so files are never rewritten, yet a plain `zcat` still reads
+    them. The archive_index table (in the mail database) maps each
+    Message-ID to its segment and member offset, so get() decompresses only
+    that member, and find() filters on sender/date without touching the
+    files. expire() drops whole segments past `keep_months`.
+
+    Every process running the process role calls these, so both take the
+    store's 'archive' task lease first and return 0 if another process
+    holds it.
+    """
+
+    def __init__(self, store, directory=ARCHIVE_DIR, after_days=ARCHIVE_AFTER_DAYS,
+                 keep_months=ARCHIVE_KEEP_MONTHS, batch=ARCHIVE_BATCH):
+        self.store = store
+        self.directory = directory
+        self.after_days = after_days
+        self.keep_months = keep_months
+        self.batch = batch
+        self.ready = False
+
+    def _conn(self):
+        conn = self.store.connection()
+        if not self.ready:
+            conn.executescript(ARCHIVE_SCHEMA)
+            self.ready = True
+        return conn
+
+    # Compaction
+
+    @metrics.timed('archive_compact')
+    def compact(self, now=None):
+        """Move settled mail older than the retention window into segments; returns how many"""
+        if not self.after_days:
+            return 0
+
+        if not self.store.claim_task('archive'):
+            return 0
+        try:
+            return self._compact((now or time.time()) - self.after_days * 24 * 3600)
+        finally:
+            self.store.release_task('archive')
+
+    def _compact(self, cutoff):
+        conn = self._conn()
+        os.makedirs(self.directory, exist_ok=True)
+        archived = 0
+
+        while True:
+            records = self.store.archive_candidates(cutoff, limit=self.batch)
+            if not records:
+                break
+
+            by_segment = {}
+            for record in records:
+                by_segment.setdefault(segment_name(record.get('received_at') or record.get('fetched_at')), []).append(record)
+
+            # Data first, then the index, then delete: a crash in between
+            # only means the batch is archived again (the index keeps the last copy)
+            archived_at = time.time()
+            rows = []
+            for segment, segment_records in by_segment.items():
+                offset = self._append(segment, segment_records)
+                rows.extend(
+                    (record['message_id'], segment, offset, record.get('from'), record.get('subject'),
+                     record.get('date_ts'), record.get('account'), archived_at)
+                    for record in segment_records
+                )
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO archive_index '
+                    '(message_id, segment, member_offset, sender, subject, date_ts, account, archived_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+            self.store.delete_mails([record['message_id'] for record in records])
+
+            archived += len(records)
+            metrics.inc('archived_mails_total', len(records))
+            # Stop if the lease lapsed (a stalled run) and another process took over
+            if len(records) < self.batch or not self.store.claim_task('archive'):
+                break
+
+        return archived
+
+    def _append(self, segment, records):
+        """Append records to a segment as one gzip member and return its offset"""
+        payload = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        data = gzip.compress(payload.encode('utf-8'))
+
+        path = os.path.join(self.directory, segment)
+        with open(path, 'ab') as f:
+            if fcntl is not None:
+                # The offset must be where this write lands; released on close
+                fcntl.flock(f, fcntl.LOCK_EX)
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return offset
+
+    def expire(self, now=None):
+        """Delete segments older than `keep_months`; returns how many were removed"""
+        if not self.keep_months:
+            return 0
+        if not self.store.claim_task('archive'):
+            return 0
+        try:
+            return self._expire(now)
+        finally:
+            self.store.release_task('archive')
+
+    def _expire(self, now):
+        today = datetime.fromtimestamp(now or time.time(), tz=timezone.utc)
+        oldest = _month_index(today.year, today.month) - self.keep_months
+        conn = self._conn()
+        removed = 0
+
+        for segment in self.segments():
+            year, month = map(int, _SEGMENT.match(segment).groups())
+            if _month_index(year, month) >= oldest:
+                continue
+            # Index rows first, so a lookup never points at a missing file
+            with conn:
+                conn.execute('DELETE FROM archive_index WHERE segment = ?', (segment,))
+            os.remove(os.path.join(self.directory, segment))
+            removed += 1
+
+        return removed
+
+    # Lookups
+
+    def segments(self):
+        """Segment file names, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if _SEGMENT.match(name))
+
+    def get(self, message_id):
+        """Return the archived record for a Message-ID, or None"""
+        row = self._conn().execute(
+            'SELECT segment, member_offset FROM archive_index WHERE message_id = ?', (message_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        for line in self._read_member(row['segment'], row['member_offset']):
+            record = json.loads(line)
+            if record.get('message_id') == message_id:
+                return record
+        return None
+
+    def find(self, sender=None, account=None, since=None, until=None, limit=50, after=None):
+        """Index entries (no bodies) newest first, filtered by sender substring, account and date"""
+        query = 'SELECT rowid, * FROM archive_index'
+        where = []
+        params = []
+        if sender:
+            where.append('sender LIKE ?')
+            params.append(f'%{sender}%')
+        if account:
+            where.append('account = ?')
+            params.append(account)
+        if since is not None:
+            where.append('date_ts >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('date_ts < ?')
+            params.append(until)
+        if after:
+            where.append('rowid < ?')
+            params.append(after)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY rowid DESC LIMIT ?'
+        params.append(limit)
+
+        return [
+            {
+                "id": row["rowid"],
+                "message_id": row["message_id"],
+                "subject": row["subject"],
+                "from": row["sender"],
+                "date_ts": row["date_ts"],
+                "account": row["account"],
+                "segment": row["segment"],
+                "archived_at": row["archived_at"]
+            }
+            for row in self._conn().execute(query, params)
+        ]
+
+    def stats(self):
+        """Per-segment size on disk and record count"""
+        counts = dict(self._conn().execute('SELECT segment, COUNT(*) FROM archive_index GROUP BY segment').fetchall())
+        return [
+            {
+                "segment": segment,
+                "bytes": os.path.getsize(os.path.join(self.directory, segment)),
+                "mails": counts.get(segment, 0)
+            }
+            for segment in self.segments()
+        ]
+
+    def _read_member(self, segment, offset):
+        """Decompress the single gzip member at `offset` and return its lines"""
+        decompressor = zlib.decompressobj(wbits=31)
+        chunks = []
+        with open(os.path.join(self.directory, segment), 'rb') as f:
+            f.seek(offset)
+            while not decompressor.eof:
+                data = f.read(64 * 1024)
+                if not data:
+                    break
+                chunks.append(decompressor.decompress(data))
+        return b''.join(chunks).decode('utf-8').splitlines()
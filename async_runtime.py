@@ -0,0 +1,364 @@
+import asyncio
+import contextlib
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from ai_service import LLMUnavailable, email_ai_response_async
+from imap_session import ImapSession
+from worker_pool import AsyncWorkerPool
+
+# Optional: serve the API from the event loop (falls back to the Flask server thread)
+try:
+    import uvicorn # type: ignore
+    from asgiref.sync import sync_to_async # type: ignore
+    from asgiref.wsgi import WsgiToAsgiInstance # type: ignore
+except ImportError:
+    uvicorn = None
+
+# Replies handled at once; a reply waiting on the LLM or SMTP costs a task, not a thread
+ASYNC_REPLY_WORKERS = 32
+
+# Seconds in-flight replies get to finish on shutdown before they are cut off
+SHUTDOWN_GRACE = 30
+
+# Threads serving API requests at once; an open /events stream or a waiting
+# /changes request holds one (api.MAX_WAITING caps those)
+API_THREADS = 64
+
+
+def in_daemon_thread(func, *args):
+    """Run a blocking call on its own daemon thread and return an awaitable for the result.
+
+    Used for imaplib, which has no async API. A session parked in IDLE can't
+    be interrupted, and unlike the default executor's threads a daemon
+    thread doesn't hold up interpreter exit while it waits.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        result, error = None, None
+        try:
+            result = func(*args)
+        except Exception as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            # The loop has already shut down
+            pass
+
+    threading.Thread(target=target, name=getattr(func, '__name__', 'blocking'), daemon=True).start()
+    return future
+
+
+class AsyncRuntime:
+    """Fetch, reply and API stages of MailLLM on one asyncio event loop.
+
+    The stages talk through in-memory channels: fetchers set an event when
+    mail lands, the outbox is fed into a ReplyScheduler that turns mail
+    away when full (backpressure; the rest waits in the outbox), and reply
+    tasks await the LLM through AsyncGroq and SMTP through the pooled
+    senders. imaplib stays blocking and runs on daemon threads; SQLite
+    calls, the response cache and prompt building run on the default
+    executor, so a lock wait on the database (another process writing)
+    never stalls the loop. On SIGINT
+    or SIGTERM fetching stops, replies under way get SHUTDOWN_GRACE seconds
+    to finish, then the API server closes.
+
+    `core` is the index module, whose store, helpers and settings are
+    shared with the threaded runtime. It is passed in so running index.py
+    as a script doesn't import it a second time. `roles` picks the stages
+    this process runs (see index.ROLES).
+    """
+
+    def __init__(self, core, workers=ASYNC_REPLY_WORKERS, roles=None, api_threads=API_THREADS):
+        self.core = core
+        self.workers = workers
+        self.api_threads = api_threads
+        self.roles = set(core.ROLES if roles is None else roles)
+        self.stopping = None
+        self.new_mail = None
+        self.pool = None
+        self.api = None
+
+    def stop(self):
+        """Begin a graceful shutdown"""
+        if not self.stopping.is_set():
+            print("\nStopping...")
+            self.stopping.set()
+
+    async def run(self):
+        core = self.core
+        self.stopping = asyncio.Event()
+        self.new_mail = asyncio.Event()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Not the main thread, or no signal support on this platform
+                pass
+
+        producers = []
+        if 'fetch' in self.roles:
+            producers.extend(
+                asyncio.create_task(self.fetch_loop(account, folder), name=f"fetch-{account.name}-{folder}")
+                for account in core.ACCOUNTS for folder in account.folders
+            )
+        if 'process' in self.roles:
+            self.pool = AsyncWorkerPool(self.reply, core.reply_scheduler(self.new_mail), workers=self.workers, name="reply")
+            self.pool.start()
+            metrics.gauge('reply_queue_depth', self.pool.depth)
+            producers.append(asyncio.create_task(self.feed_loop(), name="feed"))
+            producers.append(asyncio.create_task(self.archive_loop(), name="archive"))
+            producers.append(asyncio.create_task(self.lease_loop(), name="leases"))
+            if 'fetch' not in self.roles:
+                producers.append(asyncio.create_task(self.watch_loop(), name="mail-watch"))
+        api = asyncio.create_task(self.api_server(), name="api") if 'api' in self.roles else None
+
+        await self.stopping.wait()
+
+        # Stop taking in mail, let the replies under way finish, then close the API
+        for task in producers:
+            task.cancel()
+        await asyncio.gather(*producers, return_exceptions=True)
+
+        cut_off = await self.pool.drain(SHUTDOWN_GRACE) if self.pool is not None else 0
+        if cut_off:
+            print(f"{cut_off} replies were cut off; they resume from the outbox")
+            await asyncio.to_thread(core.store.release_leases)
+        if self.pool is not None:
+            await asyncio.to_thread(core.close_smtp)
+
+        # End open /events streams and /changes polls so the server can close
+        core.change_feed.close()
+        if self.api is not None:
+            self.api.should_exit = True
+        if api is not None:
+            await asyncio.gather(api, return_exceptions=True)
+
+    async def fetch_loop(self, account, folder):
+        """Fetch stage for one account and folder: store new mail, then wait in IDLE"""
+        core = self.core
+        session = ImapSession(lambda: core.connect_to_gmail(account), folder=folder)
+
+        while True:
+            try:
+                if await in_daemon_thread(core.fetch_new_mail, session, account, folder):
+                    self.new_mail.set()
+                await in_daemon_thread(session.wait_for_changes)
+            except Exception as e:
+                print(f"ERROR [FETCH {account.name}/{folder}]: {e}")
+                session.reset()
+                await asyncio.sleep(5)
+
+    async def feed_loop(self):
+        """Process stage: offer due outbox entries to the reply pool whenever mail lands or a retry is due"""
+        core = self.core
+
+        while True:
+            try:
+                # Clear before reading so a signal raised mid-cycle isn't lost
+                self.new_mail.clear()
+                for mail in await asyncio.to_thread(core.due_mail):
+                    self.pool.submit(mail.get('message_id'), mail, group=mail.get('account'))
+
+                wait = await asyncio.to_thread(core.next_check_in)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.new_mail.wait(), wait)
+            except Exception as e:
+                print(f"ERROR [PROCESS]: {e}")
+                await asyncio.sleep(30)
+
+    async def watch_loop(self):
+        """Wake the process stage when a fetch role in another process stores mail"""
+        core = self.core
+        last = await asyncio.to_thread(core.store.version)
+
+        while True:
+            await asyncio.sleep(core.MAIL_WATCH_INTERVAL)
+            try:
+                current = await asyncio.to_thread(core.store.version)
+                if current != last:
+                    last = current
+                    self.new_mail.set()
+            except Exception as e:
+                print(f"ERROR [MAIL WATCH]: {e}")
+
+    async def lease_loop(self):
+        """Renew this process's outbox leases and reclaim expired ones, off the loop"""
+        core = self.core
+
+        while True:
+            await asyncio.sleep(core.store.lease_seconds / 3)
+            await in_daemon_thread(core.maintain_leases)
+
+    async def archive_loop(self):
+        """Compact the mail database every ARCHIVE_INTERVAL seconds, off the loop"""
+        core = self.core
+
+        while True:
+            await in_daemon_thread(core.run_compaction)
+            await asyncio.sleep(core.ARCHIVE_INTERVAL)
+
+    async def reply(self, mail):
+        """index.reply_to_email on the event loop: the same outbox steps, awaiting the LLM and SMTP"""
+        core = self.core
+        store = core.store
+        message_id = mail.get('message_id')
+
+        target = await asyncio.to_thread(core.reply_target, mail)
+        if target is None:
+            return
+        account, to_email = target
+
+        ai_response = mail.get('draft')
+        if mail.get('state') == 'received':
+            # Claim generation; another worker or process may already own it
+            if not await asyncio.to_thread(store.transition, message_id, 'received', 'generating'):
+                return
+            try:
+                ai_response = await self.generate(mail)
+            except Exception as e:
+                await asyncio.to_thread(core.reply_failed, mail, e)
+                return
+
+            # Save the draft before sending so a retry never pays for it again
+            if not await asyncio.to_thread(store.transition, message_id, 'generating', 'generated', ai_response):
+                return
+
+        # Claim the send; the row stays 'sending' until SMTP accepts it
+        if not await asyncio.to_thread(store.transition, message_id, 'generated', 'sending'):
+            return
+
+        if await self.send(account, to_email, mail, ai_response):
+            await asyncio.to_thread(core.reply_sent, mail, account, ai_response)
+        else:
+            await asyncio.to_thread(core.reply_failed, mail, "SMTP send failed")
+
+    async def generate(self, mail):
+        """Ask the cache or the LLM for a reply to one mail"""
+        # The thread lookup, cache similarity check and the body itself are blocking work
+        cached, email_content, context = await asyncio.to_thread(self.core.prepare_reply, mail)
+        if cached:
+            return cached
+
+        try:
+            ai_response = await email_ai_response_async(email_content, context=context or None)
+        except LLMUnavailable as e:
+            return self.core.canned_reply(mail, e)
+        await asyncio.to_thread(self.core.cache_reply, mail, context, ai_response)
+        return ai_response
+
+    async def send(self, account, to_email, mail, body):
+        """Queue the reply on the account's SMTP senders and await the result"""
+        core = self.core
+        start = time.perf_counter()
+        try:
+            msg = core.compose_email(account, to_email=to_email, body=body, **core.reply_headers(mail, account))
+            future = asyncio.wrap_future(core.outbound_for(account).submit(msg))
+            # Shielded: a send already handed to SMTP can't be taken back
+            return await asyncio.shield(future)
+        except Exception as e:
+            metrics.inc('smtp_send_errors_total')
+            print(f"ERROR sending email: {e}")
+            return False
+        finally:
+            metrics.observe('smtp_send_seconds', time.perf_counter() - start)
+
+    async def api_server(self):
+        """Serve the Flask API from this loop through uvicorn"""
+        core = self.core
+        if uvicorn is None:
+            print("uvicorn/asgiref not installed, serving the API with the Flask server on a thread")
+            threading.Thread(target=core.flask_server_thread, daemon=True).start()
+            return
+
+        executor = ThreadPoolExecutor(self.api_threads, thread_name_prefix="api")
+        app = _ThreadedWsgi(core.setup_api(), executor)
+        config = uvicorn.Config(app, host='0.0.0.0', port=core.API_PORT, log_level='warning', lifespan='off')
+        self.api = _ApiServer(config)
+        try:
+            await self.api.serve()
+        finally:
+            executor.shutdown(wait=False)
+
+
+
+if uvicorn is not None:
+    class _ApiServer(uvicorn.Server):
+        """uvicorn server that leaves signals to the runtime, which stops it last"""
+
+        def install_signal_handlers(self):
+            pass
+
+        @contextlib.contextmanager
+        def capture_signals(self):
+            yield
+
+    class _ThreadedWsgi:
+        """ASGI app running a WSGI app with each request on a thread of `executor`.
+
+        asgiref's WsgiToAsgi runs every request on one shared thread, so a
+        single /events stream or /changes long-poll would hold up all the
+        others. A client that hangs up is noticed at its next write (the
+        stream's keepalive at the latest), which ends the request.
+        """
+
+        def __init__(self, wsgi_application, executor):
+            self.wsgi_application = wsgi_application
+            self.executor = executor
+
+        async def __call__(self, scope, receive, send):
+            gone = asyncio.Event()
+            watcher = None
+
+            async def watch():
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+                gone.set()
+
+            async def receive_request():
+                nonlocal watcher
+                message = await receive()
+                if message["type"] == "http.request" and not message.get("more_body"):
+                    # Body read; from here on receive() only reports a disconnect
+                    watcher = asyncio.create_task(watch())
+                return message
+
+            async def send_response(message):
+                if gone.is_set():
+                    raise ConnectionResetError("client disconnected")
+                await send(message)
+
+            instance = _WsgiRequest(self.wsgi_application)
+            instance.executor = self.executor
+            try:
+                await instance(scope, receive_request, send_response)
+            except ConnectionResetError:
+                if not gone.is_set():
+                    raise
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+
+    class _WsgiRequest(WsgiToAsgiInstance):
+        """One request of _ThreadedWsgi"""
+
+        executor = None
+
+        async def run_wsgi_app(self, body):
+            run = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func
+            await sync_to_async(run, thread_sensitive=False, executor=self.executor)(self, body)
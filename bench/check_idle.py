@@ -0,0 +1,50 @@
+# Regression check for IMAP IDLE: a server may send the continuation and the
+# new mail's EXISTS in one TCP segment. imaplib then buffers the EXISTS line
+# while reading "+ idling", where select() on the socket never sees it, and
+# the session would sit out the whole keepalive instead of waking up.
+#
+#   python bench/check_idle.py
+import imaplib
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fake_imap
+from imap_session import ImapSession
+from synthetic import make_message
+
+KEEPALIVE = 10
+
+
+def main():
+    mailbox = fake_imap.Mailbox(seed=3, attachment_size=0)
+    server = fake_imap.serve(mailbox)
+
+    def connect():
+        imap = imaplib.IMAP4('127.0.0.1', server.server_address[1])
+        imap.login('bench', 'bench')
+        return imap
+
+    session = ImapSession(connect, keepalive=KEEPALIVE)
+    session.ensure()
+    # Arrives after SELECT, so the fake server reports it together with "+ idling"
+    mailbox.append(make_message(4, subject="Coalesced"))
+
+    start = time.monotonic()
+    changed = session.wait_for_changes()
+    elapsed = time.monotonic() - start
+    session.close()
+    server.shutdown()
+
+    print(f"IDLE woke after {elapsed:.2f}s (changed={changed})")
+    if not changed or elapsed > KEEPALIVE / 2:
+        print("FAIL: the EXISTS sent with the IDLE continuation was missed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Regression check for the API's Last-Modified validator: two writes within
+# one second. HTTP dates have whole seconds, so a client holding the first
+# write's Last-Modified must still get the second write, not a 304.
+#
+#   python bench/check_last_modified.py
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from api import create_app
+from read_model import ReadModel
+from storage import MailStore
+
+
+def _mail(i):
+    return {"message_id": f"<check-{i}@bench>", "subject": f"Check {i}", "sender": "bench@example.com",
+            "body": "hello", "date": ""}
+
+
+def main():
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        store = MailStore(os.path.join(tmp, 'check.db'))
+        read_model = ReadModel(store).attach()
+        client = create_app(store, read_model).test_client()
+
+        # Start just after a second boundary so both writes share a second
+        time.sleep(1.05 - time.time() % 1)
+        store.add_mails([_mail(1)])
+        first = client.get('/stats')
+        last_modified = first.headers.get('Last-Modified')
+        store.add_mails([_mail(2)])
+
+        headers = {'If-Modified-Since': last_modified} if last_modified else {}
+        second = client.get('/stats', headers=headers)
+        if second.status_code != 200 or second.get_json()["stats"]["total_emails"] != 2:
+            failures.append(f"second write in the same second answered {second.status_code} "
+                            f"to If-Modified-Since: {last_modified}")
+
+        # Once the second is over the date validates again
+        time.sleep(1.1)
+        third = client.get('/stats')
+        last_modified = third.headers.get('Last-Modified')
+        if not last_modified:
+            failures.append("no Last-Modified once the write's second was over")
+        elif client.get('/stats', headers={'If-Modified-Since': last_modified}).status_code != 304:
+            failures.append(f"unchanged data not answered 304 to If-Modified-Since: {last_modified}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("Last-Modified OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+# Minimal IMAP4rev1 server over plain TCP for benchmarks.
+#
+# Implements just what MailLLM and the benchmark injector use: CAPABILITY,
+# LOGIN, SELECT/EXAMINE, STATUS, (UID) SEARCH, (UID) FETCH with BODYSTRUCTURE,
+# INTERNALDATE and BODY[section]<partial>, APPEND, NOOP, IDLE, CLOSE, LOGOUT.
+# Seeded messages are generated on demand, so a million-message mailbox costs
+# nothing until a message is actually fetched.
+import email
+import re
+import select
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+
+from synthetic import make_message
+
+CAPABILITIES = "IMAP4rev1 IDLE UIDPLUS LITERAL+"
+
+_ITEM = re.compile(
+    r'(BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|BODYSTRUCTURE|INTERNALDATE|RFC822\.SIZE|RFC822\.HEADER|RFC822|UID|FLAGS|ENVELOPE)',
+    re.IGNORECASE
+)
+
+
+class Mailbox:
+    """INBOX with `seed` lazily generated messages followed by appended ones"""
+
+    def __init__(self, seed=1000, attachment_size=256 * 1024, uidvalidity=1):
+        self.seed = seed
+        self.attachment_size = attachment_size
+        self.uidvalidity = uidvalidity
+        self.appended = {}
+        self.internal_dates = {}
+        self.next_uid = seed + 1
+        self.created = time.time()
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+
+    def exists(self):
+        return self.next_uid - 1
+
+    def append(self, raw):
+        with self.lock:
+            uid = self.next_uid
+            self.appended[uid] = raw
+            self.internal_dates[uid] = time.time()
+            self.next_uid += 1
+            return uid
+
+    def raw(self, uid):
+        raw = self.appended.get(uid)
+        if raw is None:
+            raw = make_message(uid, attachment_size=self.attachment_size)
+        return raw
+
+    def internal_date(self, uid):
+        return self.internal_dates.get(uid, self.created)
+
+    def parsed(self, uid):
+        """Parsed message for uid, with a small LRU so header+body fetches don't reparse"""
+        with self.lock:
+            msg = self.cache.get(uid)
+            if msg is not None:
+                self.cache.move_to_end(uid)
+                return msg
+        msg = email.message_from_bytes(self.raw(uid))
+        with self.lock:
+            self.cache[uid] = msg
+            while len(self.cache) > 256:
+                self.cache.popitem(last=False)
+        return msg
+
+
+def _quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _payload_bytes(part):
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, bytes):
+        return payload
+    return (payload or '').encode('utf-8', 'surrogateescape')
+
+
+def bodystructure(part):
+    """Render a message part as an IMAP BODYSTRUCTURE"""
+    if part.is_multipart():
+        children = ''.join(bodystructure(child) for child in part.get_payload())
+        boundary = part.get_boundary()
+        return f'({children} {_quote(part.get_content_subtype().upper())} ("BOUNDARY" {_quote(boundary)}) NIL NIL NIL)'
+
+    maintype = part.get_content_maintype().upper()
+    subtype = part.get_content_subtype().upper()
+    params = part.get_params() or []
+    params = ' '.join(f'{_quote(key.upper())} {_quote(value)}' for key, value in params[1:])
+    params = f'({params})' if params else 'NIL'
+    encoding = (part.get('Content-Transfer-Encoding') or '7BIT').upper()
+    payload = _payload_bytes(part)
+
+    fields = f'{_quote(maintype)} {_quote(subtype)} {params} NIL NIL {_quote(encoding)} {len(payload)}'
+    if maintype == 'TEXT':
+        lines = payload.count(b'\n')
+        fields += f' {lines}'
+
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        extra = f' ("FILENAME" {_quote(filename)})' if filename else ' NIL'
+        disposition = f'({_quote(disposition.upper())}{extra})'
+    else:
+        disposition = 'NIL'
+
+    return f'({fields} NIL {disposition} NIL NIL)'
+
+
+def _section(msg, raw, spec):
+    """Bytes for a BODY[spec] request"""
+    spec = spec.upper()
+    header_end = raw.find(b'\r\n\r\n')
+    separator = 4
+    if header_end < 0:
+        header_end = raw.find(b'\n\n')
+        separator = 2
+    headers = raw[:header_end + separator]
+
+    if spec == '':
+        return raw
+    if spec == 'HEADER':
+        return headers
+    if spec == 'TEXT':
+        return raw[header_end + separator:]
+    if spec.startswith('HEADER.FIELDS'):
+        wanted = set(re.search(r'\((.*)\)', spec).group(1).split())
+        out = []
+        keep = False
+        for line in headers.split(b'\r\n') if separator == 4 else headers.split(b'\n'):
+            if line[:1] in (b' ', b'\t'):
+                if keep:
+                    out.append(line)
+                continue
+            name = line.split(b':', 1)[0].decode('ascii', 'replace').upper()
+            keep = name in wanted
+            if keep:
+                out.append(line)
+        return b'\r\n'.join(out) + b'\r\n\r\n'
+
+    # Numeric part path like 1, 1.2
+    part = msg
+    for number in spec.split('.'):
+        index = int(number) - 1
+        if part.is_multipart():
+            part = part.get_payload()[index]
+        elif index != 0:
+            return b''
+    return _payload_bytes(part)
+
+
+def _uid_set(spec, last):
+    """Expand '1:5,7,9:*' into a sorted list of UIDs that exist"""
+    uids = set()
+    for chunk in spec.split(','):
+        if ':' in chunk:
+            lo, hi = chunk.split(':')
+            lo = last if lo == '*' else int(lo)
+            hi = last if hi == '*' else int(hi)
+            lo, hi = min(lo, hi), max(lo, hi)
+            uids.update(range(max(lo, 1), min(hi, last) + 1))
+        else:
+            uid = last if chunk == '*' else int(chunk)
+            if 1 <= uid <= last:
+                uids.add(uid)
+    return sorted(uids)
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def read_command(self):
+        """Read one command line, inlining synchronising/non-synchronising literals"""
+        line = self.rfile.readline()
+        if not line:
+            return None, []
+        literals = []
+        while True:
+            match = re.search(rb'\{(\d+)(\+?)\}\r\n$', line)
+            if not match:
+                break
+            if not match.group(2):
+                self.send('+ Ready\r\n')
+            literals.append(self.rfile.read(int(match.group(1))))
+            line = line[:match.start()] + b'\x00LITERAL\x00' + self.rfile.readline()
+        return line.decode('utf-8', 'replace').rstrip('\r\n'), literals
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.selected = False
+        # Message count this session was last told about
+        self.reported = 0
+        self.send(f'* OK [CAPABILITY {CAPABILITIES}] fake IMAP ready\r\n')
+
+        while True:
+            line, literals = self.read_command()
+            if line is None:
+                return
+            parts = line.split(' ', 2)
+            if len(parts) < 2:
+                self.send('* BAD empty command\r\n')
+                continue
+            tag, command = parts[0], parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ''
+
+            # Sequence numbers equal UIDs here (nothing is ever expunged)
+            if command == 'UID':
+                command, _, args = args.partition(' ')
+                command = command.upper()
+
+            if command == 'CAPABILITY':
+                self.send(f'* CAPABILITY {CAPABILITIES}\r\n{tag} OK CAPABILITY completed\r\n')
+            elif command in ('LOGIN', 'AUTHENTICATE'):
+                self.send(f'{tag} OK LOGIN completed\r\n')
+            elif command in ('SELECT', 'EXAMINE'):
+                self.selected = True
+                exists = self.reported = mailbox.exists()
+                self.send(
+                    f'* {exists} EXISTS\r\n* 0 RECENT\r\n'
+                    f'* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n'
+                    f'* OK [UIDNEXT {mailbox.next_uid}] Predicted next UID\r\n'
+                    f'* FLAGS (\\Seen \\Answered)\r\n'
+                    f'{tag} OK [READ-WRITE] {command} completed\r\n'
+                )
+            elif command == 'STATUS':
+                self.send(f'* STATUS INBOX (MESSAGES {mailbox.exists()} UIDNEXT {mailbox.next_uid} '
+                          f'UIDVALIDITY {mailbox.uidvalidity})\r\n{tag} OK STATUS completed\r\n')
+            elif command == 'SEARCH':
+                criteria = args.upper()
+                uids = []
+                if 'UNSEEN' not in criteria:
+                    match = re.search(r'UID (\S+)', criteria)
+                    spec = match.group(1) if match else '1:*'
+                    uids = _uid_set(spec, mailbox.exists())
+                self.send(f'* SEARCH {" ".join(map(str, uids))}\r\n{tag} OK SEARCH completed\r\n')
+            elif command == 'FETCH':
+                self.fetch(tag, args)
+            elif command == 'APPEND':
+                uid = mailbox.append(literals[0] if literals else b'')
+                self.send(f'{tag} OK [APPENDUID {mailbox.uidvalidity} {uid}] APPEND completed\r\n')
+            elif command == 'NOOP':
+                # Like a real server, only report a count the client hasn't seen yet
+                exists = mailbox.exists()
+                if exists != self.reported:
+                    self.reported = exists
+                    self.send(f'* {exists} EXISTS\r\n')
+                self.send(f'{tag} OK NOOP completed\r\n')
+            elif command == 'IDLE':
+                self.idle(tag)
+            elif command == 'CLOSE':
+                self.selected = False
+                self.send(f'{tag} OK CLOSE completed\r\n')
+            elif command == 'LOGOUT':
+                self.send(f'* BYE logging out\r\n{tag} OK LOGOUT completed\r\n')
+                return
+            else:
+                self.send(f'{tag} BAD unsupported command {command}\r\n')
+
+    def fetch(self, tag, args):
+        mailbox = self.server.mailbox
+        spec, _, items = args.partition(' ')
+        requested = _ITEM.findall(items)
+
+        for uid in _uid_set(spec, mailbox.exists()):
+            out = [f'* {uid} FETCH ('.encode()]
+            first = True
+            msg = None
+            raw = None
+
+            if 'UID' not in [item.upper() for item in requested]:
+                requested = ['UID'] + requested
+
+            for item in requested:
+                name = item.upper()
+                out.append(b'' if first else b' ')
+                first = False
+
+                if name == 'UID':
+                    out.append(f'UID {uid}'.encode())
+                elif name == 'FLAGS':
+                    out.append(b'FLAGS ()')
+                elif name == 'INTERNALDATE':
+                    stamp = time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime(mailbox.internal_date(uid)))
+                    out.append(f'INTERNALDATE "{stamp}"'.encode())
+                elif name == 'RFC822.SIZE':
+                    out.append(f'RFC822.SIZE {len(mailbox.raw(uid))}'.encode())
+                elif name == 'BODYSTRUCTURE':
+                    msg = msg or mailbox.parsed(uid)
+                    out.append(f'BODYSTRUCTURE {bodystructure(msg)}'.encode())
+                elif name == 'ENVELOPE':
+                    out.append(b'ENVELOPE NIL')
+                else:
+                    raw = raw if raw is not None else mailbox.raw(uid)
+                    msg = msg or mailbox.parsed(uid)
+                    if name in ('RFC822', 'RFC822.HEADER'):
+                        data = raw if name == 'RFC822' else _section(msg, raw, 'HEADER')
+                        label = name
+                    else:
+                        match = re.match(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', item, re.IGNORECASE)
+                        section, start, length = match.group(1), match.group(2), match.group(3)
+                        data = _section(msg, raw, section)
+                        label = f'BODY[{section}]'
+                        if start is not None:
+                            data = data[int(start):int(start) + int(length)]
+                            label += f'<{start}>'
+                    out.append(f'{label} {{{len(data)}}}\r\n'.encode())
+                    out.append(data)
+
+            out.append(b')\r\n')
+            self.send(b''.join(out))
+
+        self.send(f'{tag} OK FETCH completed\r\n')
+
+    def idle(self, tag):
+        mailbox = self.server.mailbox
+        # Like real servers, report mail that arrived since the last command in
+        # the same segment as the continuation
+        exists = mailbox.exists()
+        if exists != self.reported:
+            self.reported = exists
+            self.send(f'+ idling\r\n* {exists} EXISTS\r\n')
+        else:
+            self.send('+ idling\r\n')
+        sock = self.connection
+
+        while True:
+            readable, _, _ = select.select([sock], [], [], 0.01)
+            if readable:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b'DONE':
+                    break
+            # Includes mail that arrived between SELECT and IDLE
+            exists = mailbox.exists()
+            if exists != self.reported:
+                self.reported = exists
+                self.send(f'* {exists} EXISTS\r\n')
+
+        self.send(f'{tag} OK IDLE terminated\r\n')
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, mailbox):
+        super().__init__(address, IMAPHandler)
+        self.mailbox = mailbox
+
+
+def serve(mailbox, host='127.0.0.1', port=0):
+    """Start the server on a background thread and return it"""
+    server = FakeIMAPServer((host, port), mailbox)
+    threading.Thread(target=server.serve_forever, name="fake-imap", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a fake IMAP server with a synthetic INBOX")
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--seed', type=int, default=1000, help="messages already in the mailbox")
+    args = parser.parse_args()
+
+    server = serve(Mailbox(seed=args.seed), port=args.port)
+    print(f"Fake IMAP on 127.0.0.1:{server.server_address[1]} with {args.seed} messages")
+    threading.Event().wait()
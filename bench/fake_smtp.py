@@ -0,0 +1,77 @@
+# SMTP sink over plain TCP for benchmarks.
+#
+# Accepts EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA, RSET, NOOP and QUIT, and
+# hands every accepted message to a callback instead of delivering it.
+import socketserver
+import threading
+import time
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.send('220 fake SMTP ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb == 'EHLO':
+                self.send('250-fake.local')
+                self.send('250-AUTH PLAIN LOGIN')
+                self.send('250-PIPELINING')
+                self.send('250 8BITMIME')
+            elif verb == 'HELO':
+                self.send('250 fake.local')
+            elif verb == 'AUTH':
+                if command.upper().startswith('AUTH LOGIN'):
+                    # Username and password prompts, unless sent inline
+                    if len(command.split()) < 3:
+                        self.send('334 VXNlcm5hbWU6')
+                        self.rfile.readline()
+                    self.send('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                self.send('235 Authentication successful')
+            elif verb in ('MAIL', 'RCPT', 'RSET'):
+                self.send('250 OK')
+            elif verb == 'NOOP':
+                self.send('250 OK')
+            elif verb == 'DATA':
+                self.send('354 End data with <CR><LF>.<CR><LF>')
+                chunks = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b'.\r\n', b'.\n'):
+                        break
+                    if data.startswith(b'..'):
+                        data = data[1:]
+                    chunks.append(data)
+                self.server.on_message(b''.join(chunks), time.time())
+                self.send('250 OK queued')
+            elif verb == 'QUIT':
+                self.send('221 Bye')
+                return
+            else:
+                self.send('502 Command not implemented')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, on_message):
+        super().__init__(address, SMTPHandler)
+        self.on_message = on_message
+
+
+def serve(on_message, host='127.0.0.1', port=0):
+    """Start the sink on a background thread and return it"""
+    server = FakeSMTPServer((host, port), on_message)
+    threading.Thread(target=server.serve_forever, name="fake-smtp", daemon=True).start()
+    return server
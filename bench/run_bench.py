@@ -0,0 +1,306 @@
+# End-to-end benchmark: IMAP arrival -> stored -> AI reply -> SMTP accepted.
+#
+# The fake IMAP server, SMTP sink and stub LLM run in a child process so their
+# CPU time doesn't compete with MailLLM for the GIL. MailLLM itself runs in this
+# process against a throwaway database, exactly as index.main() wires it, with
+# its servers pointed at the fakes through the usual environment variables.
+#
+#   python bench/run_bench.py --messages 200 --rate 20 --llm-latency 0.3
+#
+# With --api the API runs too, with an /events client connected for the whole
+# run while /stats is polled alongside it; the run fails if any poll fails or
+# the stream misses the new mail.
+import argparse
+import email
+import http.client
+import imaplib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from email.header import decode_header, make_header
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def _servers(args, ports, replies, stop):
+    """Child process: run the fakes and report every accepted reply"""
+    import fake_imap
+    import fake_smtp
+    import stub_llm
+
+    def on_message(raw, at):
+        subject = str(make_header(decode_header(email.message_from_bytes(raw).get('Subject', ''))))
+        replies.put((subject, at))
+
+    imap_servers = [
+        fake_imap.serve(fake_imap.Mailbox(seed=args.seed_messages, attachment_size=args.attachment_kb * 1024))
+        for _ in range(args.accounts)
+    ]
+    smtp_server = fake_smtp.serve(on_message)
+    llm_server = stub_llm.serve(latency=args.llm_latency, rate_limit_ratio=args.llm_429_rate)
+
+    ports.put({
+        "imap": [server.server_address[1] for server in imap_servers],
+        "smtp": smtp_server.server_address[1],
+        "llm": llm_server.server_address[1]
+    })
+    stop.wait()
+    ports.put({"llm_requests": llm_server.requests, "llm_rate_limited": llm_server.rate_limited})
+
+
+def _quantile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def _inject(ports, count, rate, sent_at):
+    """APPEND `count` uniquely-subjected messages across the mailboxes, `rate` per second (0 = one burst)"""
+    from synthetic import make_message
+
+    sessions = []
+    for port in ports:
+        imap = imaplib.IMAP4('127.0.0.1', port)
+        imap.login('bench', 'bench')
+        sessions.append(imap)
+    start = time.time()
+    for i in range(count):
+        if rate:
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        subject = f"Bench {os.getpid()}-{i}"
+        raw = make_message(10_000_000 + i, subject=subject)
+        sent_at[subject] = time.time()
+        sessions[i % len(sessions)].append('INBOX', None, None, raw)
+    for imap in sessions:
+        imap.logout()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _probe_api(port, stop, result):
+    """Hold an /events stream open and time /stats requests next to it"""
+    deadline = time.time() + 10
+    while True:
+        try:
+            events = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            events.request('GET', '/events')
+            stream = events.getresponse()
+            break
+        except OSError:
+            # The server is still starting
+            if time.time() > deadline:
+                result["failed"] += 1
+                return
+            time.sleep(0.1)
+
+    def read_events():
+        try:
+            for line in stream:
+                if line.startswith(b'event: new_mail'):
+                    result["stream_events"] += 1
+        except (OSError, ValueError):
+            pass
+
+    threading.Thread(target=read_events, daemon=True).start()
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/stats')
+            conn.getresponse().read()
+            conn.close()
+            result["latencies"].append(time.perf_counter() - start)
+        except OSError:
+            result["failed"] += 1
+        time.sleep(0.05)
+    events.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MailLLM end to end against local fakes")
+    parser.add_argument('--seed-messages', type=int, default=1000, help="messages already in INBOX before the run")
+    parser.add_argument('--messages', type=int, default=100, help="messages injected during the run")
+    parser.add_argument('--rate', type=float, default=0, help="injected messages per second (0 = burst)")
+    parser.add_argument('--attachment-kb', type=int, default=256, help="attachment size in seeded messages")
+    parser.add_argument('--llm-latency', type=float, default=0.3, help="mean stub LLM latency in seconds")
+    parser.add_argument('--llm-429-rate', type=float, default=0.0, help="fraction of LLM calls answered with 429")
+    parser.add_argument('--workers', type=int, default=4, help="REPLY_WORKERS")
+    parser.add_argument('--runtime', choices=('threads', 'async'), default='threads', help="RUNTIME to benchmark")
+    parser.add_argument('--accounts', type=int, default=1, help="mailboxes, each on its own fake IMAP server")
+    parser.add_argument('--timeout', type=float, default=120, help="give up waiting for replies after this many seconds")
+    parser.add_argument('--api', action='store_true', help="also serve the API and poll it next to an open /events stream")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    # Fakes in a child process
+    ports, replies, stop = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+    child = multiprocessing.Process(target=_servers, args=(args, ports, replies, stop), daemon=True)
+    child.start()
+    port = ports.get(timeout=30)
+
+    # Point MailLLM at the fakes before it reads its configuration
+    os.environ.update({
+        "EMAIL": "bench@bench.local",
+        "PASSWORD": "bench",
+        "IMAP_HOST": "127.0.0.1",
+        "IMAP_PORT": str(port['imap'][0]),
+        "IMAP_SSL": "0",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(port['smtp']),
+        "SMTP_SSL": "0",
+        "GROQ_API_KEY": "bench",
+        "GROQ_BASE_URL": f"http://127.0.0.1:{port['llm']}",
+        "GROQ_RPM": "100000",
+        "GROQ_TPM": "100000000",
+        "GROQ_STRONG_RPM": "100000",
+        "GROQ_STRONG_TPM": "100000000",
+        "RESPONSE_CACHE": "0",
+        "REPLY_WORKERS": str(args.workers),
+        "API_PORT": str(_free_port())
+    })
+
+    # Throwaway working directory for ./logs/MailLLM.db
+    workdir = tempfile.mkdtemp(prefix="mailllm-bench-")
+    os.chdir(workdir)
+    os.makedirs('logs', exist_ok=True)
+    sys.path.insert(0, REPO_DIR)
+
+    # Several mailboxes go through an accounts file, as in production
+    if args.accounts > 1:
+        with open('accounts.json', 'w') as f:
+            json.dump({"accounts": [
+                {"name": f"bench{i}", "email": f"bench{i}@bench.local", "password": "bench", "imap_port": imap_port}
+                for i, imap_port in enumerate(port['imap'])
+            ]}, f)
+        os.environ["ACCOUNTS_FILE"] = os.path.abspath('accounts.json')
+
+    import index
+    import metrics
+    index.seen.attach()
+    roles = ('fetch', 'process')
+    if args.api:
+        roles += ('api',)
+        index.read_model.attach()
+        index.change_feed.attach()
+
+    if args.runtime == 'async':
+        import asyncio
+        from async_runtime import AsyncRuntime
+        runtime = AsyncRuntime(index, workers=index.ASYNC_REPLY_WORKERS, roles=roles)
+        threading.Thread(target=asyncio.run, args=(runtime.run(),), daemon=True).start()
+    else:
+        for account in index.ACCOUNTS:
+            threading.Thread(target=index.fetch_emails_thread, args=(account,), daemon=True).start()
+        threading.Thread(target=index.process_emails_thread, daemon=True).start()
+        if args.api:
+            threading.Thread(target=index.flask_server_thread, daemon=True).start()
+
+    api = {"latencies": [], "failed": 0, "stream_events": 0}
+    api_stop = threading.Event()
+    if args.api:
+        threading.Thread(target=_probe_api, args=(index.API_PORT, api_stop, api), daemon=True).start()
+
+    # Let the initial backfill settle so it doesn't count against the run
+    time.sleep(2)
+
+    sent_at = {}
+    received_at = {}
+    start = time.time()
+    injector = threading.Thread(target=_inject, args=(port['imap'], args.messages, args.rate, sent_at), daemon=True)
+    injector.start()
+
+    deadline = start + args.timeout
+    while len(received_at) < args.messages and time.time() < deadline:
+        try:
+            subject, at = replies.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if subject.startswith("Re: "):
+            subject = subject[4:]
+        if subject in sent_at or subject.startswith("Bench "):
+            received_at.setdefault(subject, at)
+    elapsed = time.time() - start
+
+    # Give the stream a moment to deliver the last changes
+    if args.api:
+        time.sleep(1)
+    api_stop.set()
+    stop.set()
+    try:
+        llm = ports.get(timeout=5)
+    except queue.Empty:
+        llm = {}
+
+    latencies = [received_at[s] - sent_at[s] for s in received_at if s in sent_at]
+    report = {
+        "runtime": args.runtime,
+        "accounts": args.accounts,
+        "messages": args.messages,
+        "replied": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "mails_per_second": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_seconds": {
+            "p50": _quantile(latencies, 0.5),
+            "p95": _quantile(latencies, 0.95),
+            "p99": _quantile(latencies, 0.99),
+            "max": max(latencies) if latencies else None
+        },
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "threads": threading.active_count(),
+        "stages": {
+            name: metrics.snapshot_quantiles(f'{name}_seconds')
+            for name in ('imap_fetch', 'llm_request', 'smtp_send')
+        },
+        "llm": llm
+    }
+    if args.api:
+        report["api"] = {
+            "stats_requests": len(api["latencies"]),
+            "stats_failed": api["failed"],
+            "stats_p95": _quantile(api["latencies"], 0.95),
+            "stream_new_mail_events": api["stream_events"]
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Replied {report['replied']}/{report['messages']} in {report['elapsed_seconds']}s "
+              f"({report['mails_per_second']} mails/s)")
+        for name, value in report['latency_seconds'].items():
+            print(f"  latency {name}: {value if value is None else round(value, 3)}s")
+        print(f"  peak RSS: {report['peak_rss_mb']} MB, {report['threads']} threads")
+        for name, quantiles in report['stages'].items():
+            summary = ', '.join(f"p{int(q * 100)}={v:.3f}s" for q, v in quantiles.items())
+            print(f"  {name}: {summary or 'no samples'}")
+        print(f"  LLM requests: {llm.get('llm_requests')} ({llm.get('llm_rate_limited')} rate limited)")
+        if args.api:
+            p95 = report['api']['stats_p95']
+            print(f"  API: {report['api']['stats_requests']} /stats requests next to an open /events stream "
+                  f"({report['api']['stats_failed']} failed, p95={p95 if p95 is None else round(p95, 3)}s), "
+                  f"{report['api']['stream_new_mail_events']} new_mail events streamed")
+
+    ok = report['replied'] == args.messages
+    if args.api:
+        # Every /stats request must complete while the stream is open, and the stream must see the new mail
+        ok = ok and api["latencies"] and not api["failed"] and api["stream_events"] >= args.messages
+    os._exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
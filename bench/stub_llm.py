@@ -0,0 +1,111 @@
+# Stand-in for the Groq chat completions API.
+#
+# Serves POST /openai/v1/chat/completions (what the groq client calls when
+# GROQ_BASE_URL points here) with a canned email reply after a configurable
+# latency, and answers a configurable fraction of requests with 429 +
+# Retry-After. Supports both plain and streamed (SSE) responses.
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = (
+    "Dear {name},\n\n"
+    "From your email question, here is the answer: this is a benchmark reply.\n\n"
+    "Best Regards,\n"
+    "MailLLM"
+)
+
+
+class LLMHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        config = self.server.config
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        if random.random() < config['rate_limit_ratio']:
+            with self.server.lock:
+                self.server.rate_limited += 1
+            body = json.dumps({"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}}).encode()
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Retry-After', str(config['retry_after']))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        latency = max(random.gauss(config['latency'], config['latency'] * config['jitter']), 0)
+        time.sleep(latency)
+
+        prompt = ' '.join(str(message.get('content', '')) for message in request.get('messages', []))
+        content = REPLY.format(name="there")
+        usage = {
+            "prompt_tokens": len(prompt) // 4 + 1,
+            "completion_tokens": len(content) // 4 + 1,
+            "total_tokens": len(prompt) // 4 + len(content) // 4 + 2
+        }
+        model = request.get('model', 'stub')
+
+        if request.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            words = content.split(' ')
+            for i, word in enumerate(words):
+                chunk = {
+                    "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word + (' ' if i < len(words) - 1 else '')}, "finish_reason": None}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            final = {
+                "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "x_groq": {"id": "stub", "usage": usage}
+            }
+            self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+            return
+
+        body = json.dumps({
+            "id": "stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, LLMHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+
+
+def serve(latency=0.3, jitter=0.2, rate_limit_ratio=0.0, retry_after=1, host='127.0.0.1', port=0):
+    """Start the stub on a background thread and return it"""
+    server = StubLLMServer((host, port), {
+        "latency": latency,
+        "jitter": jitter,
+        "rate_limit_ratio": rate_limit_ratio,
+        "retry_after": retry_after
+    })
+    threading.Thread(target=server.serve_forever, name="stub-llm", daemon=True).start()
+    return server
@@ -0,0 +1,45 @@
+import random
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+from datetime import datetime, timezone
+
+# Message shapes in a synthetic mailbox
+KINDS = ('plain', 'alternative', 'attachment')
+
+QUESTIONS = (
+    "Who made you?",
+    "What is the capital of Australia?",
+    "Can you explain how IMAP IDLE works?",
+    "How many bytes are in a kilobyte?",
+    "What's a good name for a cat?",
+    "Why is the sky blue?",
+)
+
+_FIRST_NAMES = ('Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace', 'Heidi')
+
+
+def make_message(uid, kind=None, attachment_size=256 * 1024, subject=None):
+    """Build a deterministic RFC822 message for a UID"""
+    rng = random.Random(uid)
+    kind = kind or KINDS[uid % len(KINDS)]
+    name = _FIRST_NAMES[uid % len(_FIRST_NAMES)]
+    question = QUESTIONS[uid % len(QUESTIONS)]
+
+    msg = EmailMessage()
+    msg['Message-ID'] = make_msgid(idstring=f"bench{uid}", domain="bench.local")
+    msg['Subject'] = subject or f"Question {uid}"
+    msg['From'] = f"{name} Example <{name.lower()}{uid % 1000}@bench.local>"
+    msg['To'] = "mailllm@bench.local"
+    msg['Date'] = format_datetime(datetime.now(timezone.utc))
+
+    body = f"Hi MailLLM,\n\n{question}\n\nThanks,\n{name}\n"
+    msg.set_content(body)
+
+    if kind in ('alternative', 'attachment'):
+        msg.add_alternative(f"<html><body><p>Hi MailLLM,</p><p>{question}</p></body></html>", subtype='html')
+
+    if kind == 'attachment':
+        payload = rng.randbytes(attachment_size)
+        msg.add_attachment(payload, maintype='application', subtype='octet-stream', filename=f"log-{uid}.bin")
+
+    return msg.as_bytes()
@@ -0,0 +1,65 @@
+import threading
+import time
+
+# How often a separate API process checks the database for new changes
+POLL_INTERVAL = 0.5
+
+
+class ChangeFeed:
+    """Wakes API requests waiting for the store's change log to move past a
+    sequence number (the long-poll /changes and the /events stream).
+
+    `seq` is the latest change this process knows of. In the process that
+    writes, the store's listener hook advances it as each write commits;
+    watch() also polls the log for writes from other processes. Waiters
+    block on one Condition, so idle clients cost no queries.
+    close() releases every waiter for good, so open streams end on shutdown.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.closed = False
+
+    def attach(self):
+        """Follow the store's writes in this process"""
+        self.seq = self.store.last_change()
+        self.store.subscribe(self._apply)
+        return self
+
+    def watch(self, interval=POLL_INTERVAL):
+        """Also poll for changes written by other processes"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self._advance(self.store.last_change())
+                except Exception as e:
+                    print(f"ERROR [CHANGE FEED WATCH]: {e}")
+
+        self.attach()
+        threading.Thread(target=run, name="change-feed-watch", daemon=True).start()
+        return self
+
+    def _apply(self, event, payload):
+        if payload.get("seq"):
+            self._advance(payload["seq"])
+
+    def _advance(self, seq):
+        with self.cond:
+            if seq > self.seq:
+                self.seq = seq
+                self.cond.notify_all()
+
+    def close(self):
+        """Wake every waiter and stop waiting from now on"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def wait(self, since, timeout):
+        """Block until there are changes after `since`, `timeout` runs out or the feed closes; returns the latest seq"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > since or self.closed, timeout)
+            return self.seq
@@ -0,0 +1,351 @@
+import base64
+import imaplib
+import quopri
+import re
+import time
+from email.header import decode_header
+from email.parser import BytesHeaderParser
+import metrics
+from mime_stream import TextPartExtractor, html_to_text
+
+# Headers needed to build an email dict
+HEADER_FIELDS = "MESSAGE-ID SUBJECT FROM DATE IN-REPLY-TO REFERENCES"
+
+# Only this many bytes of a text/plain part are downloaded
+MAX_BODY_BYTES = 64 * 1024
+
+# UIDs per body FETCH command
+FETCH_BATCH_SIZE = 100
+
+# Messages whose BODYSTRUCTURE can't be used are read raw, up to this many bytes
+MAX_RAW_BYTES = 256 * 1024
+
+# UIDs per raw FETCH command, so a batch stays within a few MB
+RAW_FETCH_BATCH_SIZE = 10
+
+# Raw messages are fed to the MIME extractor in chunks of this size
+RAW_CHUNK_BYTES = 16 * 1024
+
+_LITERAL_MARKER = re.compile(rb'\{(\d+)\}$')
+
+
+def _tokenize(data):
+    """Turn an imaplib FETCH response into a flat token list.
+
+    imaplib hands back a mix of bytes and (prefix, literal) tuples; literals
+    become a single bytes token, everything else is split into parens,
+    quoted strings and atoms (str). NIL becomes None.
+    """
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            tokens.extend(_tokenize_line(_LITERAL_MARKER.sub(b'', prefix)))
+            tokens.append(literal)
+        elif item is not None:
+            tokens.extend(_tokenize_line(item))
+    return tokens
+
+
+def _tokenize_line(line):
+    tokens = []
+    text = line.decode('utf-8', errors='replace')
+    i, n = 0, len(text)
+
+    while i < n:
+        c = text[i]
+        if c in ' \r\n':
+            i += 1
+        elif c in '()':
+            tokens.append(c)
+            i += 1
+        elif c == '"':
+            # Quoted string with backslash escapes
+            i += 1
+            out = []
+            while i < n and text[i] != '"':
+                if text[i] == '\\' and i + 1 < n:
+                    i += 1
+                out.append(text[i])
+                i += 1
+            tokens.append(''.join(out))
+            i += 1
+        else:
+            # Atom; section specs like BODY[HEADER.FIELDS (A B)]<0> stay whole
+            start = i
+            depth = 0
+            while i < n:
+                c = text[i]
+                if c == '[':
+                    depth += 1
+                elif c == ']':
+                    depth -= 1
+                elif depth == 0 and c in ' ()\r\n':
+                    break
+                i += 1
+            atom = text[start:i]
+            tokens.append(None if atom.upper() == 'NIL' else atom)
+
+    return tokens
+
+
+def _parse_list(tokens, pos):
+    """Parse a parenthesised list starting after '(' and return (list, next_pos)"""
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token == '(':
+            sub, pos = _parse_list(tokens, pos + 1)
+            items.append(sub)
+        elif token == ')':
+            return items, pos + 1
+        else:
+            items.append(token)
+            pos += 1
+    return items, pos
+
+
+def parse_fetch_response(data):
+    """Parse a UID FETCH response into {uid: {ITEM: value}}"""
+    tokens = _tokenize(data)
+    messages = {}
+    pos = 0
+
+    while pos < len(tokens):
+        # Each response is "<seq> (ITEM value ITEM value ...)"
+        if tokens[pos] != '(':
+            pos += 1
+            continue
+        items, pos = _parse_list(tokens, pos + 1)
+
+        fields = {}
+        for key, value in zip(items[::2], items[1::2]):
+            if isinstance(key, str):
+                fields[key.upper()] = value
+
+        if 'UID' in fields:
+            messages[int(fields['UID'])] = fields
+
+    return messages
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value or ''
+
+
+def find_text_part(structure, prefix='', want='plain'):
+    """Find the first inline text/<want> part in a BODYSTRUCTURE.
+
+    Forwarded messages (message/rfc822 parts) are searched too.
+    Returns (section, encoding, charset, size, subtype) or None.
+    """
+    if not structure:
+        return None
+
+    if isinstance(structure[0], list):
+        # Multipart: child parts first, then the subtype
+        number = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            section = f"{prefix}.{number}" if prefix else str(number)
+            found = find_text_part(child, section, want)
+            if found:
+                return found
+        return None
+
+    maintype = _text(structure[0]).lower()
+    subtype = _text(structure[1]).lower()
+    if (maintype, subtype) == ('message', 'rfc822') and len(structure) > 8 and isinstance(structure[8], list):
+        # The forwarded message's parts are numbered below this one; a single part is N.1
+        inner = structure[8]
+        section = prefix or '1'
+        if inner and isinstance(inner[0], list):
+            return find_text_part(inner, section, want)
+        return find_text_part(inner, f"{section}.1", want)
+    if (maintype, subtype) != ('text', want):
+        return None
+
+    # Skip parts marked as attachments (disposition sits after lines and md5)
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and _text(disposition[0]).lower() == 'attachment':
+        return None
+
+    params = structure[2] or []
+    charset = 'utf-8'
+    for key, value in zip(params[::2], params[1::2]):
+        if _text(key).lower() == 'charset':
+            charset = _text(value)
+
+    encoding = _text(structure[5]).lower()
+    size = int(structure[6] or 0)
+    return (prefix or '1', encoding, charset, size, subtype)
+
+
+@metrics.timed('mime_parse', part='body')
+def decode_part(payload, encoding, charset):
+    """Undo the transfer encoding and decode a (possibly truncated) part"""
+    if encoding == 'base64':
+        compact = re.sub(rb'[^A-Za-z0-9+/=]', b'', payload)
+        # A truncated partial fetch can end mid-quad
+        compact = compact[:len(compact) - len(compact) % 4]
+        payload = base64.b64decode(compact)
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+
+    try:
+        return payload.decode(charset)
+    except (LookupError, UnicodeDecodeError):
+        return payload.decode('utf-8', errors='replace')
+
+
+def body_text(payload, encoding, charset, subtype='plain'):
+    """Decode a text part, converting HTML to plain text"""
+    text = decode_part(payload, encoding, charset)
+    if subtype == 'html':
+        return html_to_text(text)
+    return text
+
+
+@metrics.timed('mime_parse', part='raw')
+def extract_body(raw):
+    """Body text of a raw (possibly truncated) message, streamed through the MIME extractor"""
+    extractor = TextPartExtractor(MAX_BODY_BYTES)
+    view = memoryview(raw)
+    for start in range(0, len(view), RAW_CHUNK_BYTES):
+        extractor.feed(bytes(view[start:start + RAW_CHUNK_BYTES]))
+        if extractor.done:
+            break
+
+    part = extractor.close()
+    return body_text(*part) if part else ""
+
+
+@metrics.timed('mime_parse', part='headers')
+def parse_headers(header_bytes):
+    """Build the header half of an email dict from fetched header fields"""
+    msg = BytesHeaderParser().parsebytes(header_bytes or b'')
+
+    # Decode email subject
+    subject = msg["Subject"]
+    if subject is not None:
+        subject, encoding = decode_header(subject)[0]
+        if isinstance(subject, bytes):
+            subject = subject.decode(encoding if encoding else "utf-8")
+
+    return {
+        "message_id": msg.get("Message-ID"),
+        "subject": subject,
+        "from": msg.get("From"),
+        "date": msg.get("Date"),
+        "in_reply_to": msg.get("In-Reply-To"),
+        "references": msg.get("References")
+    }
+
+
+def _internal_date(value):
+    """Server arrival time (INTERNALDATE) as a Unix timestamp"""
+    if not value:
+        return None
+    parsed = imaplib.Internaldate2tuple(f'INTERNALDATE "{value}"'.encode())
+    return time.mktime(parsed) if parsed else None
+
+
+def fetch_messages(imap, uid_set, min_uid=0, seen=None):
+    """Fetch emails for a UID set with headers and BODYSTRUCTURE first.
+
+    One FETCH returns headers and structure for every message; then only the
+    text/plain section of each message (text/html if there is none) is
+    downloaded, capped at MAX_BODY_BYTES and batched by section. Attachments
+    never come over the wire. A message whose BODYSTRUCTURE can't be
+    interpreted is read raw, at most MAX_RAW_BYTES, and streamed through the
+    MIME extractor. Messages whose Message-ID is in `seen` are dropped
+    after the header pass, so refetched mail costs no body download.
+    Returns a list of email dicts with a 'uid' key.
+    """
+    status, data = imap.uid(
+        'FETCH', uid_set,
+        f'(UID INTERNALDATE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])'
+    )
+    if status != 'OK':
+        raise RuntimeError(f"UID FETCH failed: {status}")
+
+    emails = {}
+    parts = {}
+    raw_uids = []
+    for uid, fields in parse_fetch_response(data).items():
+        # "n:*" always matches the newest message, even when its UID is below n;
+        # unsolicited FLAGS updates carry no BODYSTRUCTURE
+        if uid < min_uid or 'BODYSTRUCTURE' not in fields:
+            continue
+
+        header_bytes = next((v for k, v in fields.items() if k.startswith('BODY[HEADER')), b'')
+        email_data = parse_headers(header_bytes)
+        if seen is not None and email_data.get('message_id') in seen:
+            metrics.inc('mails_seen_skipped_total')
+            continue
+        email_data['uid'] = uid
+        email_data['received_at'] = _internal_date(fields.get('INTERNALDATE'))
+        email_data['body'] = ""
+        emails[uid] = email_data
+
+        structure = fields.get('BODYSTRUCTURE')
+        try:
+            part = find_text_part(structure) or find_text_part(structure, want='html')
+        except (IndexError, TypeError, ValueError):
+            # Malformed or unusual structure: fall back to the raw message
+            raw_uids.append(uid)
+            continue
+        if part:
+            parts[uid] = part
+            if part[4] == 'html':
+                metrics.inc('mime_fallback_total', kind='html')
+
+    # Group messages by section so each group is one FETCH
+    by_section = {}
+    for uid, (section, encoding, charset, size, subtype) in parts.items():
+        by_section.setdefault(section, []).append(uid)
+
+    for section, uids in by_section.items():
+        for i in range(0, len(uids), FETCH_BATCH_SIZE):
+            batch = uids[i:i + FETCH_BATCH_SIZE]
+            status, data = imap.uid(
+                'FETCH', ','.join(str(uid) for uid in batch),
+                f'(UID BODY.PEEK[{section}]<0.{MAX_BODY_BYTES}>)'
+            )
+            if status != 'OK':
+                print(f"ERROR fetching section {section}: {status}")
+                continue
+
+            for uid, fields in parse_fetch_response(data).items():
+                if uid not in parts:
+                    continue
+                payload = next((v for k, v in fields.items() if k.startswith('BODY[')), None)
+                if isinstance(payload, str):
+                    # Small sections may come back as a quoted string
+                    payload = payload.encode('utf-8')
+                if isinstance(payload, bytes):
+                    _, encoding, charset, _, subtype = parts[uid]
+                    emails[uid]['body'] = body_text(payload, encoding, charset, subtype)
+
+    for i in range(0, len(raw_uids), RAW_FETCH_BATCH_SIZE):
+        batch = raw_uids[i:i + RAW_FETCH_BATCH_SIZE]
+        status, data = imap.uid(
+            'FETCH', ','.join(str(uid) for uid in batch),
+            f'(UID BODY.PEEK[]<0.{MAX_RAW_BYTES}>)'
+        )
+        if status != 'OK':
+            print(f"ERROR fetching raw messages: {status}")
+            continue
+
+        for uid, fields in parse_fetch_response(data).items():
+            payload = next((v for k, v in fields.items() if k.startswith('BODY[')), None)
+            if uid in emails and isinstance(payload, bytes):
+                metrics.inc('mime_fallback_total', kind='raw')
+                emails[uid]['body'] = extract_body(payload)
+
+    # Newest first
+    return [emails[uid] for uid in sorted(emails, reverse=True)]
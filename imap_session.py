@@ -0,0 +1,166 @@
+import imaplib
+import random
+import select
+import ssl
+import time
+
+# How long a single IDLE may run before we break it with DONE + NOOP.
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes; NAT
+# boxes and Gmail tend to drop silent connections well before that.
+IDLE_KEEPALIVE = 5 * 60
+
+# Reconnect backoff bounds (seconds)
+BACKOFF_MIN = 1
+BACKOFF_MAX = 5 * 60
+
+
+class ImapSession:
+    """Long-lived IMAP session that waits for new mail with IDLE"""
+
+    def __init__(self, connect, folder="INBOX", keepalive=IDLE_KEEPALIVE):
+        # connect() must return a logged-in IMAP4 object or None
+        self.connect = connect
+        self.folder = folder
+        self.keepalive = keepalive
+        self.imap = None
+        self.backoff = BACKOFF_MIN
+
+    def ensure(self):
+        """Return an authenticated connection, reconnecting with backoff if needed"""
+        while self.imap is None:
+            imap = self.connect()
+            if imap is not None:
+                try:
+                    imap.select(f'"{self.folder}"')
+                    self.imap = imap
+                    self.backoff = BACKOFF_MIN
+                    break
+                except Exception as e:
+                    print(f"ERROR selecting {self.folder}: {e}")
+                    self._shutdown(imap)
+
+            # Exponential backoff with jitter so we don't hammer the login endpoint
+            delay = self.backoff + random.uniform(0, self.backoff / 2)
+            print(f"ERROR: IMAP connect failed, retrying in {delay:.0f}s")
+            time.sleep(delay)
+            self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+
+        return self.imap
+
+    def supports_idle(self):
+        """Check whether the server advertised the IDLE capability"""
+        return self.imap is not None and 'IDLE' in self.imap.capabilities
+
+    def wait_for_changes(self, timeout=None):
+        """Block until the server reports new mail or the keepalive expires.
+
+        Returns True if the mailbox changed. The connection stays open; any
+        network error drops it so the next ensure() reconnects.
+        """
+        imap = self.ensure()
+        timeout = timeout or self.keepalive
+
+        try:
+            # The server may already have reported new mail in an untagged
+            # EXISTS during the last FETCH; it won't repeat that inside IDLE
+            exists = imap.untagged_responses.get('EXISTS') or []
+            if len(exists) > 1 and exists[-1] != exists[0]:
+                imap.untagged_responses.pop('EXISTS', None)
+                return True
+
+            if self.supports_idle():
+                changed = self._idle(imap, timeout)
+            else:
+                # No IDLE: fall back to polling with NOOP on the same session
+                time.sleep(timeout)
+                changed = False
+
+            # NOOP doubles as keepalive and flushes any pending EXISTS updates
+            status, _ = imap.noop()
+            if status != 'OK':
+                raise imaplib.IMAP4.abort(f"NOOP returned {status}")
+            if imap.untagged_responses.pop('EXISTS', None) or imap.untagged_responses.pop('RECENT', None):
+                changed = True
+            return changed
+        except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as e:
+            print(f"ERROR [IMAP SESSION]: {e}")
+            self.reset()
+            return True
+
+    def _idle(self, imap, timeout):
+        """Run one IDLE command and return True if EXISTS/RECENT arrived"""
+        tag = imap._new_tag()
+        imap.send(tag + b' IDLE\r\n')
+
+        line = imap.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.abort(f"IDLE rejected: {line!r}")
+
+        changed = False
+        deadline = time.monotonic() + timeout
+        sock = imap.sock
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # Responses may already sit in imaplib's read buffer (or, over SSL,
+            # decrypted in the socket) where select() can't see them
+            if not self._buffered(imap):
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if not readable:
+                    break
+
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            if line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort(line.decode(errors='replace').strip())
+            if line.endswith(b'EXISTS\r\n') or line.endswith(b'RECENT\r\n'):
+                changed = True
+                break
+
+        # Leave IDLE and drain until our tagged completion
+        imap.send(b'DONE\r\n')
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+            if line.startswith(tag):
+                break
+            if line.endswith(b'EXISTS\r\n') or line.endswith(b'RECENT\r\n'):
+                changed = True
+
+        return changed
+
+    @staticmethod
+    def _buffered(imap):
+        """Return True if a response can be read from imap.file without waiting"""
+        sock = imap.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            # peek() returns what's buffered, or makes one non-blocking read
+            return bool(imap.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def reset(self):
+        """Drop the current connection; the next ensure() reconnects"""
+        if self.imap is not None:
+            self._shutdown(self.imap)
+        self.imap = None
+
+    def close(self):
+        """Log out and release the connection"""
+        self.reset()
+
+    @staticmethod
+    def _shutdown(imap):
+        try:
+            imap.logout()
+        except Exception:
+            pass
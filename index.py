@@ -1,457 +1,688 @@
 import imaplib
 import smtplib
-import email
-from email.header import decode_header
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
-import json
+import sys
+import hashlib
+import re
 import time
 import threading
+from itertools import chain, zip_longest
 from dotenv import load_dotenv
-from ai_service import email_ai_response
-from flask import Flask, jsonify, request
+from accounts import configured_accounts
+from ai_service import CANNED_REPLY, LLMUnavailable, email_ai_response, rate_limiter
+from archive import Archive
+from change_feed import ChangeFeed
+from imap_fetch import fetch_messages
+from preprocess import build_prompt
+import metrics
+from imap_session import ImapSession
+from read_model import ReadModel
+from response_cache import ResponseCache, first_name, personalize
+from scheduler import ReplyScheduler
+from seen import SeenSet
+from smtp_pool import OutboundQueue, SmtpPool
+from storage import MailStore
+from threads import ThreadIndex, reference_chain
+from worker_pool import WorkerPool
 
 # Load environment variables
 load_dotenv()
 
-# Get credentials from .env file
-EMAIL = os.getenv('EMAIL')
-PASSWORD = os.getenv('PASSWORD')
-
-# Initialize Flask app
-app = Flask(__name__)
-
-# Ensure logs directory exists
-os.makedirs('./logs', exist_ok=True)
+# Mailboxes served by this process: every account in ACCOUNTS_FILE, or the
+# EMAIL/PASSWORD account from .env (mail servers default to Gmail; see
+# accounts.py). PARTITION=i/n splits the accounts across n processes.
+ACCOUNTS = configured_accounts()
+ACCOUNTS_BY_NAME = {account.name: account for account in ACCOUNTS}
 
+# Legacy JSON logs, imported into the database on first start
 ALL_MAIL_FILE = './logs/AllMail.json'
 UNREAD_MAIL_FILE = './logs/UnreadMail.json'
 RESPONDED_MAIL_FILE = './logs/RespondedMail.json'
 
-def connect_to_gmail():
-    """Connect to Gmail using IMAP"""
+# Mail, responses and sync state live in SQLite
+# Any number of processes may run the process role against one database:
+# claimed outbox rows are leased for OUTBOX_LEASE_SECONDS, renewed by a
+# heartbeat, and reclaimed by another process once they expire
+store = MailStore(lease_seconds=float(os.getenv('OUTBOX_LEASE_SECONDS', '120')))
+
+# Message-IDs of every mail ever stored, archived ones included, as 64-bit
+# hashes; mail already seen is skipped before its body is downloaded
+seen = SeenSet(store)
+
+# In-memory snapshot for the API, updated by the fetch and process stages
+read_model = ReadModel(store)
+
+# Wakes /changes long-polls and /events streams when the change log grows
+change_feed = ChangeFeed(store)
+
+# Cache of AI replies for repeated questions (RESPONSE_CACHE=0 disables it)
+response_cache = ResponseCache(
+    store,
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '5000')),
+    ttl=float(os.getenv('RESPONSE_CACHE_TTL', str(7 * 24 * 3600))),
+    similarity=float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0.9'))
+) if os.getenv('RESPONSE_CACHE', '1') != '0' else None
+
+# Earlier turns of a conversation sent along with a follow-up, in tokens
+thread_index = ThreadIndex(store, budget=int(os.getenv('THREAD_CONTEXT_BUDGET', '400')))
+
+# Settled mail older than ARCHIVE_AFTER_DAYS moves to compressed monthly
+# segments under logs/archive (0 disables); segments older than
+# ARCHIVE_KEEP_MONTHS are deleted (0 keeps them forever)
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', str(6 * 3600)))
+archive = Archive(
+    store,
+    after_days=float(os.getenv('ARCHIVE_AFTER_DAYS', '90')),
+    keep_months=int(os.getenv('ARCHIVE_KEEP_MONTHS', '0'))
+)
+
+# Answer with a short "please try again later" when no model can reply in
+# time (LLM_DEADLINE, see ai_service.py); CANNED_REPLY=0 retries instead
+CANNED_REPLIES = os.getenv('CANNED_REPLY', '1') != '0'
+
+# Reply workers and how many mails may wait for one
+REPLY_WORKERS = int(os.getenv('REPLY_WORKERS', '4'))
+REPLY_QUEUE_SIZE = int(os.getenv('REPLY_QUEUE_SIZE', '100'))
+
+# Token budget for a mail's subject and body in the prompt (quotes, signatures and noise are stripped first)
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '1500'))
+
+# Reply scheduling: VIP sender domains go first, each sender is capped per hour
+VIP_DOMAINS = [domain.strip() for domain in os.getenv('VIP_DOMAINS', '').split(',') if domain.strip()]
+SENDER_RATE_PER_HOUR = float(os.getenv('SENDER_RATE_PER_HOUR', '30'))
+SENDER_BURST = int(os.getenv('SENDER_BURST', '5'))
+SENDER_QUEUE_LIMIT = int(os.getenv('SENDER_QUEUE_LIMIT', '10'))
+
+# "threads" (default) or "async": fetch, reply and API stages on one asyncio
+# event loop (see async_runtime.py; uvicorn and asgiref serve the API there)
+RUNTIME = os.getenv('RUNTIME', 'threads')
+ASYNC_REPLY_WORKERS = int(os.getenv('ASYNC_REPLY_WORKERS', '32'))
+ASYNC_API_THREADS = int(os.getenv('ASYNC_API_THREADS', '64'))
+
+# Port the API listens on
+API_PORT = int(os.getenv('API_PORT', '5000'))
+
+# Authenticated SMTP sessions kept open for replies
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '2'))
+
+# Roles one process can take: fetch mail over IMAP, process replies (LLM
+# and SMTP), serve the API. mailllm.py picks them; index.py runs all three.
+ROLES = ('fetch', 'process', 'api')
+
+# Seconds between checks for mail stored by a fetch role in another process
+MAIL_WATCH_INTERVAL = float(os.getenv('MAIL_WATCH_INTERVAL', '1'))
+
+# Flask app for the API role, built by setup_api()
+app = None
+
+# Number of recent emails fetched on first sync or after a UIDVALIDITY reset
+BACKFILL_EMAILS = 10
+
+# Set by the fetch thread whenever new mail lands, wakes the process thread
+new_mail_event = threading.Event()
+
+@metrics.timed('imap_connect')
+def connect_to_gmail(account):
+    """Connect to an account's mailbox using IMAP"""
     try:
-        # Connect to Gmail's IMAP server
-        imap = imaplib.IMAP4_SSL("imap.gmail.com")
+        # Connect to the account's IMAP server (Gmail unless configured otherwise)
+        if account.imap_ssl:
+            imap = imaplib.IMAP4_SSL(account.imap_host, account.imap_port)
+        else:
+            imap = imaplib.IMAP4(account.imap_host, account.imap_port)
         
         # Login
-        if EMAIL and PASSWORD:
-            imap.login(EMAIL, PASSWORD)
+        if account.email and account.password:
+            imap.login(account.email, account.password)
         else:
-            print("ERROR: Email or password not found")
+            print(f"ERROR: Email or password not found for account {account.name}")
             return None
         
         return imap
     except Exception as e:
-        print(f"ERROR connecting to Gmail: {e}")
+        print(f"ERROR connecting to {account.name} IMAP: {e}")
         return None
 
-def get_emails(imap, folder="INBOX", num_emails=10, only_unread=False):
-    """Fetch emails from specified folder and return as list"""
-    emails_list = []
+@metrics.timed('imap_fetch')
+def get_new_emails(imap, folder="INBOX", backfill=10, account="default"):
+    """Fetch only messages above the stored UID high-water mark for this folder.
+    
+    Returns (emails, state). The caller persists state once the emails are saved,
+    so a crash in between refetches rather than skips.
+    """
+    state = store.get_sync_state(folder, account)
+    
+    # Select the mailbox and read its UIDVALIDITY / UIDNEXT
+    status, _ = imap.select(f'"{folder}"')
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"could not select {folder}")
+    
+    uid_validity = int(imap.response('UIDVALIDITY')[1][0])
+    uid_next = imap.response('UIDNEXT')[1][0]
+    if uid_next is None:
+        # Not every server sends UIDNEXT on SELECT
+        status, data = imap.status(f'"{folder}"', '(UIDNEXT)')
+        uid_next = re.search(rb'UIDNEXT (\d+)', data[0]).group(1)
+    uid_next = int(uid_next)
     
+    # First run or UIDVALIDITY reset: old UIDs mean nothing any more, so start
+    # again just below UIDNEXT and let Message-ID dedupe catch repeats
+    if state.get('uidvalidity') != uid_validity:
+        if state:
+            print(f"UIDVALIDITY changed for {folder}, resyncing")
+        state = {
+            "uidvalidity": uid_validity,
+            "last_uid": max(uid_next - 1 - backfill, 0)
+        }
+    
+    last_uid = state['last_uid']
+    if uid_next <= last_uid + 1:
+        return [], state
+    
+    # One batched, header-first UID FETCH for everything above the high-water mark
+    emails_list = fetch_messages(imap, f"{last_uid + 1}:*", min_uid=last_uid + 1, seen=seen)
+    
+    # Everything below UIDNEXT was covered, including mail skipped as already seen
+    state['last_uid'] = max(state['last_uid'], uid_next - 1, emails_list[0]['uid'] if emails_list else 0)
+    
+    return emails_list, state
+
+@metrics.timed('smtp_connect')
+def connect_to_smtp(account):
+    """Open an authenticated SMTP session for an account"""
     try:
-        # Select the mailbox (folder)
-        status, messages = imap.select(folder)
-        
-        # Search for emails based on read/unread status
-        if only_unread:
-            # Search for unread emails
-            status, email_ids = imap.search(None, 'UNSEEN')
-        else:
-            # Get all emails
-            status, email_ids = imap.search(None, 'ALL')
-        
-        # Convert to list of IDs
-        email_id_list = email_ids[0].split()
-        
-        if not email_id_list:
-            return []
+        if not (account.email and account.password):
+            print(f"ERROR: Email or password not found for account {account.name}")
+            return None
         
-        # Get the last 'num_emails' or all unread emails
-        if only_unread:
-            # For unread, get all of them
-            ids_to_fetch = email_id_list
+        # Connect to the account's SMTP server (Gmail unless configured otherwise)
+        if account.smtp_ssl:
+            server = smtplib.SMTP_SSL(account.smtp_host, account.smtp_port)
         else:
-            # For all emails, get the last num_emails
-            ids_to_fetch = email_id_list[-num_emails:] if len(email_id_list) > num_emails else email_id_list
-        
-        for email_id in reversed(ids_to_fetch):
-            # Fetch the email by ID
-            res, msg = imap.fetch(email_id, "(RFC822)")
-            
-            for response in msg:
-                if isinstance(response, tuple):
-                    # Parse the email content
-                    msg = email.message_from_bytes(response[1])
-                    
-                    # Decode email subject
-                    subject, encoding = decode_header(msg["Subject"])[0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(encoding if encoding else "utf-8")
-                    
-                    # Get sender
-                    from_ = msg.get("From")
-                    
-                    # Get date
-                    date = msg.get("Date")
-                    
-                    # Get Message-ID for unique identification
-                    message_id = msg.get("Message-ID")
-                    
-                    # Get email body
-                    body_text = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            content_type = part.get_content_type()
-                            content_disposition = str(part.get("Content-Disposition"))
-                            
-                            try:
-                                body = part.get_payload(decode=True)
-                                if body and content_type == "text/plain" and "attachment" not in content_disposition:
-                                    if isinstance(body, bytes):
-                                        body_text = body.decode()
-                                    else:
-                                        body_text = str(body)
-                                    break
-                            except:
-                                pass
-                    else:
-                        # Simple email
-                        body = msg.get_payload(decode=True)
-                        if body:
-                            if isinstance(body, bytes):
-                                body_text = body.decode()
-                            else:
-                                body_text = str(body)
-                    
-                    # Create email dict
-                    email_data = {
-                        "message_id": message_id,
-                        "subject": subject,
-                        "from": from_,
-                        "date": date,
-                        "body": body_text
-                    }
-                    
-                    emails_list.append(email_data)
-        
+            server = smtplib.SMTP(account.smtp_host, account.smtp_port)
+        server.login(account.email, account.password)
+        return server
     except Exception as e:
-        print(f"ERROR fetching emails: {e}")
+        print(f"ERROR connecting to {account.name} SMTP: {e}")
+        return None
+
+# A few logged-in SMTP sessions per account, shared by all reply workers
+outbound_queues = {}
+outbound_lock = threading.Lock()
+
+def outbound_for(account):
+    """Return the account's outbound queue, creating it on first use"""
+    with outbound_lock:
+        outbound = outbound_queues.get(account.name)
+        if outbound is None:
+            pool = SmtpPool(lambda: connect_to_smtp(account), size=SMTP_POOL_SIZE)
+            outbound = outbound_queues[account.name] = OutboundQueue(pool, senders=SMTP_POOL_SIZE)
+            metrics.gauge('smtp_queue_depth', outbound.depth, account=account.name)
+        return outbound
+
+def close_smtp():
+    """Log out of every idle pooled SMTP session (on shutdown)"""
+    with outbound_lock:
+        outbounds = list(outbound_queues.values())
+    for outbound in outbounds:
+        outbound.pool.close()
+
+def reply_message_id(message_id, account):
+    """Deterministic Message-ID for our reply, so a resend can be recognised"""
+    digest = hashlib.sha1((message_id or '').encode()).hexdigest()[:24]
+    domain = (account.email or 'localhost').rpartition('@')[2]
+    return f"<mailllm.{digest}@{domain}>"
+
+def compose_email(account, to_email, subject, body, message_id=None, in_reply_to=None, references=None):
+    """Build a reply message from an account"""
+    # Create message
+    msg = MIMEMultipart()
+    msg['From'] = account.email
+    msg['To'] = to_email
+    msg['Subject'] = subject if subject.lower().startswith('re:') else f"Re: {subject}"
+    if message_id:
+        msg['Message-ID'] = message_id
     
-    return emails_list
+    # Threading headers, so mail clients show the reply in the conversation
+    if in_reply_to:
+        msg['In-Reply-To'] = in_reply_to
+    if references:
+        msg['References'] = references
+    
+    # Attach body
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+def reply_headers(mail, account):
+    """Subject and threading headers for our reply to a mail"""
+    return {
+        "subject": mail.get('subject') or 'No Subject',
+        "message_id": reply_message_id(mail.get('message_id'), account),
+        "in_reply_to": mail.get('message_id'),
+        "references": ' '.join(reference_chain(mail))
+    }
 
-def send_email(to_email, subject, body):
-    """Send email using SMTP"""
+@metrics.timed('smtp_send')
+def send_email(account, to_email, subject, body, message_id=None, in_reply_to=None, references=None):
+    """Send email from an account over a pooled SMTP session"""
     try:
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL # type: ignore
-        msg['To'] = to_email
-        msg['Subject'] = f"Re: {subject}"
-        
-        # Attach body
-        msg.attach(MIMEText(body, 'plain'))
-        
-        # Connect to Gmail SMTP server
-        server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-        if EMAIL and PASSWORD:
-            server.login(EMAIL, PASSWORD)
-        else:
-            print("ERROR: Email or password not found")
-            return False
+        msg = compose_email(account, to_email, subject, body, message_id, in_reply_to, references)
         
-        # Send email
-        server.send_message(msg)
-        server.quit()
-        
-        return True
+        # Queue it and wait for the batch it lands in to be sent
+        return outbound_for(account).send(msg)
     except Exception as e:
         print(f"ERROR sending email: {e}")
         return False
 
-def load_json_file(filepath):
-    """Load JSON file, return empty list if file doesn't exist"""
-    try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return []
-    except Exception as e:
-        print(f"ERROR loading {filepath}: {e}")
-        return []
-
-def save_json_file(filepath, data):
-    """Save data to JSON file"""
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"ERROR saving to {filepath}: {e}")
-
-def fetch_emails_thread():
-    """Thread 1: Continuously fetch emails and save to AllMail.json and UnreadMail.json"""
+def fetch_emails_thread(account=None, folder="INBOX"):
+    """Fetch thread (one per account and folder): keep an IMAP session open and store new emails as soon as IDLE reports them"""
+    
+    account = account or ACCOUNTS[0]
+    session = ImapSession(lambda: connect_to_gmail(account), folder=folder)
     
     while True:
         try:
-            # Connect to Gmail
-            imap = connect_to_gmail()
+            # Hand new mail straight to the process thread
+            if fetch_new_mail(session, account, folder):
+                new_mail_event.set()
             
-            if imap:
-                # Load existing AllMail data
-                existing_all_mails = load_json_file(ALL_MAIL_FILE)
-                existing_message_ids = {mail.get('message_id') for mail in existing_all_mails if mail.get('message_id')}
-                
-                # Get all emails from INBOX
-                all_emails = get_emails(imap, folder="INBOX", num_emails=10, only_unread=False)
-                
-                # Find new emails (not in AllMail.json)
-                unread_emails = []
-                for email_data in all_emails:
-                    if email_data.get('message_id') not in existing_message_ids:
-                        unread_emails.append(email_data)
-                
-                # Save all emails to AllMail.json
-                save_json_file(ALL_MAIL_FILE, all_emails)
-                
-                # Save only new emails to UnreadMail.json
-                save_json_file(UNREAD_MAIL_FILE, unread_emails)
-                
-                # Close connection
-                imap.close()
-                imap.logout()
-                
-            # Wait before next fetch (e.g., 60 seconds)
-            time.sleep(60)
+            # Block in IDLE until the server pushes new mail (NOOP keepalive inside)
+            session.wait_for_changes()
             
         except Exception as e:
-            print(f"ERROR [FETCH THREAD]: {e}")
-            time.sleep(60)
+            print(f"ERROR [FETCH THREAD {account.name}/{folder}]: {e}")
+            session.reset()
+            time.sleep(5)
 
-def process_emails_thread():
-    """Thread 2: Read unread emails, check if responded, and send AI responses"""
+def fetch_new_mail(session, account, folder):
+    """One fetch cycle on an open session; returns how many unread mails were stored"""
+    # Reuse the open session (reconnects with backoff if it dropped)
+    imap = session.ensure()
     
-    while True:
-        try:
-            # Load unread emails (smaller list for faster iteration)
-            unread_mails = load_json_file(UNREAD_MAIL_FILE)
-            
-            # Load responded emails
-            responded_mails = load_json_file(RESPONDED_MAIL_FILE)
-            
-            # Create a set of responded message IDs for quick lookup
-            responded_ids = {mail.get('message_id') for mail in responded_mails if mail.get('message_id')}
-            
-            # Process each unread email
-            for mail in unread_mails:
-                message_id = mail.get('message_id')
-                
-                # Skip if already responded
-                if message_id in responded_ids:
-                    continue
-                
-                # Prepare email content for AI
-                email_content = json.dumps({
-                    "subject": mail.get('subject'),
-                    "from": mail.get('from'),
-                    "date": mail.get('date'),
-                    "body": mail.get('body')
-                }, indent=2)
-                
-                # Get AI response
-                ai_response = email_ai_response(email_content)
-                
-                # Extract email address from "from" field
-                from_field = mail.get('from', '')
-                # Simple regex to extract email
-                import re
-                email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_field)
-                to_email = email_match.group(0) if email_match else None
-                
-                if to_email:
-                    # Send email
-                    success = send_email(
-                        to_email=to_email,
-                        subject=mail.get('subject', 'No Subject'),
-                        body=ai_response
-                    )
-                    
-                    if success:
-                        # Add to responded mails
-                        responded_mail_entry = {
-                            "message_id": message_id,
-                            "original_subject": mail.get('subject'),
-                            "original_from": mail.get('from'),
-                            "responded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                            "response": ai_response
-                        }
-                        
-                        responded_mails.append(responded_mail_entry)
-                        save_json_file(RESPONDED_MAIL_FILE, responded_mails)
-                else:
-                    print(f"ERROR: Could not extract email address from: {from_field}")
-            
-            # Wait before next processing cycle (e.g., 30 seconds)
-            time.sleep(30)
-            
-        except Exception as e:
-            print(f"ERROR [PROCESS THREAD]: {e}")
-            time.sleep(30)
+    # Fetch only messages above the UID high-water mark
+    new_emails, state = get_new_emails(imap, folder=folder, backfill=BACKFILL_EMAILS, account=account.name)
+    
+    # Store them; mail seen before was dropped by the fetch, and the unique
+    # Message-ID index catches anything else
+    unread_emails = store.add_mails(new_emails, folder=folder, account=account.name)
+    metrics.inc('mails_fetched_total', len(unread_emails), account=account.name)
+    
+    # Advance the high-water mark only after the emails are stored
+    store.set_sync_state(folder, state, account=account.name)
+    return len(unread_emails)
 
-def flask_server_thread():
-    """Thread 3: Run Flask server for API endpoints"""
+def prepare_reply(mail):
+    """Return (cached reply or None, prompt, thread context) for one mail"""
+    # Follow-ups carry a summary of the thread instead of the quoted history;
+    # their answer depends on it, so they bypass the cache
+    context = thread_index.context(mail)
+    
+    # Repeated questions are answered from the cache with a fresh salutation
+    if response_cache is not None and not context:
+        cached = response_cache.get(mail.get('subject'), mail.get('body'))
+        if cached:
+            metrics.inc('response_cache_total', result='hit')
+            return personalize(cached, mail.get('from') or ''), None, context
+        metrics.inc('response_cache_total', result='miss')
     
-    @app.route('/all', methods=['GET'])
-    def get_all_emails():
-        """API endpoint to get all emails"""
+    # Compact plain-text prompt: quoted history, signatures and noise removed, body within budget
+    email_content, tokens_before, tokens_after = build_prompt(mail, PROMPT_TOKEN_BUDGET)
+    metrics.inc('prompt_tokens_saved_total', tokens_before - tokens_after)
+    metrics.observe('prompt_tokens_saved', tokens_before - tokens_after, buckets=metrics.TOKEN_BUCKETS)
+    return None, email_content, context
+
+def cache_reply(mail, context, ai_response):
+    """Keep a fresh LLM reply for repeats of the same question"""
+    if response_cache is not None and not context:
+        response_cache.put(mail.get('subject'), mail.get('body'), ai_response)
+
+def generate_reply(mail):
+    """Ask the cache or the LLM for a reply to one mail"""
+    cached, email_content, context = prepare_reply(mail)
+    if cached:
+        return cached
+    
+    # Get AI response (waits for RPM/TPM budget, backs off on 429, falls back to a faster model)
+    try:
+        ai_response = email_ai_response(email_content, context=context or None)
+    except LLMUnavailable as e:
+        return canned_reply(mail, e)
+    cache_reply(mail, context, ai_response)
+    return ai_response
+
+def canned_reply(mail, error):
+    """Stand-in reply when no model answered in time; never cached"""
+    if not CANNED_REPLIES:
+        raise error
+    metrics.inc('llm_canned_replies_total')
+    print(f"Sending a canned reply to {mail.get('message_id')}: {error}")
+    return CANNED_REPLY.format(name=first_name(mail.get('from') or ''))
+
+def reply_failed(mail, error, permanent=False):
+    """Back the mail off in the outbox, dead-lettering it after too many attempts"""
+    state = store.outbox_failed(mail.get('message_id'), error, permanent=permanent)
+    metrics.inc('replies_failed_total', account=mail.get('account'))
+    if state == 'dead':
+        metrics.inc('outbox_dead_total')
+        print(f"ERROR: giving up on {mail.get('message_id')}: {error}")
+
+def reply_target(mail):
+    """Return (account, recipient address) for a reply, or None if it can't be sent"""
+    # Replies go out from the mailbox the mail arrived in
+    account = ACCOUNTS_BY_NAME.get(mail.get('account'))
+    if account is None:
+        return None
+    
+    # Extract email address from "from" field
+    from_field = mail.get('from') or ''
+    # Simple regex to extract email
+    email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_field)
+    to_email = email_match.group(0) if email_match else None
+    
+    if not to_email:
+        print(f"ERROR: Could not extract email address from: {from_field}")
+        reply_failed(mail, f"no address in {from_field!r}", permanent=True)
+        return None
+    return account, to_email
+
+def reply_sent(mail, account, ai_response):
+    """Record a reply SMTP accepted: mark the mail responded, the outbox row sent, and thread it"""
+    if store.mark_responded(mail, ai_response) is None:
+        # Our lease ran out mid-send and another process owns the row now
+        print(f"Lease lost while sending {mail.get('message_id')}; the new owner settles it")
+        metrics.inc('replies_lease_lost_total', account=account.name)
+        return
+    thread_index.record(mail, ai_response, reply_message_id(mail.get('message_id'), account))
+    metrics.inc('replies_sent_total', account=account.name)
+    
+    # End to end: server arrival (INTERNALDATE) to reply accepted by SMTP
+    if mail.get('received_at'):
+        metrics.observe('reply_latency_seconds', time.time() - mail['received_at'])
+
+def reply_to_email(mail):
+    """Drive one mail through the outbox: generate, save the draft, send (runs on a worker thread)"""
+    message_id = mail.get('message_id')
+    
+    target = reply_target(mail)
+    if target is None:
+        return
+    account, to_email = target
+    
+    ai_response = mail.get('draft')
+    if mail.get('state') == 'received':
+        # Claim generation; another worker or process may already own it
+        if not store.transition(message_id, 'received', 'generating'):
+            return
         try:
-            # Get number of emails from query parameter (default: all)
-            num_emails = request.args.get('num', default=None, type=int)
-            
-            # Load all emails
-            emails = load_json_file(ALL_MAIL_FILE)
-            
-            # Limit if num is specified
-            if num_emails:
-                emails = emails[:num_emails]
-            
-            return jsonify({
-                "success": True,
-                "type": "all",
-                "count": len(emails),
-                "emails": emails
-            })
+            ai_response = generate_reply(mail)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            reply_failed(mail, e)
+            return
+        
+        # Save the draft before sending so a retry never pays for it again;
+        # if our lease expired and another process took the mail, stop here
+        if not store.transition(message_id, 'generating', 'generated', draft=ai_response):
+            return
+    
+    # Claim the send; the row stays 'sending' until SMTP accepts it
+    if not store.transition(message_id, 'generated', 'sending'):
+        return
     
-    @app.route('/unread', methods=['GET'])
-    def get_unread_emails():
-        """API endpoint to get unread emails"""
+    # Send email
+    success = send_email(account, to_email=to_email, body=ai_response, **reply_headers(mail, account))
+    
+    if success:
+        reply_sent(mail, account, ai_response)
+    else:
+        reply_failed(mail, "SMTP send failed")
+
+def recover_outbox():
+    """Finish or requeue replies whose process died or stalled (expired leases), without calling the LLM again"""
+    in_flight = store.recover_outbox(accounts=list(ACCOUNTS_BY_NAME))
+    if not in_flight:
+        return
+    
+    # A reply stuck in 'sending' may already have gone out: look for its
+    # Message-ID in the account's Sent folder before sending it again
+    sent = set()
+    for account in ACCOUNTS:
+        mails = [mail for mail in in_flight if mail.get('account') == account.name]
+        if not mails:
+            continue
+        
+        imap = connect_to_gmail(account)
+        if imap is None:
+            continue
         try:
-            # Get number of emails from query parameter (default: all)
-            num_emails = request.args.get('num', default=None, type=int)
-            
-            # Load unread emails
-            emails = load_json_file(UNREAD_MAIL_FILE)
-            
-            # Limit if num is specified
-            if num_emails:
-                emails = emails[:num_emails]
-            
-            return jsonify({
-                "success": True,
-                "type": "unread",
-                "count": len(emails),
-                "emails": emails
-            })
+            status, _ = imap.select(f'"{account.sent_folder}"', readonly=True)
+            if status == 'OK':
+                for mail in mails:
+                    reply_id = reply_message_id(mail.get('message_id'), account)
+                    status, data = imap.uid('SEARCH', None, 'HEADER', 'Message-ID', f'"{reply_id}"')
+                    if status == 'OK' and data and data[0]:
+                        sent.add(mail.get('message_id'))
+            imap.logout()
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            print(f"ERROR checking {account.name} {account.sent_folder}: {e}")
+    
+    for mail in in_flight:
+        if mail.get('message_id') in sent:
+            if store.mark_responded(mail, mail.get('draft')) is None:
+                continue
+            account = ACCOUNTS_BY_NAME[mail.get('account')]
+            thread_index.record(mail, mail.get('draft'), reply_message_id(mail.get('message_id'), account))
+        else:
+            # Not found (or couldn't check): resend with the same Message-ID
+            store.transition(mail.get('message_id'), 'sending', 'generated')
     
-    @app.route('/responded', methods=['GET'])
-    def get_responded_emails():
-        """API endpoint to get responded emails"""
+    print(f"Recovered {len(in_flight)} interrupted replies ({len(sent)} already sent)")
+
+def reply_scheduler(wakeup):
+    """Queue for the reply workers; `wakeup` is set when mail it turned away can be offered again"""
+    # Workers take the most urgent eligible mail: overdue first, then VIPs,
+    # then whoever has had the least service; flooding senders and large
+    # prompts wait when the Groq quota runs low
+    return ReplyScheduler(
+        maxsize=REPLY_QUEUE_SIZE,
+        vip_domains=VIP_DOMAINS,
+        headroom=rate_limiter.headroom,
+        sender_rate=SENDER_RATE_PER_HOUR,
+        sender_burst=SENDER_BURST,
+        sender_limit=SENDER_QUEUE_LIMIT,
+        wakeup=wakeup
+    )
+
+def due_mail():
+    """Mails whose next attempt is due, in the order to offer them"""
+    # Interleave accounts and take only each sender's oldest few, so a
+    # backlog in one mailbox or from one sender can't hold up the rest
+    pending = [
+        store.pending_mails(limit=REPLY_QUEUE_SIZE, account=account.name, per_sender=SENDER_QUEUE_LIMIT)
+        for account in ACCOUNTS
+    ]
+    return [mail for mail in chain.from_iterable(zip_longest(*pending)) if mail is not None]
+
+def queue_due_mail(submit):
+    """Offer mails whose next attempt is due to submit(key, mail, group)"""
+    # Whatever the scheduler has no room for stays in the outbox until it
+    # wakes us again
+    for mail in due_mail():
+        submit(mail.get('message_id'), mail, group=mail.get('account'))
+
+def next_check_in():
+    """Seconds until the outbox should be read again: the next backed-off retry, at most 30"""
+    next_attempt = store.next_attempt_at()
+    return 30 if next_attempt is None else min(max(next_attempt - time.time(), 1), 30)
+
+def process_emails_thread():
+    """Process thread: feed due outbox entries from every account into one shared reply worker pool"""
+    
+    pool = WorkerPool(reply_to_email, workers=REPLY_WORKERS, name="reply", queue=reply_scheduler(new_mail_event))
+    pool.start()
+    metrics.gauge('reply_queue_depth', pool.depth)
+    
+    while True:
         try:
-            # Get number of emails from query parameter (default: all)
-            num_emails = request.args.get('num', default=None, type=int)
+            # Clear before reading so a signal raised mid-cycle isn't lost
+            new_mail_event.clear()
             
-            # Load responded emails
-            emails = load_json_file(RESPONDED_MAIL_FILE)
+            queue_due_mail(pool.submit)
             
-            # Limit if num is specified
-            if num_emails:
-                emails = emails[:num_emails]
+            # Wait for new mail or the next backed-off retry
+            new_mail_event.wait(next_check_in())
             
-            return jsonify({
-                "success": True,
-                "type": "responded",
-                "count": len(emails),
-                "emails": emails
-            })
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            print(f"ERROR [PROCESS THREAD]: {e}")
+            time.sleep(30)
+
+def run_compaction():
+    """Archive settled mail past the retention window and expire old segments"""
     
-    @app.route('/receive', methods=['GET'])
-    def receive_emails():
-        """API endpoint to receive emails from JSON files"""
-        try:
-            # Get type parameter (default: 'unread')
-            mail_type = request.args.get('type', default='unread', type=str)
-            
-            if mail_type == 'all':
-                emails = load_json_file(ALL_MAIL_FILE)
-            elif mail_type == 'unread':
-                emails = load_json_file(UNREAD_MAIL_FILE)
-            elif mail_type == 'responded':
-                emails = load_json_file(RESPONDED_MAIL_FILE)
-            else:
-                return jsonify({"error": "Invalid type. Use 'all', 'unread', or 'responded'"}), 400
-            
-            return jsonify({
-                "success": True,
-                "type": mail_type,
-                "count": len(emails),
-                "emails": emails
-            })
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
+    try:
+        archived = archive.compact()
+        expired = archive.expire()
+        if archived or expired:
+            print(f"Archived {archived} mails, removed {expired} old segments")
+    except Exception as e:
+        print(f"ERROR [ARCHIVE]: {e}")
+
+def lease_thread():
+    """Renew this process's outbox leases and reclaim expired ones, every third of a lease"""
+    
+    while True:
+        time.sleep(store.lease_seconds / 3)
+        maintain_leases()
+
+def maintain_leases():
+    """One heartbeat: extend our leases, then pick up rows other processes abandoned"""
+    
+    try:
+        store.renew_leases()
+        recover_outbox()
+    except Exception as e:
+        print(f"ERROR [LEASES]: {e}")
+
+def archive_thread():
+    """Compact the mail database every ARCHIVE_INTERVAL seconds"""
+    
+    while True:
+        run_compaction()
+        time.sleep(ARCHIVE_INTERVAL)
+
+def mail_watch_thread():
+    """Wake the process stage when a fetch role in another process stores mail"""
     
-    @app.route('/stats', methods=['GET'])
-    def get_stats():
-        """API endpoint to get email statistics"""
+    last = store.version()
+    while True:
+        time.sleep(MAIL_WATCH_INTERVAL)
         try:
-            all_mails = load_json_file(ALL_MAIL_FILE)
-            unread_mails = load_json_file(UNREAD_MAIL_FILE)
-            responded_mails = load_json_file(RESPONDED_MAIL_FILE)
-            
-            return jsonify({
-                "success": True,
-                "stats": {
-                    "total_emails": len(all_mails),
-                    "unread_emails": len(unread_mails),
-                    "responded_emails": len(responded_mails)
-                }
-            })
+            current = store.version()
+            if current != last:
+                last = current
+                new_mail_event.set()
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
-    
-    @app.route('/', methods=['GET'])
-    def home():
-        """Home endpoint"""
-        return jsonify({
-            "message": "MailLLM Server API",
-            "status": "running",
-            "endpoints": {
-                "/all": "GET - Get all emails (query param: ?num=10)",
-                "/unread": "GET - Get unread emails (query param: ?num=10)",
-                "/responded": "GET - Get responded emails (query param: ?num=10)",
-                "/receive": "GET - Receive emails (query param: ?type=unread|all|responded)",
-                "/stats": "GET - Get email statistics"
-            }
-        })
+            print(f"ERROR [MAIL WATCH]: {e}")
+
+def setup_api():
+    """Build the Flask app for the API endpoints (once) and return it"""
+    global app
+    
+    if app is None:
+        # Imported here so the fetch and process roles never load Flask
+        from api import create_app
+        
+        # Mail endpoints shared with the API-only role, answered from the in-memory read model
+        app = create_app(store, read_model, archive, change_feed, message="MailLLM Server API", status="running")
+    return app
+
+def flask_server_thread():
+    """Thread 3: Run Flask server for API endpoints"""
     
     # Run Flask server
-    app.run(debug=False, host='0.0.0.0', port=5000, use_reloader=False)
+    setup_api().run(debug=False, host='0.0.0.0', port=API_PORT, use_reloader=False)
 
-def main():
-    """Main function to start both threads"""
+def main(roles=ROLES):
+    """Start the enabled roles (all three by default) and wait"""
     
-    if not EMAIL or not PASSWORD:
-        print("ERROR: EMAIL and PASSWORD must be set in .env file")
+    roles = set(roles)
+    if roles & {'fetch', 'process'}:
+        if not ACCOUNTS:
+            print("ERROR: no accounts to serve (check ACCOUNTS_FILE and PARTITION)")
+            return
+        
+        for account in ACCOUNTS:
+            if not account.email or not account.password:
+                print(f"ERROR: EMAIL and PASSWORD must be set for account {account.name} (.env or ACCOUNTS_FILE)")
+                return
+    
+    # Ensure logs directory exists
+    os.makedirs('./logs', exist_ok=True)
+    
+    if roles & {'fetch', 'process'}:
+        # Carry over history from the old JSON logs
+        store.import_json_logs(ALL_MAIL_FILE, UNREAD_MAIL_FILE, RESPONDED_MAIL_FILE)
+    
+    if 'fetch' in roles:
+        # Load the seen Message-IDs and add every mail stored from here on
+        seen.attach()
+    
+    if 'process' in roles:
+        # Settle replies a previous run left mid-flight before any worker starts
+        recover_outbox()
+        for state in ('received', 'generating', 'generated', 'sending', 'dead'):
+            metrics.gauge('outbox_rows', lambda state=state: store.outbox_counts().get(state, 0), state=state)
+    
+    if 'api' in roles:
+        # Load the API snapshot and follow every write from here on; with
+        # no writer in this process, reload when the database changes
+        if roles & {'fetch', 'process'}:
+            read_model.attach()
+        else:
+            read_model.watch()
+        # Writes in this process wake waiting clients at once; a role
+        # running elsewhere is picked up by polling the change log
+        if roles >= {'fetch', 'process'}:
+            change_feed.attach()
+        else:
+            change_feed.watch()
+        metrics.gauge('unread_backlog', lambda: read_model.snapshot().counts["unread_emails"])
+    
+    enabled = ', '.join(role for role in ROLES if role in roles)
+    if RUNTIME == 'async':
+        import asyncio
+        from async_runtime import AsyncRuntime
+        
+        print(f"MailLLM Server Running for {len(ACCOUNTS)} account(s) on asyncio ({enabled})... (Press Ctrl+C to stop)")
+        if 'api' in roles:
+            print(f"API available at http://localhost:{API_PORT}")
+        asyncio.run(AsyncRuntime(sys.modules[__name__], workers=ASYNC_REPLY_WORKERS, roles=roles, api_threads=ASYNC_API_THREADS).run())
         return
     
-    # Create threads
-    fetch_thread = threading.Thread(target=fetch_emails_thread, daemon=True)
-    process_thread = threading.Thread(target=process_emails_thread, daemon=True)
-    flask_thread = threading.Thread(target=flask_server_thread, daemon=True)
+    # Create threads: one fetcher per account and folder, one shared processor
+    threads = []
+    if 'fetch' in roles:
+        threads.extend(
+            threading.Thread(target=fetch_emails_thread, args=(account, folder), name=f"fetch-{account.name}-{folder}", daemon=True)
+            for account in ACCOUNTS for folder in account.folders
+        )
+    if 'process' in roles:
+        threads.append(threading.Thread(target=process_emails_thread, daemon=True))
+        threads.append(threading.Thread(target=archive_thread, name="archive", daemon=True))
+        threads.append(threading.Thread(target=lease_thread, name="leases", daemon=True))
+        if 'fetch' not in roles:
+            threads.append(threading.Thread(target=mail_watch_thread, name="mail-watch", daemon=True))
+    if 'api' in roles:
+        threads.append(threading.Thread(target=flask_server_thread, daemon=True))
     
     # Start threads
-    fetch_thread.start()
-    process_thread.start()
-    flask_thread.start()
+    for thread in threads:
+        thread.start()
     
-    print("MailLLM Server Running... (Press Ctrl+C to stop)")
-    print("Flask API available at http://localhost:5000")
+    print(f"MailLLM Server Running for {len(ACCOUNTS)} account(s) ({enabled})... (Press Ctrl+C to stop)")
+    if 'api' in roles:
+        print(f"Flask API available at http://localhost:{API_PORT}")
     
     try:
         # Keep main thread alive
@@ -459,6 +690,10 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         print("\nStopping...")
+        if 'process' in roles:
+            # Replies cut off here can be picked up by another process right away
+            store.release_leases()
+            close_smtp()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,81 @@
+# MailLLM command line: run any mix of the fetch, process and api roles.
+#
+#   python mailllm.py                        # everything in one process (same as index.py)
+#   python mailllm.py --role api             # read-only API replica
+#   python mailllm.py --role fetch,process   # mail roles, no API
+#
+# Only the modules a role needs are imported: the api role never loads
+# Groq, IMAP, SMTP or the MIME parser, and fetch/process never load Flask.
+import argparse
+import os
+
+# What each role does; 'all' is every role in one process
+ROLES = {
+    "fetch": "fetch new mail over IMAP into the database",
+    "process": "answer stored mail with the LLM and send the replies (plus archiving)",
+    "api": "serve the HTTP API from the database"
+}
+
+
+def parse_roles(values):
+    """Turn --role values (repeatable, comma-separated, 'all') into a set of role names"""
+    roles = set()
+    for value in values:
+        for role in value.split(','):
+            role = role.strip().lower()
+            if not role:
+                continue
+            if role == 'all':
+                roles.update(ROLES)
+            elif role in ROLES:
+                roles.add(role)
+            else:
+                raise ValueError(f"Unknown role {role!r}; use {', '.join(ROLES)} or all")
+    return roles or set(ROLES)
+
+
+def api_app():
+    """Flask app for the api role on its own: a read replica of the mail database"""
+    from dotenv import load_dotenv
+    from api import create_app
+    from archive import Archive
+    from change_feed import ChangeFeed
+    from read_model import ReadModel
+    from storage import MailStore
+
+    # Load environment variables
+    load_dotenv()
+
+    # Read from the same database the fetch and process roles write to, and
+    # reload the in-memory snapshot only when it changes
+    store = MailStore()
+    return create_app(store, ReadModel(store).watch(), Archive(store), ChangeFeed(store).watch(),
+                      message="MailLLM Email API")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MailLLM: answer email with an LLM")
+    parser.add_argument(
+        '--role', action='append', default=[],
+        help="role to run: " + "; ".join(f"{name} ({text})" for name, text in ROLES.items())
+             + "; or all (default, or the ROLES environment variable)"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        roles = parse_roles(args.role or [os.getenv('ROLES', 'all')])
+    except ValueError as e:
+        parser.error(str(e))
+
+    if roles == {'api'}:
+        print("Starting Flask server...")
+        api_app().run(debug=False, host='0.0.0.0', port=int(os.getenv('API_PORT', '5000')), use_reloader=False)
+        return
+
+    # The mail roles share index.py's wiring (stores, pools, runtimes)
+    import index
+    index.main(roles)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+
+# Metric names are prefixed so they group together in Prometheus
+PREFIX = 'mailllm_'
+
+# Latency buckets in seconds (Prometheus histogram "le" bounds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Buckets for token counts
+TOKEN_BUCKETS = (0, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+# Recent observations kept per histogram for p50/p95/p99
+RESERVOIR_SIZE = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value):
+    """Label value with backslash, quote and newline escaped, as the text format requires"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + list(extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self):
+        values = sorted(self.recent)
+        if not values:
+            return {}
+        return {q: values[min(int(q * len(values)), len(values) - 1)] for q in QUANTILES}
+
+
+def inc(name, value=1, **labels):
+    """Add to a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Record one observation in a histogram"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram(buckets)
+        histogram.observe(value)
+
+
+def gauge(name, value, **labels):
+    """Set a gauge to a number, or to a callable evaluated at scrape time"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def timed(name, **labels):
+    """Decorator recording call latency in `<name>_seconds` and failures in `<name>_errors_total`"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    inc(f'{name}_errors_total', **labels)
+                    raise
+                finally:
+                    observe(f'{name}_seconds', time.perf_counter() - start, **labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                inc(f'{name}_errors_total', **labels)
+                raise
+            finally:
+                observe(f'{name}_seconds', time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def snapshot_quantiles(name, **labels):
+    """Return {quantile: value} for a histogram (handy for benchmarks)"""
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        return histogram.quantiles() if histogram else {}
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format"""
+    lines = []
+    seen = set()
+
+    def header(name, kind):
+        if name in seen:
+            return
+        seen.add(name)
+        lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items(), key=lambda item: item[0])
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+        histograms = [(key, h.buckets, list(h.counts), h.sum, h.count, h.quantiles()) for key, h in histograms]
+
+    for (name, labels), value in counters:
+        header(name, 'counter')
+        lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+
+    for (name, labels), value in gauges:
+        if callable(value):
+            try:
+                value = value()
+            except Exception:
+                continue
+        header(name, 'gauge')
+        lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+
+    recent = []
+    for (name, labels), buckets, counts, total, count, quantiles in histograms:
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+            cumulative += bucket_count
+            lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {count}')
+
+        if quantiles:
+            recent.append((name, labels, quantiles))
+
+    # Recent-window percentiles, as gauge families of their own after the
+    # histograms (a family's lines must not be split up)
+    for name, labels, quantiles in recent:
+        header(f'{name}_recent', 'gauge')
+        for q, value in quantiles.items():
+            lines.append(f'{PREFIX}{name}_recent{_format_labels(labels, [("quantile", q)])} {value}')
+
+    return '\n'.join(lines) + '\n'
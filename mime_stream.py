@@ -0,0 +1,208 @@
+import re
+from email.parser import BytesHeaderParser
+from html.parser import HTMLParser
+
+# Most bytes of a text part the streaming extractor keeps
+MAX_PART_BYTES = 64 * 1024
+
+# Header blocks are cut at this size (real ones are a few KB)
+MAX_HEADER_BYTES = 64 * 1024
+
+# A line longer than this is handled in pieces instead of buffered whole
+MAX_LINE_BYTES = 64 * 1024
+
+# Tags that start a new line of text, and tags whose content is never shown
+_BLOCK_TAGS = {
+    'address', 'article', 'blockquote', 'div', 'dl', 'dt', 'dd', 'footer', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul'
+}
+_HIDDEN_TAGS = {'head', 'script', 'style', 'title', 'template'}
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class _HtmlText(HTMLParser):
+    """Collects the visible text of an HTML body, one line per block"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = [[]]
+        self.hidden = 0
+        self.quoted = 0
+
+    def _newline(self):
+        if self.lines[-1]:
+            self.lines.append([])
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _HIDDEN_TAGS:
+            self.hidden += 1
+        elif tag == 'br' or tag in _BLOCK_TAGS:
+            self._newline()
+            if tag == 'blockquote':
+                self.quoted += 1
+            elif tag == 'li':
+                self.lines[-1].append('- ')
+
+    def handle_endtag(self, tag):
+        if tag in _HIDDEN_TAGS:
+            self.hidden = max(self.hidden - 1, 0)
+        elif tag in _BLOCK_TAGS:
+            self._newline()
+            if tag == 'blockquote':
+                self.quoted = max(self.quoted - 1, 0)
+
+    def handle_data(self, data):
+        if self.hidden:
+            return
+        # Source newlines are plain whitespace in HTML; only tags break lines.
+        # A run of whitespace becomes one space, kept at the edges so words
+        # either side of an inline tag stay apart.
+        text = _WHITESPACE.sub(' ', data)
+        if not self.lines[-1]:
+            text = text.lstrip()
+        if not text:
+            return
+        if not self.lines[-1] and self.quoted:
+            # Quoted history keeps its '>' marker so preprocessing can drop it
+            self.lines[-1].append('> ')
+        self.lines[-1].append(text)
+
+
+def html_to_text(markup):
+    """Plain text of an HTML mail body: tags, scripts and styles removed, blocks on their own lines"""
+    parser = _HtmlText()
+    parser.feed(markup or '')
+    parser.close()
+    text = '\n'.join(_WHITESPACE.sub(' ', ''.join(parts)).strip() for parts in parser.lines)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+class TextPartExtractor:
+    """Incremental MIME reader that keeps only the first readable text part.
+
+    Raw message bytes are fed in chunks, as with email.parser.BytesFeedParser,
+    but no message tree is built: each part's headers are parsed on their
+    own, attachments and other non-text payloads are skipped line by line,
+    and at most `max_bytes` of the chosen part are kept. The first inline
+    text/plain part wins; the first text/html part is kept in case there is
+    none. Once a text/plain part is complete `done` is set and the rest of
+    the input is ignored, so memory stays bounded whatever the message size.
+    """
+
+    def __init__(self, max_bytes=MAX_PART_BYTES):
+        self.max_bytes = max_bytes
+        self.pending = b''
+        # Delimiters (b'--' + boundary) of the multiparts we are inside
+        self.boundaries = []
+        # Header lines of the part being read, or None while in a body
+        self.headers = []
+        self.header_size = 0
+        # [payload, transfer encoding, charset, subtype] of the part being kept
+        self.current = None
+        self.plain = None
+        self.html = None
+        self.done = False
+
+    def feed(self, data):
+        if self.done:
+            return
+        self.pending += data
+        *lines, self.pending = self.pending.split(b'\n')
+        for line in lines:
+            self._line(line + b'\n')
+            if self.done:
+                return
+
+        # A huge unbroken line (a pasted log, say) is handled in pieces
+        if len(self.pending) > MAX_LINE_BYTES:
+            self._line(self.pending)
+            self.pending = b''
+
+    def close(self):
+        """Return (payload, encoding, charset, subtype) for the best text part, or None"""
+        # An unfinished line that may be a cut-off delimiter is dropped
+        if self.pending and not self.done and not (self.boundaries and self.pending.startswith(b'--')):
+            self._line(self.pending)
+        self.pending = b''
+
+        # A part cut off by a partial fetch still counts
+        self._finish_part()
+        return self.plain or self.html
+
+    def _line(self, line):
+        if self.headers is not None:
+            # Header block, ended by a blank line
+            if line.strip(b'\r\n'):
+                if self.header_size < MAX_HEADER_BYTES:
+                    self.headers.append(line)
+                    self.header_size += len(line)
+                return
+            self._start_body()
+            return
+
+        # Delimiter of this multipart or an enclosing one (which ends the inner ones)
+        if line.startswith(b'--') and self.boundaries:
+            stripped = line.rstrip()
+            for depth in range(len(self.boundaries) - 1, -1, -1):
+                delimiter = self.boundaries[depth]
+                if stripped == delimiter or stripped == delimiter + b'--':
+                    self._finish_part()
+                    del self.boundaries[depth + 1:]
+                    if stripped == delimiter:
+                        self.headers, self.header_size = [], 0
+                    else:
+                        # Closing delimiter: skip the epilogue
+                        self.boundaries.pop()
+                    return
+
+        current = self.current
+        if current is not None and len(current[0]) < self.max_bytes:
+            current[0] += line[:self.max_bytes - len(current[0])]
+
+    def _start_body(self):
+        headers = BytesHeaderParser().parsebytes(b''.join(self.headers))
+        self.headers = None
+        content_type = headers.get_content_type()
+
+        if headers.get_content_maintype() == 'multipart':
+            boundary = headers.get_boundary()
+            if boundary:
+                self.boundaries.append(b'--' + boundary.encode('ascii', errors='replace'))
+            return
+
+        if content_type == 'message/rfc822':
+            # A forwarded message: its own headers come next
+            self.headers, self.header_size = [], 0
+            return
+
+        if headers.get_content_disposition() == 'attachment':
+            return
+
+        wanted = (
+            (content_type == 'text/plain' and self.plain is None)
+            or (content_type == 'text/html' and self.html is None)
+        )
+        if wanted:
+            encoding = (headers.get('Content-Transfer-Encoding') or '').strip().lower()
+            charset = headers.get_content_charset() or 'utf-8'
+            self.current = [bytearray(), encoding, charset, headers.get_content_subtype()]
+
+    def _finish_part(self):
+        if self.current is None:
+            return
+        payload, encoding, charset, subtype = self.current
+        self.current = None
+
+        # The line break before a delimiter belongs to the delimiter
+        payload = bytes(payload)
+        if payload.endswith(b'\r\n'):
+            payload = payload[:-2]
+        elif payload.endswith(b'\n'):
+            payload = payload[:-1]
+
+        if subtype == 'plain':
+            self.plain = (payload, encoding, charset, subtype)
+            self.done = True
+        else:
+            self.html = (payload, encoding, charset, subtype)
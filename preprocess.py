@@ -0,0 +1,171 @@
+import html
+import json
+import re
+from email.utils import parseaddr
+
+# Most tokens a mail's subject and body may take in the prompt
+PROMPT_TOKEN_BUDGET = 1500
+
+# Share of an over-budget body kept from the start; the rest comes from the end
+HEAD_SHARE = 0.7
+
+# URLs longer than this are shortened to scheme://host/…
+MAX_URL_LENGTH = 60
+
+# Rough pre-tokenizer: words, numbers, and single punctuation marks
+_TOKEN = re.compile(r"[A-Za-z]+|\d+|[^\w\s]|_+|\S")
+
+_ATTRIBUTION = re.compile(r'^\s*On\b.{0,200}\bwrote:\s*$', re.IGNORECASE | re.DOTALL)
+_ORIGINAL_MESSAGE = re.compile(
+    r'^\s*(-{2,}\s*(Original|Forwarded) Message\s*-{2,}|_{10,}|From:\s.+)\s*$', re.IGNORECASE
+)
+_OUTLOOK_HEADER = re.compile(r'^\s*(Sent|Date|To|Subject|Cc):\s', re.IGNORECASE)
+_SIGNATURE = re.compile(
+    r'^(--|Sent from my \w+.*|Get Outlook for \w+.*|Sent from (Mail|Yahoo Mail|Outlook) for \w+.*)$',
+    re.IGNORECASE
+)
+_TAG = re.compile(r'<[^>\n]{1,500}>')
+_IMAGE_PLACEHOLDER = re.compile(r'\[(image|cid):[^\]]*\]', re.IGNORECASE)
+_URL = re.compile(r'\b(https?://[^\s/]+)(/\S*)')
+
+
+def count_tokens(text):
+    """Local token estimate: word pieces of up to 4 letters, digits in threes, punctuation"""
+    count = 0
+    for piece in _TOKEN.findall(text or ''):
+        if piece[0].isalpha():
+            count += (len(piece) + 3) // 4
+        elif piece[0].isdigit():
+            count += (len(piece) + 2) // 3
+        else:
+            count += 1
+    return count
+
+
+def strip_quoted(text):
+    """Drop '>' quoted lines, 'On ... wrote:' lines and everything below an Outlook-style header block"""
+    lines = text.splitlines()
+    kept = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line.lstrip().startswith('>'):
+            continue
+
+        # Attribution lines may wrap onto a second line
+        if _ATTRIBUTION.match(line):
+            continue
+        if i < len(lines) and _ATTRIBUTION.match(f"{line} {lines[i]}"):
+            i += 1
+            continue
+
+        # "-----Original Message-----", or "From:" followed by Sent:/To:/Subject:
+        if _ORIGINAL_MESSAGE.match(line):
+            following = lines[i:i + 3]
+            if not line.lstrip().lower().startswith('from:') or any(_OUTLOOK_HEADER.match(l) for l in following):
+                break
+        kept.append(line)
+    return '\n'.join(kept)
+
+
+def strip_signature(text):
+    """Cut at the '-- ' signature delimiter or a mobile client footer"""
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        # Never the first line, so a mail that is all signature still says something
+        if i and _SIGNATURE.match(line.strip()):
+            return '\n'.join(lines[:i])
+    return text
+
+
+def strip_markup(text):
+    """Remove leftover HTML tags/entities, image placeholders and long URL paths"""
+    text = _TAG.sub(' ', text)
+    text = html.unescape(text)
+    text = _IMAGE_PLACEHOLDER.sub('', text)
+    return _URL.sub(lambda m: m.group(0) if len(m.group(0)) <= MAX_URL_LENGTH else f"{m.group(1)}/…", text)
+
+
+def collapse_whitespace(text):
+    """Squeeze runs of spaces, fold repeated lines and drop extra blank lines"""
+    lines = []
+    repeats = 0
+    for line in text.splitlines():
+        line = ' '.join(line.split())
+        if lines and line and line == lines[-1]:
+            repeats += 1
+            continue
+        if repeats:
+            lines.append(f"[previous line repeated {repeats} more times]")
+            repeats = 0
+        if not line and (not lines or not lines[-1]):
+            continue
+        lines.append(line)
+    if repeats:
+        lines.append(f"[previous line repeated {repeats} more times]")
+    return '\n'.join(lines).strip()
+
+
+def truncate(text, budget):
+    """Keep the start and end of text within `budget` tokens, marking what was cut"""
+    if count_tokens(text) <= budget:
+        return text
+
+    lines = text.splitlines()
+    head_budget = int(budget * HEAD_SHARE)
+    tail_budget = budget - head_budget
+
+    head, used = [], 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > head_budget:
+            # A single huge line (a pasted log, say) is cut mid-line
+            if not head:
+                head.append(line[:max(head_budget * 4 - used, 0)])
+            break
+        head.append(line)
+        used += cost
+
+    tail, used = [], 0
+    for line in reversed(lines[len(head):]):
+        cost = count_tokens(line) + 1
+        if used + cost > tail_budget:
+            break
+        tail.insert(0, line)
+        used += cost
+
+    omitted = len(lines) - len(head) - len(tail)
+    return '\n'.join(head + [f"[... {max(omitted, 1)} lines omitted ...]"] + tail)
+
+
+def clean_body(body, budget=PROMPT_TOKEN_BUDGET):
+    """Run the whole cleanup pipeline on a mail body"""
+    text = (body or '').replace('\r\n', '\n')
+    text = strip_quoted(text)
+    text = strip_signature(text)
+    text = strip_markup(text)
+    text = collapse_whitespace(text)
+    return truncate(text, budget)
+
+
+def build_prompt(mail, budget=PROMPT_TOKEN_BUDGET):
+    """Return (prompt, tokens_before, tokens_after) for one mail.
+
+    The prompt is a short plain-text envelope (sender name, subject, cleaned
+    body) rather than indented JSON. tokens_before is the estimate for the
+    old JSON envelope, so the difference is what preprocessing saved.
+    """
+    original = json.dumps({
+        "subject": mail.get('subject'),
+        "from": mail.get('from'),
+        "date": mail.get('date'),
+        "body": mail.get('body')
+    }, indent=2)
+
+    name, address = parseaddr(mail.get('from') or '')
+    subject = ' '.join((mail.get('subject') or '').split())
+    body = clean_body(mail.get('body'), max(budget - count_tokens(subject), 1))
+
+    prompt = f"From: {name or address}\nSubject: {subject}\n\n{body}"
+    return prompt, count_tokens(original), count_tokens(prompt)
@@ -0,0 +1,80 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` tokens per minute.
+
+    Holds at most `capacity` tokens (default: one minute's worth).
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.capacity = float(per_minute if capacity is None else capacity)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` tokens are available (0 if they are now)"""
+        self._refill(now)
+        # Requests larger than the bucket would never fit; let them drain it
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Shared requests-per-minute and tokens-per-minute limiter for the LLM.
+
+    Workers call reserve() before each request, waiting as long as it says
+    (within their deadline), and settle() with the real token usage
+    afterwards. A 429 calls pause() so every worker backs off
+    until the provider's Retry-After has passed.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, estimated_tokens):
+        """Take one request and `estimated_tokens` if they fit now (returns 0), else return seconds to wait"""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(
+                self.blocked_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(estimated_tokens, now)
+            )
+            if wait <= 0:
+                self.requests.tokens -= 1
+                self.tokens.tokens -= estimated_tokens
+                return 0.0
+            return wait
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real usage is known"""
+        with self.lock:
+            self.tokens.tokens += estimated_tokens - actual_tokens
+
+    def headroom(self):
+        """Fraction of the request and token quota available right now (0 while paused)"""
+        with self.lock:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                return 0.0
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            return max(0.0, min(self.requests.tokens / self.requests.capacity,
+                                self.tokens.tokens / self.tokens.capacity))
+
+    def pause(self, seconds):
+        """Stop all requests for `seconds` (e.g. from a 429 Retry-After)"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
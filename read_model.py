@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+# Recent rows kept in memory per list
+WINDOW_SIZE = 200
+
+# How often the standalone API checks the database files for changes
+WATCH_INTERVAL = 1.0
+
+# An immutable view of the mailbox. `lists` maps 'all'/'unread' to newest-first
+# tuples and 'responded' to an oldest-first tuple; `complete` says whether a
+# list holds every row or only the most recent WINDOW_SIZE.
+Snapshot = namedtuple('Snapshot', 'version updated_at counts lists complete')
+
+
+class ReadModel:
+    """In-process, versioned snapshot of the mail store for the API.
+
+    The fetch and process stages publish changes through the store's
+    listener hook; each change builds a new Snapshot that replaces the old
+    one in a single assignment, so readers never lock or touch disk.
+    """
+
+    def __init__(self, store, window=WINDOW_SIZE):
+        self.store = store
+        self.window = window
+        self.lock = threading.Lock()
+        self.current = None
+        # Writes up to this version are already in the snapshot
+        self.base_version = 0
+
+    def attach(self):
+        """Load the initial snapshot and follow the store's writes"""
+        self.refresh()
+        self.store.subscribe(self.apply)
+        return self
+
+    def snapshot(self):
+        return self.current
+
+    def refresh(self):
+        """Rebuild the snapshot from the store"""
+        conn = self.store.connection()
+        with self.lock:
+            # One read transaction, so the lists and counts all match `version`:
+            # a write committed meanwhile is left to apply(), not counted twice
+            conn.execute('BEGIN')
+            try:
+                version, updated_at = self.store.version()
+                all_mails = tuple(self.store.iter_mails(limit=self.window + 1))
+                unread = tuple(self.store.iter_mails(status='unread', limit=self.window + 1))
+                # Responded is listed oldest first; keep the newest window in that order
+                responded = tuple(reversed(list(self.store.iter_responses(newest_first=True, limit=self.window + 1))))
+                counts = self.store.counts()
+            finally:
+                conn.commit()
+
+            self.base_version = version
+            self.current = Snapshot(
+                version=version,
+                updated_at=updated_at,
+                counts=counts,
+                lists={"all": all_mails[:self.window], "unread": unread[:self.window], "responded": responded[-self.window:]},
+                complete={"all": len(all_mails) <= self.window, "unread": len(unread) <= self.window,
+                          "responded": len(responded) <= self.window}
+            )
+
+    def apply(self, event, payload):
+        """Store listener: fold one committed write into a new snapshot"""
+        if event == 'archived':
+            # Rows left the store; reload rather than patch every list
+            self.refresh()
+            return
+
+        with self.lock:
+            old = self.current
+            if old is None or payload["version"] <= self.base_version:
+                return
+
+            counts = dict(old.counts)
+            lists = dict(old.lists)
+            complete = dict(old.complete)
+
+            if event == 'mails_added':
+                added = tuple(sorted(payload["mails"], key=lambda mail: mail["id"], reverse=True))
+                for name in ('all', 'unread'):
+                    lists[name] = self._trim(name, added + lists[name], complete)
+                counts["total_emails"] += len(added)
+                counts["unread_emails"] += len(added)
+
+            elif event == 'responded':
+                message_id = payload["mail"].get("message_id")
+                lists["unread"] = tuple(mail for mail in lists["unread"] if mail["message_id"] != message_id)
+                responded = tuple(row for row in lists["responded"] if row["message_id"] != message_id)
+                if len(responded) == len(lists["responded"]):
+                    counts["responded_emails"] += 1
+                lists["responded"] = self._trim_oldest('responded', responded + (payload["response"],), complete)
+                counts["unread_emails"] = max(counts["unread_emails"] - 1, 0)
+
+            self.current = Snapshot(
+                version=max(old.version, payload["version"]),
+                updated_at=max(old.updated_at, payload["updated_at"]),
+                counts=counts,
+                lists=lists,
+                complete=complete
+            )
+
+        # A partial unread window drains as replies go out; top it up from disk
+        if event == 'responded' and not complete["unread"] and len(lists["unread"]) < self.window // 2:
+            self.refresh()
+
+    def _trim(self, name, rows, complete):
+        if len(rows) > self.window:
+            complete[name] = False
+            return rows[:self.window]
+        return rows
+
+    def _trim_oldest(self, name, rows, complete):
+        if len(rows) > self.window:
+            complete[name] = False
+            return rows[-self.window:]
+        return rows
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """Reload when the database files change (for a separate API process)"""
+        def files_signature():
+            signature = []
+            for suffix in ('', '-wal'):
+                try:
+                    stat = os.stat(self.store.path + suffix)
+                    signature.append((stat.st_mtime_ns, stat.st_size))
+                except FileNotFoundError:
+                    signature.append(None)
+            return signature
+
+        def run(last):
+            while True:
+                time.sleep(interval)
+                try:
+                    current = files_signature()
+                    if current != last:
+                        last = current
+                        self.refresh()
+                except Exception as e:
+                    print(f"ERROR [READ MODEL WATCH]: {e}")
+
+        # Take the signature before loading so a write in between is not missed
+        last = files_signature()
+        self.refresh()
+        threading.Thread(target=run, args=(last,), name="read-model-watch", daemon=True).start()
+        return self
+
+
+def page(snapshot, name, after=None, limit=None):
+    """Serve a page from the snapshot, or None if it reaches past the window"""
+    rows = snapshot.lists[name]
+    complete = snapshot.complete[name]
+
+    if name == 'responded':
+        # Oldest first: the window holds every row from its first id onwards
+        if not complete and (not after or not rows or after < rows[0]["id"]):
+            return None
+        if after:
+            rows = tuple(row for row in rows if row["id"] > after)
+        return rows[:limit] if limit else rows
+
+    # Newest first: rows below the cursor are in memory until the window ends
+    if after:
+        rows = tuple(row for row in rows if row["id"] < after)
+    if limit and len(rows) >= limit:
+        return rows[:limit]
+    return rows if complete else None
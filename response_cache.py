@@ -0,0 +1,217 @@
+import hashlib
+import random
+import re
+import threading
+import time
+from array import array
+from email.utils import parseaddr
+
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS response_cache (
+    key         TEXT PRIMARY KEY,
+    response    TEXT NOT NULL,
+    signature   BLOB,
+    created_at  REAL NOT NULL,
+    last_used   REAL NOT NULL,
+    hits        INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS response_cache_last_used ON response_cache(last_used);
+'''
+
+# MinHash signature: NUM_PERM values split into LSH bands of BAND_ROWS
+NUM_PERM = 64
+BAND_ROWS = 4
+SHINGLE_SIZE = 4
+
+# Only the start of long bodies goes into the signature
+SIGNATURE_TEXT_LIMIT = 2000
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(0x6D61696C)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+_SUBJECT_PREFIX = re.compile(r'^\s*((re|fwd?|aw|sv)\s*:\s*)+', re.IGNORECASE)
+_SALUTATION = re.compile(r'^\s*Dear\s+[^,\n]*,', re.IGNORECASE)
+
+
+def normalize(subject, body):
+    """Canonical question text: no reply prefixes, quotes, case or punctuation noise"""
+    subject = _SUBJECT_PREFIX.sub('', subject or '')
+    lines = [line for line in (body or '').splitlines() if not line.lstrip().startswith('>')]
+    text = f"{subject}\n{' '.join(lines)}".lower()
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def minhash(text):
+    """MinHash signature over character shingles of normalized text"""
+    text = text[:SIGNATURE_TEXT_LIMIT]
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), 'big') for s in shingles]
+
+    signature = array('Q')
+    for a, b in _PERMUTATIONS:
+        signature.append(min((a * h + b) % _MERSENNE_PRIME for h in hashes))
+    return signature
+
+
+def _bands(signature):
+    for start in range(0, NUM_PERM, BAND_ROWS):
+        yield start // BAND_ROWS, tuple(signature[start:start + BAND_ROWS])
+
+
+def _similarity(sig_a, sig_b):
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / NUM_PERM
+
+
+def first_name(from_field):
+    """Best guess at the sender's first name for the salutation"""
+    name, address = parseaddr(from_field or '')
+    name = name.strip().strip('"')
+    if name:
+        # "Last, First" as well as "First Last"
+        if ',' in name:
+            name = name.split(',', 1)[1]
+        return name.split()[0].capitalize() if name.split() else 'there'
+    local = address.split('@')[0]
+    local = re.split(r'[._\-+0-9]', local)[0]
+    return local.capitalize() if local else 'there'
+
+
+def personalize(response, from_field):
+    """Swap the cached reply's "Dear <Name>," for the new recipient's"""
+    salutation = f"Dear {first_name(from_field)},"
+    if _SALUTATION.search(response):
+        return _SALUTATION.sub(salutation, response, count=1)
+    return response
+
+
+class ResponseCache:
+    """Persistent cache of AI replies keyed on the normalized question.
+
+    Exact matches are looked up by hash; when that misses, a MinHash/LSH
+    index finds near-duplicate questions above `similarity`. Entries expire
+    after `ttl` seconds and the least recently used are evicted past
+    `max_entries`. Stored in the mail database so it survives restarts.
+    """
+
+    def __init__(self, store, max_entries=5000, ttl=7 * 24 * 3600, similarity=0.9):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.lock = threading.Lock()
+        self.bands = None
+        self.signatures = {}
+        self.ready = False
+
+    def _conn(self):
+        conn = self.store.connection()
+        if not self.ready:
+            conn.executescript(CACHE_SCHEMA)
+            self.ready = True
+        return conn
+
+    def _load_index(self):
+        """Build the in-memory LSH index from the persisted signatures"""
+        if self.bands is not None:
+            return
+        self.bands = {}
+        for key, blob in self._conn().execute('SELECT key, signature FROM response_cache WHERE signature IS NOT NULL'):
+            signature = array('Q')
+            signature.frombytes(blob)
+            self._index(key, signature)
+
+    def _index(self, key, signature):
+        self.signatures[key] = signature
+        for band in _bands(signature):
+            self.bands.setdefault(band, set()).add(key)
+
+    def _unindex(self, key):
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for band in _bands(signature):
+            keys = self.bands.get(band)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.bands[band]
+
+    def get(self, subject, body):
+        """Return a cached reply for this question, or None"""
+        text = normalize(subject, body)
+        if not text:
+            return None
+
+        key = hashlib.sha256(text.encode()).hexdigest()
+        conn = self._conn()
+        now = time.time()
+
+        row = conn.execute('SELECT key, response, created_at FROM response_cache WHERE key = ?', (key,)).fetchone()
+
+        if row is None and self.similarity:
+            # Near-duplicate tier: candidates share at least one LSH band
+            signature = minhash(text)
+            with self.lock:
+                self._load_index()
+                candidates = set()
+                for band in _bands(signature):
+                    candidates |= self.bands.get(band, set())
+                best = max(candidates, key=lambda k: _similarity(signature, self.signatures[k]), default=None)
+                if best is not None and _similarity(signature, self.signatures[best]) < self.similarity:
+                    best = None
+            if best is not None:
+                row = conn.execute('SELECT key, response, created_at FROM response_cache WHERE key = ?', (best,)).fetchone()
+
+        if row is None:
+            return None
+
+        if now - row['created_at'] > self.ttl:
+            self._delete([row['key']])
+            return None
+
+        with conn:
+            conn.execute('UPDATE response_cache SET last_used = ?, hits = hits + 1 WHERE key = ?', (now, row['key']))
+        return row['response']
+
+    def put(self, subject, body, response):
+        """Cache a reply, evicting expired and least recently used entries"""
+        text = normalize(subject, body)
+        if not text or not response:
+            return
+
+        key = hashlib.sha256(text.encode()).hexdigest()
+        signature = minhash(text) if self.similarity else None
+        conn = self._conn()
+        now = time.time()
+
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO response_cache (key, response, signature, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, response, signature.tobytes() if signature else None, now, now)
+            )
+
+        if signature is not None:
+            with self.lock:
+                self._load_index()
+                self._unindex(key)
+                self._index(key, signature)
+
+        # Expired entries first, then the least recently used beyond the bound
+        expired = [r[0] for r in conn.execute('SELECT key FROM response_cache WHERE created_at < ?', (now - self.ttl,))]
+        overflow = [r[0] for r in conn.execute(
+            'SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?', (self.max_entries,)
+        )]
+        self._delete(set(expired) | set(overflow))
+
+    def _delete(self, keys):
+        if not keys:
+            return
+        conn = self._conn()
+        with conn:
+            conn.executemany('DELETE FROM response_cache WHERE key = ?', [(key,) for key in keys])
+        with self.lock:
+            if self.bands is not None:
+                for key in keys:
+                    self._unindex(key)
@@ -0,0 +1,291 @@
+import threading
+import time
+from email.utils import parseaddr
+import metrics
+from rate_limiter import TokenBucket
+
+# Priority classes, most urgent first
+VIP, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = {VIP: 'vip', NORMAL: 'normal', LOW: 'low'}
+
+# Reply deadline per class, counted from arrival (seconds)
+DEADLINES = {VIP: 2 * 60, NORMAL: 10 * 60, LOW: 60 * 60}
+
+# Prompts estimated above this many tokens are scheduled as LOW
+LARGE_PROMPT_TOKENS = 2000
+
+# Each sender may get this many replies per hour, in bursts of SENDER_BURST (0 = no cap)
+SENDER_RATE_PER_HOUR = 30
+SENDER_BURST = 5
+
+# Most mails one sender may have waiting in the scheduler at once
+SENDER_QUEUE_LIMIT = 10
+
+# Below this share of the Groq quota, LOW work is held back
+SHED_HEADROOM = 0.2
+
+# How often held-back work is re-checked (seconds)
+RECHECK_INTERVAL = 1.0
+
+# Bookkeeping for idle senders is pruned past this many entries
+MAX_TRACKED_SENDERS = 10000
+
+
+def sender_key(mail):
+    """Normalised sender address used for fair queuing and rate caps"""
+    return parseaddr(mail.get('from') or '')[1].lower()
+
+
+def prompt_tokens(mail):
+    """Cheap estimate of a mail's prompt size (~4 characters per token)"""
+    # Outbox records carry the body's length without loading the body
+    body_length = mail.get('body_length')
+    if body_length is None:
+        body_length = len(mail.get('body') or '')
+    return (len(mail.get('subject') or '') + body_length) // 4 + 1
+
+
+class _Pending:
+    """A queued (key, mail) entry with its scheduling attributes"""
+
+    def __init__(self, entry, sender, group, priority, deadline, cost):
+        self.entry = entry
+        self.sender = sender
+        self.group = group
+        self.priority = priority
+        self.deadline = deadline
+        self.cost = cost
+        self.held = False
+
+
+class ReplyScheduler:
+    """Priority, deadline and fair-share ordering for the reply pool.
+
+    A drop-in queue for WorkerPool: entries are (key, mail) pairs put under
+    a group (the account). Workers get the best eligible mail:
+
+    - mails past their deadline go first, earliest deadline first, which
+      keeps tail latency bounded during bursts;
+    - otherwise by priority class (VIP domains, normal, large prompts), then
+      by the service already given to the account and, within it, to the
+      sender, so a mailbox or sender that has had a lot of replies waits
+      its turn. Service is charged by prompt size, so short questions cost
+      less than long ones.
+
+    Senders over their hourly cap wait for their bucket to refill, and LOW
+    mail waits while the shared Groq quota is nearly used up. Held mail
+    doesn't take up the `maxsize` places meant for mail that can go now:
+    it has its own `held_limit` places, so a few throttled senders can
+    never crowd out everyone else. put() never blocks: when the places are
+    taken, or a sender already holds SENDER_QUEUE_LIMIT of them, the mail
+    is turned away and stays in the outbox; `wakeup` is set once there is
+    room again.
+    """
+
+    def __init__(self, maxsize=100, vip_domains=(), headroom=None,
+                 sender_rate=SENDER_RATE_PER_HOUR, sender_burst=SENDER_BURST,
+                 sender_limit=SENDER_QUEUE_LIMIT, large_prompt=LARGE_PROMPT_TOKENS, wakeup=None, held_limit=None):
+        self.maxsize = maxsize
+        self.held_limit = maxsize if held_limit is None else held_limit
+        self.vip_domains = {domain.lower().lstrip('@') for domain in vip_domains}
+        # headroom() -> share of the LLM quota left (e.g. RateLimiter.headroom)
+        self.headroom = headroom
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.sender_limit = sender_limit
+        self.large_prompt = large_prompt
+        # threading.Event set when a slot frees up after mail was turned away
+        self.wakeup = wakeup
+        self.turned_away = False
+
+        self.queues = {}
+        self.size = 0
+        # Senders currently held back, and how many entries they have queued
+        self.held_senders = set()
+        self.held_size = 0
+        self.group_sizes = {}
+        # Service received so far (virtual time) per sender and per group.
+        # A flow that goes idle and comes back starts from the current clock,
+        # so nobody banks credit while quiet.
+        self.sender_service = {}
+        self.group_service = {}
+        self.sender_clock = 0.0
+        self.group_clock = 0.0
+        self.buckets = {}
+        self.cond = threading.Condition()
+
+    def priority(self, mail, sender):
+        """Classify a mail as VIP, NORMAL or LOW"""
+        if sender.rpartition('@')[2] in self.vip_domains:
+            return VIP
+        if prompt_tokens(mail) > self.large_prompt:
+            return LOW
+        return NORMAL
+
+    def put(self, entry, group=None):
+        """Queue a (key, mail) entry; returns False if there is no room for it"""
+        mail = entry[1]
+        sender = sender_key(mail)
+        priority = self.priority(mail, sender)
+        arrived = mail.get('received_at') or time.time()
+        # Cost in fair-share units: one per mail plus one per ~1k prompt tokens
+        cost = 1 + prompt_tokens(mail) / 1000
+
+        with self.cond:
+            queue = self.queues.get(sender, [])
+            if len(queue) >= self.sender_limit:
+                self.turned_away = True
+                metrics.inc('scheduler_rejected_total', reason='sender_limit')
+                return False
+
+            # Held mail goes in the held places, the rest in the ordinary ones
+            head = queue[0].priority if queue else priority
+            held = bool(self._hold(sender, head, self._shedding())[0])
+            if held:
+                full = self.held_limit and self.held_size >= self.held_limit
+            else:
+                full = self.maxsize and self.size - self.held_size >= self.maxsize
+            if full:
+                self.turned_away = True
+                metrics.inc('scheduler_rejected_total', reason='held_full' if held else 'full')
+                return False
+
+            self._set_held(sender, held)
+            self.queues[sender] = queue
+            if held:
+                self.held_size += 1
+
+            if not queue:
+                self.sender_service[sender] = max(self.sender_service.get(sender, 0.0), self.sender_clock)
+            if not self.group_sizes.get(group):
+                self.group_service[group] = max(self.group_service.get(group, 0.0), self.group_clock)
+
+            queue.append(_Pending(entry, sender, group, priority, arrived + DEADLINES[priority], cost))
+            self.group_sizes[group] = self.group_sizes.get(group, 0) + 1
+            self.size += 1
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        """Block until a mail is eligible and return the most urgent one"""
+        with self.cond:
+            while True:
+                pending, wait = self._choose()
+                if pending is not None:
+                    return self._dispatch(pending)
+                self.cond.wait(wait)
+
+    def poll(self):
+        """Non-blocking get: (entry, None), or (None, seconds until one may be eligible or None)"""
+        with self.cond:
+            pending, wait = self._choose()
+            if pending is None:
+                return None, wait
+            return self._dispatch(pending), None
+
+    def qsize(self):
+        return self.size
+
+    def _shedding(self):
+        return self.headroom is not None and self.headroom() < SHED_HEADROOM
+
+    def _hold(self, sender, priority, shedding):
+        """(seconds, reason) a sender whose next mail has `priority` must wait, or (0, None)"""
+        # Over the per-sender cap: wait for the bucket to refill
+        delay = self._bucket(sender).wait_time(1, time.monotonic()) if self.sender_rate else 0
+        if delay:
+            return delay, 'sender_cap'
+        if shedding and priority == LOW:
+            return RECHECK_INTERVAL, 'quota'
+        return 0, None
+
+    def _set_held(self, sender, held):
+        """Move a sender's queued entries between the held and the ordinary places"""
+        if held == (sender in self.held_senders):
+            return
+        queued = len(self.queues.get(sender, ()))
+        if held:
+            self.held_senders.add(sender)
+            self.held_size += queued
+            # Ordinary places were freed
+            if queued and self.turned_away and self.wakeup is not None:
+                self.turned_away = False
+                self.wakeup.set()
+        else:
+            self.held_senders.discard(sender)
+            self.held_size -= queued
+
+    def _choose(self):
+        """Return (best eligible entry, None) or (None, seconds until something may be)"""
+        now = time.time()
+        shedding = self._shedding()
+        best, best_rank, wait = None, None, None
+
+        for sender, queue in self.queues.items():
+            pending = queue[0]
+
+            delay, reason = self._hold(sender, pending.priority, shedding)
+            self._set_held(sender, bool(delay))
+            if delay:
+                if not pending.held:
+                    pending.held = True
+                    metrics.inc('scheduler_held_total', reason=reason)
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            if pending.deadline <= now:
+                rank = (0, pending.deadline, 0, 0)
+            else:
+                rank = (1, pending.priority, self.group_service[pending.group], self.sender_service[sender])
+            if best_rank is None or rank < best_rank:
+                best, best_rank = pending, rank
+
+        return best, wait
+
+    def _dispatch(self, pending):
+        queue = self.queues[pending.sender]
+        queue.pop(0)
+        if not queue:
+            del self.queues[pending.sender]
+            self.held_senders.discard(pending.sender)
+        self.size -= 1
+        self.group_sizes[pending.group] -= 1
+
+        if self.sender_rate:
+            self._bucket(pending.sender).tokens -= 1
+
+        # Charge the service and advance the clocks to where this mail started
+        self.group_clock = max(self.group_clock, self.group_service[pending.group])
+        self.sender_clock = max(self.sender_clock, self.sender_service[pending.sender])
+        self.group_service[pending.group] += pending.cost
+        self.sender_service[pending.sender] += pending.cost
+        self._prune()
+        self.cond.notify_all()
+
+        if self.turned_away and self.wakeup is not None:
+            self.turned_away = False
+            self.wakeup.set()
+
+        name = PRIORITY_NAMES[pending.priority]
+        metrics.inc('scheduler_dispatched_total', priority=name)
+        if pending.deadline < time.time():
+            metrics.inc('scheduler_deadline_missed_total', priority=name)
+        return pending.entry
+
+    def _bucket(self, sender):
+        bucket = self.buckets.get(sender)
+        if bucket is None:
+            bucket = self.buckets[sender] = TokenBucket(self.sender_rate / 60.0, capacity=self.sender_burst)
+        return bucket
+
+    def _prune(self):
+        """Forget idle senders whose service and buckets no longer matter"""
+        if len(self.buckets) + len(self.sender_service) <= MAX_TRACKED_SENDERS:
+            return
+        now = time.monotonic()
+        for sender in list(self.sender_service):
+            if sender not in self.queues and self.sender_service[sender] <= self.sender_clock:
+                del self.sender_service[sender]
+        for sender, bucket in list(self.buckets.items()):
+            if sender not in self.queues and bucket.wait_time(bucket.capacity, now) == 0:
+                del self.buckets[sender]
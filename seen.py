@@ -0,0 +1,148 @@
+import bisect
+import hashlib
+import heapq
+import threading
+from array import array
+
+SEEN_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS seen_ids (
+    hash  INTEGER PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS seen_state (
+    id               INTEGER PRIMARY KEY CHECK (id = 0),
+    through_mail_id  INTEGER NOT NULL
+);
+'''
+
+# Recent additions are kept in a small set and merged into the sorted array
+# once there are this many
+MERGE_THRESHOLD = 4096
+
+# Rows hashed per batch when catching up from the mails table
+BACKFILL_BATCH = 10000
+
+
+def id_hash(message_id):
+    """64-bit (signed, as SQLite stores it) hash of a Message-ID"""
+    digest = hashlib.blake2b(message_id.encode('utf-8', errors='surrogateescape'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class SeenSet:
+    """Every Message-ID MailLLM has ever stored, at 8 bytes each.
+
+    Hashes live in a sorted array('q') searched with bisect, plus a small
+    set of recent additions merged in past MERGE_THRESHOLD, so memory is
+    fixed per mail and a lookup allocates nothing. The seen_ids table is
+    the persistent copy; unlike the mails table it keeps the ids of mail
+    that was archived (or expired) away, so a UIDVALIDITY resync can't
+    bring old mail back for a second reply. At a million mails the chance
+    of any two ids sharing a hash is about 3 in 100 million.
+
+    Fed by the store's 'mails_added' event; on load it catches up on mail
+    stored since the last recorded mail id (after a crash, say).
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.hashes = None
+        self.recent = set()
+        self.lock = threading.Lock()
+
+    def attach(self):
+        """Load the hashes and follow the store's writes"""
+        self._load()
+        self.store.subscribe(self._apply)
+        return self
+
+    def __contains__(self, message_id):
+        if not message_id:
+            return False
+        if self.hashes is None:
+            self._load()
+
+        value = id_hash(message_id)
+        with self.lock:
+            hit = value in self.recent
+            if not hit:
+                i = bisect.bisect_left(self.hashes, value)
+                hit = i < len(self.hashes) and self.hashes[i] == value
+        return hit
+
+    def __len__(self):
+        if self.hashes is None:
+            self._load()
+        with self.lock:
+            return len(self.hashes) + len(self.recent)
+
+    def add(self, mails):
+        """Record stored mails (dicts with 'id' and 'message_id')"""
+        values = {id_hash(mail['message_id']) for mail in mails if mail.get('message_id')}
+        through = max((mail['id'] for mail in mails if mail.get('id')), default=None)
+        if not values:
+            return
+
+        conn = self.store.connection()
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO seen_ids (hash) VALUES (?)', [(value,) for value in values])
+            if through is not None:
+                conn.execute(
+                    'INSERT INTO seen_state (id, through_mail_id) VALUES (0, ?) '
+                    'ON CONFLICT(id) DO UPDATE SET through_mail_id = MAX(through_mail_id, excluded.through_mail_id)',
+                    (through,)
+                )
+
+        with self.lock:
+            if self.hashes is not None:
+                self.recent.update(values)
+                if len(self.recent) >= MERGE_THRESHOLD:
+                    self._merge()
+
+    def _apply(self, event, payload):
+        if event == 'mails_added':
+            self.add(payload["mails"])
+
+    def _merge(self):
+        """Fold the recent additions into the sorted array in one pass"""
+        merged = array('q')
+        last = None
+        for value in heapq.merge(self.hashes, sorted(self.recent)):
+            if value != last:
+                merged.append(value)
+                last = value
+        self.hashes = merged
+        self.recent = set()
+
+    def _load(self):
+        conn = self.store.connection()
+        created = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'seen_ids'").fetchone() is None
+        conn.executescript(SEEN_SCHEMA)
+
+        if created:
+            # Mail archived before this table existed is only in the archive index
+            has_archive = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'archive_index'").fetchone()
+            if has_archive:
+                self._backfill('archive_index', 0, track=False)
+
+        # Mail stored since the last recorded id (all of it on first use)
+        row = conn.execute('SELECT through_mail_id FROM seen_state WHERE id = 0').fetchone()
+        self._backfill('mails', row[0] if row else 0)
+
+        hashes = array('q', (row[0] for row in conn.execute('SELECT hash FROM seen_ids ORDER BY hash')))
+        with self.lock:
+            self.hashes = hashes
+            self.recent = set()
+
+    def _backfill(self, table, after, track=True):
+        """Hash a table's Message-IDs above rowid `after`, a batch at a time"""
+        conn = self.store.connection()
+        while True:
+            rows = conn.execute(
+                f'SELECT rowid, message_id FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (after, BACKFILL_BATCH)
+            ).fetchall()
+            if not rows:
+                return
+            after = rows[-1][0]
+            self.add([{"id": row[0] if track else None, "message_id": row[1]} for row in rows])
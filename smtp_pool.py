@@ -0,0 +1,180 @@
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import Future
+
+# Sessions idle longer than this are checked with NOOP before reuse
+NOOP_AFTER = 60
+
+
+def _session_lost(error):
+    """Whether an SMTP error means the session is gone, rather than one message failing"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # 421: the server is closing the channel
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code == 421
+
+
+class SmtpPool:
+    """Small pool of authenticated SMTP sessions reused across sends"""
+
+    def __init__(self, connect, size=2):
+        # connect() must return a logged-in SMTP object or None
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.open = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """Borrow a live session, opening one if the pool isn't full"""
+        with self.cond:
+            while not self.idle and self.open >= self.size:
+                self.cond.wait()
+
+            if self.idle:
+                server, last_used = self.idle.pop()
+            else:
+                server, last_used = None, 0
+                self.open += 1
+
+        # Quietly replace sessions the server has timed out
+        if server is not None and time.monotonic() - last_used > NOOP_AFTER:
+            try:
+                if server.noop()[0] != 250:
+                    raise smtplib.SMTPServerDisconnected("NOOP failed")
+            except (smtplib.SMTPException, OSError):
+                self._quit(server)
+                server = None
+
+        if server is None:
+            server = self.connect()
+            if server is None:
+                self._forget()
+                raise smtplib.SMTPConnectError(421, "could not open SMTP session")
+
+        return server
+
+    def release(self, server, broken=False):
+        """Return a session to the pool, or drop it if it failed"""
+        if broken:
+            self._quit(server)
+            self._forget()
+            return
+
+        with self.cond:
+            self.idle.append((server, time.monotonic()))
+            self.cond.notify()
+
+    def close(self):
+        """Quit every idle session"""
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+        for server, _ in idle:
+            self._quit(server)
+
+    def _forget(self):
+        with self.cond:
+            self.open -= 1
+            self.cond.notify()
+
+    @staticmethod
+    def _quit(server):
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+
+class OutboundQueue:
+    """Outgoing mail queue drained in batches over pooled SMTP sessions.
+
+    send() blocks until the message is accepted (or fails) so callers can
+    record the result; sender threads take whatever has queued up and push
+    it through one session.
+    """
+
+    def __init__(self, pool, senders=2, batch_size=20):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.senders = senders
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for i in range(self.senders):
+            threading.Thread(target=self._run, name=f"smtp-{i}", daemon=True).start()
+
+    def submit(self, msg):
+        """Queue a message and return a Future resolving to True/False"""
+        self.start()
+        future = Future()
+        self.queue.put((msg, future))
+        return future
+
+    def send(self, msg):
+        """Queue a message and wait for the send result"""
+        return self.submit(msg).result()
+
+    def depth(self):
+        """Number of messages waiting to be sent"""
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            # Block for the first message, then drain whatever else is waiting
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        pending = list(batch)
+        retried = False
+
+        while pending:
+            try:
+                server = self.pool.acquire()
+            except Exception as e:
+                print(f"ERROR sending email: {e}")
+                for _, future in pending:
+                    future.set_result(False)
+                return
+
+            broken = False
+            try:
+                while pending:
+                    msg, future = pending[0]
+                    try:
+                        server.send_message(msg)
+                        future.set_result(True)
+                    except smtplib.SMTPException as e:
+                        if _session_lost(e):
+                            raise
+                        # The message was rejected (or needs an extension the
+                        # server lacks); the session is still fine
+                        print(f"ERROR sending email: {e}")
+                        future.set_result(False)
+                    pending.pop(0)
+            except (smtplib.SMTPException, OSError) as e:
+                # Session died mid-batch: reconnect once and resend the rest
+                broken = True
+                if retried:
+                    print(f"ERROR sending email: {e}")
+                    for _, future in pending:
+                        future.set_result(False)
+                    pending = []
+                retried = True
+            finally:
+                self.pool.release(server, broken=broken)
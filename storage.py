@@ -0,0 +1,982 @@
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import metrics
+
+# SQLite database holding mail, responses and IMAP sync state
+DB_FILE = './logs/MailLLM.db'
+
+# Outbox retry policy: exponential backoff between attempts, then dead-letter
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_MIN = 30
+OUTBOX_BACKOFF_MAX = 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mails (
+    id          INTEGER PRIMARY KEY,
+    message_id  TEXT UNIQUE,
+    subject     TEXT,
+    sender      TEXT,
+    date        TEXT,
+    date_ts     REAL,
+    body        TEXT,
+    folder      TEXT,
+    uid         INTEGER,
+    fetched_at  REAL NOT NULL,
+    received_at REAL,
+    status      TEXT NOT NULL DEFAULT 'unread',
+    account     TEXT NOT NULL DEFAULT 'default',
+    in_reply_to TEXT,
+    refs        TEXT
+);
+CREATE INDEX IF NOT EXISTS mails_date ON mails(date_ts);
+CREATE INDEX IF NOT EXISTS mails_sender ON mails(sender);
+CREATE INDEX IF NOT EXISTS mails_status ON mails(status, id);
+
+CREATE TABLE IF NOT EXISTS responses (
+    id                INTEGER PRIMARY KEY,
+    message_id        TEXT UNIQUE,
+    original_subject  TEXT,
+    original_from     TEXT,
+    responded_at      TEXT NOT NULL,
+    response          TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key    TEXT PRIMARY KEY,
+    value  REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    account      TEXT NOT NULL DEFAULT 'default',
+    folder       TEXT NOT NULL,
+    uidvalidity  INTEGER NOT NULL,
+    last_uid     INTEGER NOT NULL,
+    PRIMARY KEY (account, folder)
+);
+
+-- Reply state machine, one row per mail:
+-- received -> generating -> generated -> sending -> sent, or dead after
+-- OUTBOX_MAX_ATTEMPTS failures. The draft is kept so a retry never pays
+-- for the LLM call twice.
+CREATE TABLE IF NOT EXISTS outbox (
+    message_id       TEXT PRIMARY KEY,
+    state            TEXT NOT NULL DEFAULT 'received',
+    draft            TEXT,
+    attempts         INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at  REAL NOT NULL DEFAULT 0,
+    last_error       TEXT,
+    updated_at       REAL NOT NULL,
+    lease_owner      TEXT,
+    lease_expires    REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox(state, next_attempt_at);
+
+-- Jobs only one process may run at a time (archiving), leased like outbox rows
+CREATE TABLE IF NOT EXISTS task_leases (
+    name     TEXT PRIMARY KEY,
+    owner    TEXT NOT NULL,
+    expires  REAL NOT NULL
+);
+
+-- Change feed for API consumers: one row per stored mail, sent reply or
+-- archive batch, written in the same transaction as the change. `data` is
+-- the event as JSON, including its effect on the /stats counts.
+CREATE TABLE IF NOT EXISTS changes (
+    seq         INTEGER PRIMARY KEY,
+    kind        TEXT NOT NULL,
+    message_id  TEXT,
+    data        TEXT NOT NULL,
+    at          REAL NOT NULL
+);
+'''
+
+# Outbox states a worker can pick up
+OUTBOX_READY = ('received', 'generated')
+
+# Outbox states a worker holds under a lease while it generates or sends
+OUTBOX_LEASED = ('generating', 'sending')
+
+# Seconds a claimed row stays with its process without a heartbeat; after
+# that any process may reclaim it
+LEASE_SECONDS = 120
+
+# Most recent changes kept for /changes and /events; a client further behind
+# is told to reload
+CHANGE_LOG_SIZE = 10000
+
+# Recorded in the database's user_version once _migrate() has brought it up
+# to date; bump it whenever a migration is added
+SCHEMA_VERSION = 1
+
+# Full-text index over mail and our replies. The text itself stays in
+# mails/responses (read through the view for snippets); triggers keep the
+# index in step with every insert, replace and delete.
+SEARCH_SCHEMA = '''
+CREATE VIEW IF NOT EXISTS mail_search_source AS
+    SELECT mails.id, mails.subject, mails.sender, mails.body, responses.response
+    FROM mails LEFT JOIN responses ON responses.message_id = mails.message_id;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS mail_fts USING fts5(
+    subject, sender, body, response,
+    content='mail_search_source', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS mails_fts_insert AFTER INSERT ON mails BEGIN
+    INSERT INTO mail_fts (rowid, subject, sender, body, response)
+    VALUES (new.id, new.subject, new.sender, new.body,
+            (SELECT response FROM responses WHERE message_id = new.message_id));
+END;
+
+CREATE TRIGGER IF NOT EXISTS mails_fts_delete AFTER DELETE ON mails BEGIN
+    INSERT INTO mail_fts (mail_fts, rowid, subject, sender, body, response)
+    VALUES ('delete', old.id, old.subject, old.sender, old.body,
+            (SELECT response FROM responses WHERE message_id = old.message_id));
+END;
+
+CREATE TRIGGER IF NOT EXISTS mails_fts_update AFTER UPDATE OF subject, sender, body ON mails BEGIN
+    INSERT INTO mail_fts (mail_fts, rowid, subject, sender, body, response)
+    VALUES ('delete', old.id, old.subject, old.sender, old.body,
+            (SELECT response FROM responses WHERE message_id = old.message_id));
+    INSERT INTO mail_fts (rowid, subject, sender, body, response)
+    VALUES (new.id, new.subject, new.sender, new.body,
+            (SELECT response FROM responses WHERE message_id = new.message_id));
+END;
+
+-- A response is added to its mail's entry, and taken out again when it is
+-- deleted or replaced (REPLACE fires this with recursive_triggers on)
+CREATE TRIGGER IF NOT EXISTS responses_fts_insert AFTER INSERT ON responses BEGIN
+    INSERT INTO mail_fts (mail_fts, rowid, subject, sender, body, response)
+    SELECT 'delete', id, subject, sender, body, NULL FROM mails WHERE message_id = new.message_id;
+    INSERT INTO mail_fts (rowid, subject, sender, body, response)
+    SELECT id, subject, sender, body, new.response FROM mails WHERE message_id = new.message_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS responses_fts_delete AFTER DELETE ON responses BEGIN
+    INSERT INTO mail_fts (mail_fts, rowid, subject, sender, body, response)
+    SELECT 'delete', id, subject, sender, body, old.response FROM mails WHERE message_id = old.message_id;
+    INSERT INTO mail_fts (rowid, subject, sender, body, response)
+    SELECT id, subject, sender, body, NULL FROM mails WHERE message_id = old.message_id;
+END;
+'''
+
+# Column weights for bm25 ranking: subject, sender, body, response
+SEARCH_WEIGHTS = (5.0, 2.0, 1.0, 1.5)
+
+_SEARCH_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _date_ts(date):
+    """Parse an RFC 2822 Date header into a sortable timestamp"""
+    try:
+        return parsedate_to_datetime(date).timestamp()
+    except Exception:
+        return None
+
+
+def _mail_dict(row):
+    return {
+        "id": row["id"],
+        "message_id": row["message_id"],
+        "subject": row["subject"],
+        "from": row["sender"],
+        "date": row["date"],
+        "body": row["body"],
+        "received_at": row["received_at"],
+        "account": row["account"],
+        "in_reply_to": row["in_reply_to"],
+        "references": row["refs"]
+    }
+
+
+def _response_dict(row):
+    return {
+        "id": row["id"],
+        "message_id": row["message_id"],
+        "original_subject": row["original_subject"],
+        "original_from": row["original_from"],
+        "responded_at": row["responded_at"],
+        "response": row["response"]
+    }
+
+
+class MailRecord:
+    """A mail on its way through the outbox, without the cost of a dict per mail.
+
+    Reads like the mail dicts (get() and [key], 'from' for the sender) so
+    the scheduler, workers and prompt builder take either. The body is
+    loaded from the store on first use, so mail that only waits in the
+    reply queue never holds it; body_length is there for size estimates.
+    Senders and account names are interned, since many mails share them.
+    """
+
+    __slots__ = (
+        'id', 'message_id', 'subject', 'sender', 'date', 'received_at', 'account', 'in_reply_to',
+        'references', 'state', 'draft', 'attempts', 'body_length', '_body', '_store'
+    )
+
+    # dict keys that differ from the attribute name
+    _ATTRIBUTES = {'from': 'sender', 'body': 'body'}
+
+    def __init__(self, row, store):
+        keys = row.keys()
+        self.id = row["id"]
+        self.message_id = row["message_id"]
+        self.subject = row["subject"]
+        self.sender = sys.intern(row["sender"]) if row["sender"] else row["sender"]
+        self.date = row["date"]
+        self.received_at = row["received_at"]
+        self.account = sys.intern(row["account"])
+        self.in_reply_to = row["in_reply_to"]
+        self.references = row["refs"]
+        self.state = row["state"]
+        self.draft = row["draft"]
+        self.attempts = row["attempts"]
+        self._body = row["body"] if 'body' in keys else None
+        self.body_length = row["body_length"] if 'body_length' in keys else len(self._body or '')
+        self._store = store
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self._store.mail_body(self.message_id)
+        return self._body
+
+    def get(self, key, default=None):
+        attribute = self._ATTRIBUTES.get(key, key)
+        if attribute.startswith('_') or not hasattr(self, attribute):
+            return default
+        return getattr(self, attribute)
+
+    def __getitem__(self, key):
+        attribute = self._ATTRIBUTES.get(key, key)
+        if attribute.startswith('_') or not hasattr(self, attribute):
+            raise KeyError(key)
+        return getattr(self, attribute)
+
+    def __repr__(self):
+        return f"MailRecord({self.message_id!r}, state={self.state!r})"
+
+
+def _add_missing_columns(conn):
+    """Upgrade databases created before a column was added"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(mails)')}
+    if 'received_at' not in columns:
+        conn.execute('ALTER TABLE mails ADD COLUMN received_at REAL')
+    if 'account' not in columns:
+        conn.execute("ALTER TABLE mails ADD COLUMN account TEXT NOT NULL DEFAULT 'default'")
+    if 'in_reply_to' not in columns:
+        conn.execute('ALTER TABLE mails ADD COLUMN in_reply_to TEXT')
+        conn.execute('ALTER TABLE mails ADD COLUMN refs TEXT')
+
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(outbox)')}
+    if 'lease_owner' not in columns:
+        conn.execute('ALTER TABLE outbox ADD COLUMN lease_owner TEXT')
+        conn.execute('ALTER TABLE outbox ADD COLUMN lease_expires REAL')
+
+    # sync_state used to be keyed on folder alone; rebuild it per account
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(sync_state)')}
+    if 'account' not in columns:
+        with conn:
+            conn.execute('ALTER TABLE sync_state RENAME TO sync_state_old')
+            conn.executescript(SCHEMA)
+            conn.execute(
+                'INSERT INTO sync_state (folder, uidvalidity, last_uid) '
+                'SELECT folder, uidvalidity, last_uid FROM sync_state_old'
+            )
+            conn.execute('DROP TABLE sync_state_old')
+
+
+def _fts_terms(text):
+    terms = []
+    for phrase, word in _SEARCH_TERM.findall(text or ''):
+        prefix = word.endswith('*')
+        term = (phrase or word.rstrip('*')).replace('"', '')
+        if not any(c.isalnum() for c in term):
+            continue
+        terms.append(f'"{term}"*' if prefix else f'"{term}"')
+    return terms
+
+
+def fts_query(text):
+    """Turn a search box string into a safe FTS5 query.
+
+    Words and "quoted phrases" are all required; a trailing * makes a word a
+    prefix. FTS5 operators and punctuation in the input are taken literally.
+    """
+    return ' '.join(_fts_terms(text))
+
+
+def _add_search_index(conn):
+    """Create the full-text index, filling it from the stored mail the first time"""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'mail_fts'").fetchone()
+    conn.executescript(SEARCH_SCHEMA)
+    if not exists:
+        with conn:
+            conn.execute("INSERT INTO mail_fts (mail_fts) VALUES ('rebuild')")
+
+
+def _backfill_outbox(conn):
+    """Queue replies for unread mail stored before the outbox existed"""
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO outbox (message_id, updated_at) "
+            "SELECT message_id, ? FROM mails WHERE status = 'unread'", (time.time(),)
+        )
+
+
+# Serialises _migrate() between this process's threads
+_migrate_lock = threading.Lock()
+
+
+def _migrate(conn):
+    """Create or upgrade the schema, once per database rather than per connection"""
+    with _migrate_lock:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+        conn.executescript(SCHEMA)
+        _add_missing_columns(conn)
+        _backfill_outbox(conn)
+        try:
+            _add_search_index(conn)
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5: everything but /search still works
+            print(f"ERROR creating search index: {e}")
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def lease_owner():
+    """Name for this process in outbox leases: host, pid and a random suffix"""
+    return f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}"
+
+
+class MailStore:
+    """Mail repository backed by SQLite in WAL mode.
+
+    Each thread gets its own connection; WAL lets API readers run while the
+    fetch and process threads write. Outbox rows a worker claims are leased
+    to this store's `owner` for `lease_seconds`, so any number of
+    processes can share one outbox (see transition()).
+    """
+
+    def __init__(self, path=DB_FILE, owner=None, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.owner = owner or lease_owner()
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        self.listeners = []
+
+    def connection(self):
+        """Return this thread's SQLite connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # The search index's delete trigger relies on this for REPLACE
+            conn.execute('PRAGMA recursive_triggers = ON')
+            _migrate(conn)
+            self._local.conn = conn
+        return conn
+
+    # Listeners
+
+    def subscribe(self, listener):
+        """Call listener(event, payload) after each committed write.
+
+        Events: ('mails_added', {'mails', 'version', 'updated_at', 'seq'}),
+        ('responded', {'mail', 'response', 'version', 'updated_at', 'seq'})
+        and ('archived', {'message_ids', 'version', 'updated_at', 'seq'}),
+        where seq is the write's last entry in the change log.
+        """
+        self.listeners.append(listener)
+
+    def _publish(self, event, payload):
+        for listener in self.listeners:
+            try:
+                listener(event, payload)
+            except Exception as e:
+                print(f"ERROR in store listener: {e}")
+
+    # Mail
+
+    @metrics.timed('store_write', op='add_mails')
+    def add_mails(self, mails, folder="INBOX", account="default"):
+        """Insert mails for an account, skipping Message-IDs already stored. Returns the new rows."""
+        conn = self.connection()
+        added = []
+        now = time.time()
+
+        with conn:
+            for mail in mails:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO mails (message_id, subject, sender, date, date_ts, body, folder, uid, fetched_at, received_at, account, in_reply_to, refs) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (mail.get('message_id'), mail.get('subject'), mail.get('from'), mail.get('date'),
+                     _date_ts(mail.get('date')), mail.get('body'), folder, mail.get('uid'), now,
+                     mail.get('received_at') or now, account, mail.get('in_reply_to'), mail.get('references'))
+                )
+                if cursor.rowcount:
+                    # Queue the reply in the same transaction as the mail
+                    conn.execute(
+                        'INSERT OR IGNORE INTO outbox (message_id, updated_at) VALUES (?, ?)',
+                        (mail.get('message_id'), now)
+                    )
+                    added.append({
+                        "id": cursor.lastrowid,
+                        "message_id": mail.get('message_id'),
+                        "subject": mail.get('subject'),
+                        "from": mail.get('from'),
+                        "date": mail.get('date'),
+                        "body": mail.get('body'),
+                        "received_at": mail.get('received_at') or now,
+                        "account": account,
+                        "in_reply_to": mail.get('in_reply_to'),
+                        "references": mail.get('references')
+                    })
+            if added:
+                version, updated_at = self._bump_version(conn)
+                seq = self._log_changes(conn, [
+                    ('new_mail', mail["message_id"], {
+                        "id": mail["id"],
+                        "subject": mail["subject"],
+                        "from": mail["from"],
+                        "date": mail["date"],
+                        "received_at": mail["received_at"],
+                        "account": account,
+                        "stats": {"total_emails": 1, "unread_emails": 1}
+                    })
+                    for mail in added
+                ])
+
+        if added:
+            self._publish('mails_added', {"mails": added, "version": version, "updated_at": updated_at, "seq": seq})
+        return added
+
+    def mail_body(self, message_id):
+        """Return one mail's body ('' if it has none or is gone)"""
+        row = self.connection().execute('SELECT body FROM mails WHERE message_id = ?', (message_id,)).fetchone()
+        return (row["body"] if row else None) or ''
+
+    def iter_mails(self, status=None, after=None, limit=None):
+        """Yield mails newest first, optionally filtered by status ('unread'/'responded').
+
+        `after` is a cursor: the id of the last mail on the previous page.
+        """
+        query = 'SELECT * FROM mails'
+        where = []
+        params = []
+        if status:
+            where.append('status = ?')
+            params.append(status)
+        if after:
+            where.append('id < ?')
+            params.append(after)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY id DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        for row in self.connection().execute(query, params):
+            yield _mail_dict(row)
+
+    def pending_mails(self, limit=None, account=None, per_sender=None):
+        """Return mails whose next reply attempt is due, oldest first, with their outbox state.
+
+        `per_sender` keeps only each sender's oldest few, so one sender's
+        backlog can't fill the whole page.
+        """
+        # Bodies stay in the database until a worker needs one (see MailRecord)
+        query = (
+            'SELECT mails.id, mails.message_id, mails.subject, mails.sender, mails.date, mails.received_at, '
+            'mails.account, mails.in_reply_to, mails.refs, LENGTH(mails.body) AS body_length, '
+            'outbox.state, outbox.draft, outbox.attempts, '
+            'ROW_NUMBER() OVER (PARTITION BY mails.sender ORDER BY mails.id) AS sender_rank FROM outbox '
+            'JOIN mails ON mails.message_id = outbox.message_id '
+            'WHERE outbox.state IN (?, ?) AND outbox.next_attempt_at <= ?'
+        )
+        params = [*OUTBOX_READY, time.time()]
+        if account:
+            query += ' AND mails.account = ?'
+            params.append(account)
+        query = f'SELECT * FROM ({query})'
+        if per_sender:
+            query += ' WHERE sender_rank <= ?'
+            params.append(per_sender)
+        query += ' ORDER BY id'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        return [MailRecord(row, self) for row in self.connection().execute(query, params)]
+
+    @metrics.timed('store_search')
+    def search(self, query, sender=None, account=None, status=None, since=None, until=None, limit=20, offset=0):
+        """Full-text search over mail and our replies, best match first.
+
+        `query` is a search box string (see fts_query); `sender` matches a
+        name or address in From. `since`/`until` are Unix timestamps on the
+        mail's Date. Each result is a mail dict plus 'status', a 'snippet'
+        with matches in [brackets] and its bm25 'score' (lower is better).
+        """
+        match = fts_query(query)
+        if sender:
+            sender_terms = _fts_terms(sender)
+            if not sender_terms:
+                raise ValueError(f"Nothing to search for in sender {sender!r}")
+            # Column filter: every word of `sender` must be in From
+            match = ' '.join([match] + [f'sender : {term}' for term in sender_terms]).strip()
+        if not match:
+            raise ValueError("Nothing to search for")
+
+        sql = (
+            "SELECT mails.*, snippet(mail_fts, -1, '[', ']', '…', 16) AS snippet, "
+            f"bm25(mail_fts, {', '.join(map(str, SEARCH_WEIGHTS))}) AS score "
+            'FROM mail_fts JOIN mails ON mails.id = mail_fts.rowid WHERE mail_fts MATCH ?'
+        )
+        params = [match]
+        if account:
+            sql += ' AND mails.account = ?'
+            params.append(account)
+        if status:
+            sql += ' AND mails.status = ?'
+            params.append(status)
+        if since is not None:
+            sql += ' AND COALESCE(mails.date_ts, mails.received_at) >= ?'
+            params.append(since)
+        if until is not None:
+            sql += ' AND COALESCE(mails.date_ts, mails.received_at) < ?'
+            params.append(until)
+        sql += ' ORDER BY score LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+
+        return [
+            dict(_mail_dict(row), status=row["status"], snippet=row["snippet"], score=round(row["score"], 4))
+            for row in self.connection().execute(sql, params)
+        ]
+
+    # Responses
+
+    @metrics.timed('store_write', op='mark_responded')
+    def mark_responded(self, mail, response):
+        """Record a sent reply and flip the mail to 'responded' in one transaction.
+
+        The outbox row only moves to 'sent' under this owner's lease. If the
+        lease expired and another process reclaimed the row, nothing is
+        recorded and None is returned; the new owner finds the reply in the
+        Sent folder (see recover_outbox).
+        """
+        conn = self.connection()
+        entry = {
+            "message_id": mail.get('message_id'),
+            "original_subject": mail.get('subject'),
+            "original_from": mail.get('from'),
+            "responded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "response": response
+        }
+
+        with conn:
+            cursor = conn.execute(
+                "UPDATE outbox SET state = 'sent', last_error = NULL, updated_at = ?, lease_owner = NULL, lease_expires = NULL "
+                "WHERE message_id = ? AND lease_owner = ?",
+                (time.time(), mail.get('message_id'), self.owner)
+            )
+            if cursor.rowcount != 1:
+                return None
+
+            # What this reply changes in the counts (a resend replaces the old reply)
+            replaced = conn.execute('SELECT 1 FROM responses WHERE message_id = ?', (entry["message_id"],)).fetchone()
+            unread = conn.execute(
+                "SELECT 1 FROM mails WHERE message_id = ? AND status = 'unread'", (entry["message_id"],)
+            ).fetchone()
+
+            cursor = conn.execute(
+                'INSERT OR REPLACE INTO responses (message_id, original_subject, original_from, responded_at, response) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (entry["message_id"], entry["original_subject"], entry["original_from"],
+                 entry["responded_at"], entry["response"])
+            )
+            entry = dict(id=cursor.lastrowid, **entry)
+            conn.execute("UPDATE mails SET status = 'responded' WHERE message_id = ?", (mail.get('message_id'),))
+            version, updated_at = self._bump_version(conn)
+            seq = self._log_changes(conn, [
+                ('reply_sent', entry["message_id"], {
+                    "id": entry["id"],
+                    "original_subject": entry["original_subject"],
+                    "original_from": entry["original_from"],
+                    "responded_at": entry["responded_at"],
+                    "stats": {"unread_emails": -1 if unread else 0, "responded_emails": 0 if replaced else 1}
+                })
+            ])
+
+        self._publish('responded', {"mail": mail, "response": entry, "version": version, "updated_at": updated_at, "seq": seq})
+        return entry
+
+    def iter_responses(self, after=None, limit=None, newest_first=False):
+        """Yield responses in the order they were sent, starting after cursor `after`"""
+        query = 'SELECT * FROM responses'
+        params = []
+        if after:
+            query += ' WHERE id < ?' if newest_first else ' WHERE id > ?'
+            params.append(after)
+        query += ' ORDER BY id DESC' if newest_first else ' ORDER BY id'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        for row in self.connection().execute(query, params):
+            yield _response_dict(row)
+
+    def counts(self):
+        """Return total/unread/responded counts from the indexes"""
+        conn = self.connection()
+        total = conn.execute('SELECT COUNT(*) FROM mails').fetchone()[0]
+        unread = conn.execute("SELECT COUNT(*) FROM mails WHERE status = 'unread'").fetchone()[0]
+        responded = conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {
+            "total_emails": total,
+            "unread_emails": unread,
+            "responded_emails": responded
+        }
+
+    # Archiving
+
+    def archive_candidates(self, before, limit=1000):
+        """Settled mail (answered or dead-lettered) that arrived before `before`, oldest first.
+
+        Each record is the mail dict plus its date_ts, fetched_at, status,
+        outbox state and response ({responded_at, response} or None).
+        """
+        rows = self.connection().execute(
+            'SELECT mails.*, outbox.state, responses.responded_at, responses.response FROM mails '
+            'LEFT JOIN outbox ON outbox.message_id = mails.message_id '
+            'LEFT JOIN responses ON responses.message_id = mails.message_id '
+            "WHERE COALESCE(mails.received_at, mails.fetched_at) < ? AND (outbox.state IS NULL OR outbox.state IN ('sent', 'dead')) "
+            'ORDER BY mails.id LIMIT ?',
+            (before, limit)
+        )
+        return [
+            dict(
+                _mail_dict(row),
+                date_ts=row["date_ts"],
+                fetched_at=row["fetched_at"],
+                status=row["status"],
+                state=row["state"],
+                response={"responded_at": row["responded_at"], "response": row["response"]}
+                if row["responded_at"] is not None else None
+            )
+            for row in rows
+        ]
+
+    @metrics.timed('store_write', op='delete_mails')
+    def delete_mails(self, message_ids):
+        """Remove archived mails with their responses and outbox rows"""
+        if not message_ids:
+            return
+        conn = self.connection()
+        params = [(message_id,) for message_id in message_ids]
+
+        with conn:
+            unread = conn.execute(
+                "SELECT COUNT(*) FROM mails WHERE status = 'unread' AND message_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(message_ids)),)
+            ).fetchone()[0]
+            # Responses first so the search index drops the reply with the mail
+            responses = conn.executemany('DELETE FROM responses WHERE message_id = ?', params).rowcount
+            conn.executemany('DELETE FROM outbox WHERE message_id = ?', params)
+            mails = conn.executemany('DELETE FROM mails WHERE message_id = ?', params).rowcount
+            version, updated_at = self._bump_version(conn)
+            # One change per batch rather than per mail
+            seq = self._log_changes(conn, [
+                ('archived', None, {
+                    "message_ids": list(message_ids),
+                    "stats": {"total_emails": -mails, "unread_emails": -unread, "responded_emails": -responses}
+                })
+            ])
+
+        self._publish('archived', {"message_ids": list(message_ids), "version": version, "updated_at": updated_at, "seq": seq})
+
+    # Outbox
+
+    def transition(self, message_id, from_state, to_state, draft=None):
+        """Move an outbox row between states if it is still in `from_state`.
+
+        Returns False when another worker (or process) got there first, so
+        each step is claimed exactly once. Moving into 'generating' or
+        'sending' leases the row to this store's owner; leaving those states
+        takes a lease we still hold, so a worker whose lease expired and was
+        reclaimed can't carry on. A draft, if given, is saved in the same
+        write.
+        """
+        now = time.time()
+        leased = to_state in OUTBOX_LEASED
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute(
+                'UPDATE outbox SET state = ?, draft = COALESCE(?, draft), updated_at = ?, lease_owner = ?, lease_expires = ? '
+                'WHERE message_id = ? AND state = ? AND (lease_owner IS NULL OR lease_owner = ?)',
+                (to_state, draft, now, self.owner if leased else None, now + self.lease_seconds if leased else None,
+                 message_id, from_state, self.owner)
+            )
+        return cursor.rowcount == 1
+
+    def renew_leases(self):
+        """Heartbeat: extend every lease this owner holds; returns how many"""
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute(
+                f'UPDATE outbox SET lease_expires = ? WHERE lease_owner = ? AND state IN ({", ".join("?" * len(OUTBOX_LEASED))})',
+                (time.time() + self.lease_seconds, self.owner, *OUTBOX_LEASED)
+            )
+        return cursor.rowcount
+
+    def release_leases(self):
+        """Let other processes reclaim this owner's rows now (on shutdown)"""
+        conn = self.connection()
+        with conn:
+            conn.execute('UPDATE outbox SET lease_expires = 0 WHERE lease_owner = ?', (self.owner,))
+
+    def claim_task(self, name):
+        """Take or renew this owner's lease on a job only one process may run, such as archiving.
+
+        Returns False while another owner holds a live lease on it. Claim
+        again at least every `lease_seconds` to keep it.
+        """
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO task_leases (name, owner, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+                'WHERE task_leases.owner = excluded.owner OR task_leases.expires < ?',
+                (name, self.owner, now + self.lease_seconds, now)
+            )
+        return cursor.rowcount == 1
+
+    def release_task(self, name):
+        """Give up this owner's lease on a job"""
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM task_leases WHERE name = ? AND owner = ?', (name, self.owner))
+
+    def outbox_failed(self, message_id, error, permanent=False):
+        """Schedule a retry with exponential backoff, or dead-letter the row.
+
+        The row goes back to 'generated' if a draft was saved, otherwise to
+        'received'. Permanent errors go straight to 'dead'. Returns the new
+        state.
+        """
+        conn = self.connection()
+        with conn:
+            # A row reclaimed by another process is no longer ours to fail
+            row = conn.execute(
+                'SELECT attempts, draft FROM outbox WHERE message_id = ? AND (lease_owner IS NULL OR lease_owner = ?)',
+                (message_id, self.owner)
+            ).fetchone()
+            if row is None:
+                return None
+
+            attempts = row["attempts"] + 1
+            if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                state, next_attempt_at = 'dead', 0
+            else:
+                state = 'generated' if row["draft"] is not None else 'received'
+                delay = min(OUTBOX_BACKOFF_MIN * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+                next_attempt_at = time.time() + delay + random.uniform(0, delay / 2)
+
+            conn.execute(
+                'UPDATE outbox SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?, '
+                'lease_owner = NULL, lease_expires = NULL WHERE message_id = ?',
+                (state, attempts, next_attempt_at, str(error), time.time(), message_id)
+            )
+        return state
+
+    def next_attempt_at(self):
+        """Return when the earliest backed-off reply becomes due, or None"""
+        row = self.connection().execute(
+            'SELECT MIN(next_attempt_at) FROM outbox WHERE state IN (?, ?) AND next_attempt_at > ?',
+            (*OUTBOX_READY, time.time())
+        ).fetchone()
+        return row[0]
+
+    def recover_outbox(self, accounts=None):
+        """Reclaim rows whose lease expired (their process died or stalled); safe to call any time.
+
+        'generating' rows never saved a draft, so they go back to 'received'.
+        'sending' rows may or may not have reached the SMTP server; they are
+        leased to this owner and returned (with their drafts) for the caller
+        to check against the Sent folder. Each expired row is reclaimed by
+        exactly one process. Pass `accounts` to leave other accounts' rows
+        alone. Rows from before leases existed count as expired.
+        """
+        conn = self.connection()
+        now = time.time()
+        owned = ''
+        params = []
+        if accounts is not None:
+            placeholders = ', '.join('?' * len(accounts))
+            owned = f' AND message_id IN (SELECT message_id FROM mails WHERE account IN ({placeholders}))'
+            params = list(accounts)
+        expired = ' AND (lease_expires IS NULL OR lease_expires < ?)'
+
+        with conn:
+            cursor = conn.execute(
+                "UPDATE outbox SET state = 'received', updated_at = ?, lease_owner = NULL, lease_expires = NULL "
+                "WHERE state = 'generating'" + expired + owned,
+                [now, now, *params]
+            )
+            requeued = cursor.rowcount
+            claimed = [row[0] for row in conn.execute(
+                "UPDATE outbox SET lease_owner = ?, lease_expires = ?, updated_at = ? "
+                "WHERE state = 'sending'" + expired + owned + ' RETURNING message_id',
+                [self.owner, now + self.lease_seconds, now, now, *params]
+            ).fetchall()]
+        if requeued or claimed:
+            metrics.inc('outbox_leases_reclaimed_total', requeued, state='generating')
+            metrics.inc('outbox_leases_reclaimed_total', len(claimed), state='sending')
+        if not claimed:
+            return []
+
+        placeholders = ', '.join('?' * len(claimed))
+        rows = conn.execute(
+            'SELECT mails.*, outbox.state, outbox.draft, outbox.attempts FROM outbox '
+            f'JOIN mails ON mails.message_id = outbox.message_id WHERE outbox.message_id IN ({placeholders})',
+            claimed
+        ).fetchall()
+        return [MailRecord(row, self) for row in rows]
+
+    def outbox_counts(self):
+        """Return {state: rows} for the outbox"""
+        rows = self.connection().execute('SELECT state, COUNT(*) FROM outbox GROUP BY state').fetchall()
+        return {state: count for state, count in rows}
+
+    # Change tracking
+
+    def _bump_version(self, conn):
+        """Advance the data version inside the caller's write transaction"""
+        version = conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + 1 RETURNING value"
+        ).fetchone()[0]
+        updated_at = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('updated_at', ?)", (updated_at,)
+        )
+        return int(version), updated_at
+
+    def version(self):
+        """Return (version, updated_at) for mail and responses; changes on every write"""
+        rows = dict(self.connection().execute("SELECT key, value FROM meta WHERE key IN ('version', 'updated_at')").fetchall())
+        return int(rows.get('version', 0)), rows.get('updated_at', 0.0)
+
+    def _log_changes(self, conn, entries):
+        """Append (kind, message_id, data) entries to the change log inside the caller's transaction.
+
+        Returns the last sequence number; entries past CHANGE_LOG_SIZE are dropped.
+        """
+        now = time.time()
+        seq = None
+        for kind, message_id, data in entries:
+            seq = conn.execute(
+                'INSERT INTO changes (kind, message_id, data, at) VALUES (?, ?, ?, ?)',
+                (kind, message_id, json.dumps(data, ensure_ascii=False), now)
+            ).lastrowid
+        conn.execute('DELETE FROM changes WHERE seq <= ?', (seq - CHANGE_LOG_SIZE,))
+        return seq
+
+    def last_change(self):
+        """Sequence number of the latest change (0 before the first)"""
+        return self.connection().execute('SELECT MAX(seq) FROM changes').fetchone()[0] or 0
+
+    def changes(self, since=0, limit=100):
+        """Return (changes, reset): changes after sequence number `since`, oldest first.
+
+        reset is True when changes after `since` were already dropped from
+        the log (or `since` is from another database), so the caller has to
+        reload its lists and stats before following the feed again.
+        """
+        conn = self.connection()
+        first, last = conn.execute('SELECT MIN(seq), MAX(seq) FROM changes').fetchone()
+        reset = since > (last or 0) or (first is not None and since < first - 1)
+
+        rows = conn.execute(
+            'SELECT seq, kind, message_id, data, at FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+            (since, limit)
+        )
+        return [
+            dict(json.loads(row["data"]), seq=row["seq"], type=row["kind"], message_id=row["message_id"], at=row["at"])
+            for row in rows
+        ], reset
+
+    # IMAP sync state
+
+    def get_sync_state(self, folder, account="default"):
+        """Return {'uidvalidity', 'last_uid'} for an account's folder, or {} if never synced"""
+        row = self.connection().execute(
+            'SELECT uidvalidity, last_uid FROM sync_state WHERE account = ? AND folder = ?', (account, folder)
+        ).fetchone()
+        return dict(row) if row else {}
+
+    def set_sync_state(self, folder, state, account="default"):
+        """Persist the UIDVALIDITY/high-water mark for an account's folder"""
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sync_state (account, folder, uidvalidity, last_uid) VALUES (?, ?, ?, ?)',
+                (account, folder, state['uidvalidity'], state['last_uid'])
+            )
+
+    # Migration
+
+    def import_json_logs(self, all_file, unread_file, responded_file):
+        """One-time import of the old JSON log files into an empty database"""
+        conn = self.connection()
+        if conn.execute('SELECT 1 FROM mails LIMIT 1').fetchone() or \
+                conn.execute('SELECT 1 FROM responses LIMIT 1').fetchone():
+            return
+
+        def load(filepath):
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return []
+            except Exception as e:
+                print(f"ERROR loading {filepath}: {e}")
+                return []
+
+        responded = load(responded_file)
+        mails = load(unread_file) + load(all_file)
+        if not responded and not mails:
+            return
+
+        # Oldest first so ids follow arrival order
+        self.add_mails(list(reversed(mails)))
+        with conn:
+            for entry in responded:
+                conn.execute(
+                    'INSERT OR IGNORE INTO responses (message_id, original_subject, original_from, responded_at, response) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (entry.get('message_id'), entry.get('original_subject'), entry.get('original_from'),
+                     entry.get('responded_at') or '', entry.get('response'))
+                )
+            conn.execute(
+                "UPDATE mails SET status = 'responded' WHERE message_id IN (SELECT message_id FROM responses)"
+            )
+            conn.execute(
+                "UPDATE outbox SET state = 'sent' WHERE message_id IN (SELECT message_id FROM responses)"
+            )
+            self._bump_version(conn)
+        print(f"Imported {len(mails)} mails and {len(responded)} responses from JSON logs")
@@ -0,0 +1,151 @@
+import json
+import re
+import time
+from preprocess import clean_body, count_tokens
+
+THREADS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id    TEXT PRIMARY KEY,
+    turns        TEXT NOT NULL,
+    total_turns  INTEGER NOT NULL DEFAULT 0,
+    updated_at   REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS thread_messages (
+    message_id  TEXT PRIMARY KEY,
+    thread_id   TEXT NOT NULL
+);
+'''
+
+# Most tokens of earlier conversation sent along with a follow-up
+CONTEXT_TOKEN_BUDGET = 400
+
+# Each remembered question and answer is cut to this many tokens
+TURN_TOKEN_LIMIT = 80
+
+# Turns kept per thread; older ones only survive as a count
+MAX_TURNS = 6
+
+_MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+_SALUTATION = re.compile(r'^\s*Dear\s+[^,\n]*,\s*', re.IGNORECASE)
+_SIGN_OFF = re.compile(r'\s*Best Regards,?\s*MailLLM\s*$', re.IGNORECASE)
+
+
+def message_ids(value):
+    """Every <id> in an In-Reply-To or References header, oldest first"""
+    return _MESSAGE_ID.findall(value or '')
+
+
+def reference_chain(mail):
+    """References for a reply to `mail`: its own References plus its Message-ID"""
+    chain = message_ids(mail.get('references')) or message_ids(mail.get('in_reply_to'))
+    if mail.get('message_id') and mail['message_id'] not in chain:
+        chain.append(mail['message_id'])
+    return chain
+
+
+def _shorten(text, limit):
+    """Collapse text to at most `limit` tokens, word by word"""
+    words = text.split()
+    kept, used = [], 0
+    for word in words:
+        cost = count_tokens(word)
+        if used + cost > limit:
+            return ' '.join(kept) + ' …'
+        kept.append(word)
+        used += cost
+    return ' '.join(kept)
+
+
+class ThreadIndex:
+    """Conversation threads and a compact rolling summary of each.
+
+    Incoming mail is tied to a thread through its In-Reply-To/References
+    headers, matched against the Message-IDs of earlier mail and of our own
+    replies. Each answered mail adds a short question/answer turn to its
+    thread; the last MAX_TURNS are kept, and context() renders them within
+    a token budget so a follow-up carries the conversation without the
+    quoted chain. Stored in the mail database next to the mail itself.
+    """
+
+    def __init__(self, store, budget=CONTEXT_TOKEN_BUDGET):
+        self.store = store
+        self.budget = budget
+        self.ready = False
+
+    def _conn(self):
+        conn = self.store.connection()
+        if not self.ready:
+            conn.executescript(THREADS_SCHEMA)
+            self.ready = True
+        return conn
+
+    def thread_of(self, mail):
+        """Return the thread id a mail belongs to, or None if it starts a new one"""
+        ids = message_ids(mail.get('in_reply_to')) + message_ids(mail.get('references'))
+        if not ids:
+            return None
+
+        conn = self._conn()
+        placeholders = ', '.join('?' * len(ids))
+        row = conn.execute(
+            f'SELECT thread_id FROM thread_messages WHERE message_id IN ({placeholders}) LIMIT 1', ids
+        ).fetchone()
+        return row['thread_id'] if row else None
+
+    def context(self, mail):
+        """Summary of the earlier conversation for a follow-up, or '' for a new thread"""
+        thread_id = self.thread_of(mail)
+        if thread_id is None:
+            return ''
+
+        row = self._conn().execute('SELECT turns, total_turns FROM threads WHERE thread_id = ?', (thread_id,)).fetchone()
+        if row is None:
+            return ''
+
+        # Newest turns first until the budget runs out, then back in order
+        lines, used = [], 0
+        turns = json.loads(row['turns'])
+        for turn in reversed(turns):
+            text = f"Q: {turn['q']}\nA: {turn['a']}"
+            cost = count_tokens(text)
+            if used + cost > self.budget:
+                break
+            lines.insert(0, text)
+            used += cost
+
+        if not lines:
+            return ''
+        earlier = row['total_turns'] - len(lines)
+        if earlier > 0:
+            lines.insert(0, f"({earlier} earlier exchanges not shown)")
+        return '\n\n'.join(lines)
+
+    def record(self, mail, response, reply_id=None):
+        """Add an answered mail to its thread and remember our reply's Message-ID"""
+        message_id = mail.get('message_id')
+        if not message_id:
+            return
+
+        question = _shorten(clean_body(mail.get('body')) or mail.get('subject') or '', TURN_TOKEN_LIMIT)
+        answer = _SIGN_OFF.sub('', _SALUTATION.sub('', response or ''))
+        answer = _shorten(answer, TURN_TOKEN_LIMIT)
+
+        conn = self._conn()
+        thread_id = self.thread_of(mail) or (message_ids(mail.get('references')) or [message_id])[0]
+        now = time.time()
+
+        with conn:
+            row = conn.execute('SELECT turns, total_turns FROM threads WHERE thread_id = ?', (thread_id,)).fetchone()
+            turns = json.loads(row['turns']) if row else []
+            total = row['total_turns'] if row else 0
+
+            turns = (turns + [{"q": question, "a": answer}])[-MAX_TURNS:]
+            conn.execute(
+                'INSERT OR REPLACE INTO threads (thread_id, turns, total_turns, updated_at) VALUES (?, ?, ?, ?)',
+                (thread_id, json.dumps(turns), total + 1, now)
+            )
+            conn.executemany(
+                'INSERT OR IGNORE INTO thread_messages (message_id, thread_id) VALUES (?, ?)',
+                [(mid, thread_id) for mid in (message_id, reply_id) if mid]
+            )
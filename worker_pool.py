@@ -0,0 +1,167 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+
+class FairQueue:
+    """Bounded queue that serves its groups round robin.
+
+    Items are put under a group (an account, say); get() takes one item from
+    each non-empty group in turn, so a backlog in one group can't starve the
+    others. put() blocks while the queue as a whole is full.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.groups = OrderedDict()
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def put(self, item, group=None):
+        with self.cond:
+            while self.maxsize and self.size >= self.maxsize:
+                self.cond.wait()
+            self.groups.setdefault(group, deque()).append(item)
+            self.size += 1
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        with self.cond:
+            while not self.size:
+                self.cond.wait()
+
+            # Take from the group at the head, then send it to the back of the line
+            group, items = next(iter(self.groups.items()))
+            item = items.popleft()
+            if items:
+                self.groups.move_to_end(group)
+            else:
+                del self.groups[group]
+            self.size -= 1
+            self.cond.notify_all()
+            return item
+
+    def qsize(self):
+        return self.size
+
+
+class WorkerPool:
+    """Fixed pool of threads consuming a bounded queue.
+
+    submit() blocks when the queue is full, which pushes back on the
+    producer instead of buffering without limit. Items are keyed so the same
+    mail is never queued twice while it is waiting or being handled, and
+    grouped so each group gets its turn. Any queue with put(item, group),
+    get() and qsize() can replace the default FairQueue; put() may return
+    False to turn an item away.
+    """
+
+    def __init__(self, handler, workers=4, queue_size=100, name="worker", queue=None):
+        self.handler = handler
+        self.queue = queue if queue is not None else FairQueue(maxsize=queue_size)
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, item, group=None):
+        """Queue an item unless the same key is already queued or running"""
+        with self.lock:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+
+        if not self.queue.put((key, item), group):
+            with self.lock:
+                self.in_flight.discard(key)
+            return False
+        return True
+
+    def depth(self):
+        """Number of items waiting in the queue"""
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            key, item = self.queue.get()
+            try:
+                self.handler(item)
+            except Exception as e:
+                print(f"ERROR [{threading.current_thread().name}]: {e}")
+            finally:
+                with self.lock:
+                    self.in_flight.discard(key)
+
+
+class AsyncWorkerPool:
+    """WorkerPool for an asyncio event loop: tasks awaiting a coroutine handler.
+
+    Same keyed submit() as WorkerPool, but the queue must never block: its
+    put() turns items away when full and its poll() returns (item, None) or
+    (None, seconds to wait or None), as ReplyScheduler does. Idle workers
+    sleep on an event instead of holding a thread, so a few dozen of them
+    cost next to nothing while they wait on the LLM or SMTP.
+    """
+
+    def __init__(self, handler, queue, workers=32, name="worker"):
+        self.handler = handler
+        self.queue = queue
+        self.workers = workers
+        self.name = name
+        self.in_flight = set()
+        self.closing = False
+        self.ready = None
+        self.tasks = []
+
+    def start(self):
+        self.ready = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._run(), name=f"{self.name}-{i}") for i in range(self.workers)]
+
+    def submit(self, key, item, group=None):
+        """Queue an item unless the same key is already queued or running"""
+        if self.closing or key in self.in_flight:
+            return False
+        if not self.queue.put((key, item), group):
+            return False
+        self.in_flight.add(key)
+        self.ready.set()
+        return True
+
+    def depth(self):
+        """Number of items waiting in the queue"""
+        return self.queue.qsize()
+
+    async def drain(self, timeout):
+        """Stop taking items and give running ones `timeout` seconds to finish; returns how many were cut off"""
+        self.closing = True
+        self.ready.set()
+        _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        return len(pending)
+
+    async def _run(self):
+        while not self.closing:
+            entry, wait = self.queue.poll()
+            if entry is None:
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            key, item = entry
+            try:
+                await self.handler(item)
+            except Exception as e:
+                print(f"ERROR [{asyncio.current_task().get_name()}]: {e}")
+            finally:
+                self.in_flight.discard(key)